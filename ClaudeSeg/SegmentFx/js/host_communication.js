@@ -86,6 +86,55 @@ var HostCommunication = (function() {
         });
     }
 
+    // Python scripts keep this file up to date while they run; see metrics.ProgressTracker
+    function getProgressPath() {
+        return csInterface.getSystemPath(SystemPath.EXTENSION) + '/logs/segmentfx_progress.json';
+    }
+
+    function formatDuration(seconds) {
+        seconds = Math.round(seconds);
+        var minutes = Math.floor(seconds / 60);
+        return minutes + ':' + ('0' + (seconds % 60)).slice(-2);
+    }
+
+    function formatProgress(progress) {
+        var text = progress.done + (progress.total ? '/' + progress.total : '') + ' ' + progress.unit;
+        if (progress.rate) {
+            text += ' \u00b7 ' + progress.rate.toFixed(1) + ' fps';
+        }
+        if (progress.eta_seconds !== null && progress.eta_seconds !== undefined && progress.status === 'running') {
+            text += ' \u00b7 ETA ' + formatDuration(progress.eta_seconds);
+        }
+        return text;
+    }
+
+    // Polls the progress file and shows throughput and ETA under message until the returned function is called
+    function watchProgress(message) {
+        var progressPath = getProgressPath();
+        ensureDirectoryExistence(progressPath);
+        if (window.cep && window.cep.fs.existsSync(progressPath)) {
+            window.cep.fs.deleteFile(progressPath);  // A finished job's numbers are not this job's
+        }
+        var timer = setInterval(function() {
+            if (!window.cep) {
+                return;
+            }
+            var result = window.cep.fs.readFile(progressPath);
+            if (result.err !== 0) {
+                return;
+            }
+            try {
+                var progress = JSON.parse(result.data);
+                showLoading(message + ' ' + formatProgress(progress));
+            } catch (e) {
+                // Ignore a file that is being replaced
+            }
+        }, 500);
+        return function() {
+            clearInterval(timer);
+        };
+    }
+
     function showLoading(message) {
         document.getElementById('loadingIndicator').style.display = 'flex';
         document.getElementById('loadingMessage').textContent = message;
@@ -107,7 +156,9 @@ var HostCommunication = (function() {
     // Function to perform auto segmentation
     function autoSegment(objectCount) {
         return new Promise((resolve, reject) => {
-            csInterface.evalScript(`autoSegment(${objectCount})`, (result) => {
+            const stopWatching = watchProgress('Auto segmentation:');
+            csInterface.evalScript(`autoSegment(${objectCount}, ${JSON.stringify(getProgressPath())})`, (result) => {
+                stopWatching();
                 try {
                     const parsedResult = JSON.parse(result);
                     if (parsedResult.status === "loading") {
@@ -133,7 +184,9 @@ var HostCommunication = (function() {
     // Function to perform manual segmentation
     function manualSegment(imageData) {
         return new Promise((resolve, reject) => {
-            csInterface.evalScript(`manualSegment("${imageData}")`, (result) => {
+            const stopWatching = watchProgress('Manual segmentation:');
+            csInterface.evalScript(`manualSegment("${imageData}", ${JSON.stringify(getProgressPath())})`, (result) => {
+                stopWatching();
                 try {
                     const parsedResult = JSON.parse(result);
                     if (parsedResult.status === "loading") {
@@ -173,7 +226,14 @@ var HostCommunication = (function() {
 
     // Function to apply multiple effects to a clip
     function applyMultipleEffects(clipIndex, trackIndex, effects) {
-        return callExtendScript('applyMultipleEffects', clipIndex, trackIndex, effects);
+        const stopWatching = watchProgress('Rendering effects:');
+        const request = callExtendScript('applyMultipleEffects', clipIndex, trackIndex, effects, getProgressPath());
+        const done = function() {
+            stopWatching();
+            hideLoading();
+        };
+        request.then(done, done);
+        return request;
     }
 
     // Function to import masks to timeline
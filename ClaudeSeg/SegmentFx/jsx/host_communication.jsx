@@ -4,6 +4,11 @@ function joinPath() {
     return Array.prototype.slice.call(arguments).join("/");
 }
 
+// Arguments asking a Python script to keep a progress file (progress, throughput, ETA) for the panel to poll
+function progressArgs(progressPath) {
+    return progressPath ? ["--progress-file", '"' + progressPath + '"'] : [];
+}
+
 function testExtendScriptFunction() {
     var extensionRoot = File($.fileName).parent.fsName;
     var fullpath = joinPath(extensionRoot,  "CEP", "extensions", "SegmentFx");
@@ -44,7 +49,7 @@ function getSequenceDetails() {
 }
 
 // Function to perform auto segmentation
-function autoSegment(objectCount) {
+function autoSegment(objectCount, progressPath) {
     var extensionRoot = File($.fileName).parent.fsName;
     var fullpath = joinPath(extensionRoot,  "CEP", "extensions", "SegmentFx");
     var pythonScript = joinPath(fullpath, "python", "segmentation.py");
@@ -64,7 +69,7 @@ function autoSegment(objectCount) {
 
         // Execute the Python script
         $.evalFile(new File(joinPath(fullpath, "jsx", "execute_python.jsx")));
-        var result = executePython(pythonScript, ["auto", videoPath, objectCount]);
+        var result = executePython(pythonScript, ["auto", videoPath, objectCount].concat(progressArgs(progressPath)));
         
         // Process result and import masks
         var parsedResult = JSON.parse(result);
@@ -82,7 +87,7 @@ function autoSegment(objectCount) {
 }
 
 // Function to perform manual segmentation
-function manualSegment(imageData) {
+function manualSegment(imageData, progressPath) {
     var extensionRoot = File($.fileName).parent.fsName;
     var fullpath = joinPath(extensionRoot,  "CEP", "extensions", "SegmentFx");
     var pythonScript = joinPath(fullpath, "python", "segmentation.py");
@@ -108,7 +113,7 @@ function manualSegment(imageData) {
 
         // Execute the Python script
         $.evalFile(new File(joinPath(fullpath, "jsx", "execute_python.jsx")));
-        var result = executePython(pythonScript, ["manual", videoPath, tempFile.fsName]);
+        var result = executePython(pythonScript, ["manual", videoPath, tempFile.fsName].concat(progressArgs(progressPath)));
         
         tempFile.remove();
         
@@ -146,20 +151,30 @@ function importMasksToTimeline(outputDir) {
     // maybe: var maskClip = maskTrack.insertClip(maskVideo, sequence.getPlayerPosition());
 
 
-    // Load and parse the metadata
-    var metadataFile = new File(outputDir + "/mask_metadata.json");
-    metadataFile.open("r");
-    var metadataJSON = metadataFile.read();
-    metadataFile.close();
-    var metadata = JSON.parse(metadataJSON);
-
-    // Create adjustment layers for each unique object
+    // Collect the unique object ids. Container output lists them in mask_objects.json;
+    // the PNG layout only has the per-mask metadata.
     var objectIds = [];
-    for (var i = 0; i < metadata.length; i++) {
-        if (objectIds.indexOf(metadata[i].object_id) === -1) {
-            objectIds.push(metadata[i].object_id);
+    var objectsFile = new File(outputDir + "/mask_objects.json");
+    if (objectsFile.exists) {
+        objectsFile.open("r");
+        objectIds = JSON.parse(objectsFile.read()).object_ids;
+        objectsFile.close();
+    } else {
+        // Load and parse the metadata
+        var metadataFile = new File(outputDir + "/mask_metadata.json");
+        metadataFile.open("r");
+        var metadataJSON = metadataFile.read();
+        metadataFile.close();
+        var metadata = JSON.parse(metadataJSON);
+
+        for (var i = 0; i < metadata.length; i++) {
+            if (objectIds.indexOf(metadata[i].object_id) === -1) {
+                objectIds.push(metadata[i].object_id);
+            }
         }
     }
+
+    // Create adjustment layers for each unique object
     
     for (var i = 0; i < objectIds.length; i++) {
         var objectId = objectIds[i];
@@ -185,6 +200,8 @@ function getAllEffects() {
     var fullpath = joinPath(extensionRoot,  "CEP", "extensions", "SegmentFx");
     var effectsFile = File(joinPath(fullpath, "data", "premiere_effects.json"));
     var effects = [];
+    // Effects registered in custom_effects.py; `python custom_effects.py --list-effects` prints the current list
+    var customEffects = [];
 
     if (effectsFile.exists) {
         effectsFile.open('r');
@@ -194,6 +211,7 @@ function getAllEffects() {
         try {
             var jsonContent = JSON.parse(content);
             effects = jsonContent.effects;
+            customEffects = jsonContent.custom_effects || [];
         } catch (e) {
             alert("Error parsing effects file: " + e.toString());
         }
@@ -201,12 +219,6 @@ function getAllEffects() {
         alert("Effects file not found: " + effectsFile.fsName);
     }
     
-    var customEffects = [
-        { name: "Glitch", type: "custom" },
-        { name: "Pixelate", type: "custom" }
-        // Add more custom effects here as you implement them
-    ];
-    
     return JSON.stringify(effects.concat(customEffects));
 }
 
@@ -235,6 +247,11 @@ function applyEffectToClip(clipIndex, trackIndex, effectName) {
 
 // Function to apply custom effect
 function applyCustomEffect(clipIndex, trackIndex, effectName, parameters) {
+    return applyCustomEffectChain(clipIndex, trackIndex, [{ name: effectName, parameters: parameters }]);
+}
+
+// Function to apply an ordered chain of custom effects in a single pass over the clip
+function applyCustomEffectChain(clipIndex, trackIndex, chain, progressPath) {
     var sequence = getActiveSequence();
     if (!sequence) return JSON.stringify({ error: "No active sequence" });
 
@@ -248,12 +265,18 @@ function applyCustomEffect(clipIndex, trackIndex, effectName, parameters) {
     var fullpath = joinPath(extensionRoot,  "CEP", "extensions", "SegmentFx");
     
     var pythonScript = File(joinPath(fullpath, "python", "custom_effects.py"));
-    // var command = "python \"" + pythonScript + "\" \"" + clip.projectItem.getMediaPath() + "\" \"" + effectName + "\" '" + JSON.stringify(parameters) + "'";
+
+    // The chain goes through a file so the JSON survives the shell command line
+    var chainFile = new File(joinPath(Folder.temp.fsName, "segmentfx_chain.json"));
+    chainFile.open("w");
+    chainFile.write(JSON.stringify({ effects: chain }));
+    chainFile.close();
     
     try {
         // Execute the Python script
         $.evalFile(new File(joinPath(fullpath, "jsx", "execute_python.jsx")));
-        var result = executePython(pythonScript, [clip.projectItem.getMediaPath(), effectName, JSON.stringify(parameters)]);
+        var result = executePython(pythonScript, ['"' + clip.projectItem.getMediaPath() + '"', "--chain-file", '"' + chainFile.fsName + '"']
+                                   .concat(progressArgs(progressPath)));
 
         var parsedResult = JSON.parse(result);
         if (parsedResult.status === "error") {
@@ -275,10 +298,9 @@ function applyCustomEffect(clipIndex, trackIndex, effectName, parameters) {
 }
 
 // Function to apply multiple effects
-function applyMultipleEffects(clipIndex, trackIndex, effects) {
+function applyMultipleEffects(clipIndex, trackIndex, effects, progressPath) {
     var results = [];
-    
-    var clip = track.clips[clipIndex];
+    var customChain = [];
     
     for (var i = 0; i < effects.length; i++) {
         var effect = effects[i];
@@ -286,9 +308,14 @@ function applyMultipleEffects(clipIndex, trackIndex, effects) {
             var result = JSON.parse(applyEffectToClip(clipIndex, trackIndex, effects[i].name));
             results.push(result);
         } else if (effect.type === "custom") {
-            applyCustomEffect(clipIndex, trackIndex, effect.name.toLowerCase(), effect.parameters);
+            customChain.push({ name: effect.name.toLowerCase(), parameters: effect.parameters, objects: effect.objects });
         }
     }
     
+    // All custom effects are rendered together: one decode of the source and one output
+    if (customChain.length > 0) {
+        results.push(JSON.parse(applyCustomEffectChain(clipIndex, trackIndex, customChain, progressPath)));
+    }
+    
     return JSON.stringify({ success: true, message: "Multiple effects applied successfully" });
 }
\ No newline at end of file
@@ -1,86 +1,515 @@
+import argparse
 import cv2
+import multiprocessing
 import numpy as np
 import json
+import re
+import shutil
 import sys
 import os
+import time
 
-def apply_glitch_effect(frame, intensity=0.5):
-    # Split the frame into channels
-    b, g, r = cv2.split(frame)
-    
-    # Apply random shifts to each channel
+import metrics
+from frame_writer import WRITER_QUEUE_FRAMES, concat_videos, create_writer
+from label_map import select_objects
+from mask_store import MaskStoreReader
+from media_probe import probe_media
+
+MASK_STORE_FILENAME = "masks.sfxm"
+MASK_PNG_PATTERN = re.compile(r"mask_frame(\d+)_object(\d+)\.png$")
+
+# Effects register themselves by name. prepare() runs once per video with the frame size and the
+# effect parameters and precomputes whatever does not change between frames; apply() then renders
+# one frame into a preallocated output. Drop a module into effects/ to add an effect.
+EFFECTS = {}
+EFFECT_PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "effects")
+
+def register_effect(name, label=None, defaults=None):
+    def decorator(cls):
+        cls.name = name
+        cls.label = label or name.capitalize()
+        cls.defaults = defaults or {}
+        EFFECTS[name] = cls
+        return cls
+    return decorator
+
+class Effect:
+    # Unknown effect names fall back to this pass-through
+    name = None
+    label = None
+    defaults = {}
+
+    def prepare(self, width, height, parameters):
+        self.width = width
+        self.height = height
+        self.parameters = dict(self.defaults, **(parameters or {}))
+        return self
+
+    def input_region(self, x, y, w, h):
+        # Region of the input needed to render the output box (x, y, w, h), as (x0, y0, x1, y1)
+        return x, y, x + w, y + h
+
+    def render_region(self, frame, x, y, w, h):
+        # The box (x, y, w, h) of apply(frame), rendered from input_region() alone. Effects whose
+        # output depends on more than a local neighbourhood of the box override this
+        x0, y0, x1, y1 = self.input_region(x, y, w, h)
+        return self.apply(frame[y0:y1, x0:x1])[y - y0:y - y0 + h, x - x0:x - x0 + w]
+
+    def apply(self, frame, out=None):
+        if out is None:
+            return frame.copy()
+        np.copyto(out, frame)
+        return out
+
+@register_effect("glitch", defaults={"intensity": 0.5})
+class GlitchEffect(Effect):
+    # Blue shifted right and red shifted left (wrapping around), green untouched
+    def prepare(self, width, height, parameters):
+        super().prepare(width, height, parameters)
+        self.shift = int(self.parameters["intensity"] * width / 10)  # Adjust shift based on intensity
+        return self
+
+    def render_region(self, frame, x, y, w, h):
+        # Shifted columns wrap around the whole frame, not the box
+        rows = frame[y:y + h]
+        out = np.empty((h, w, 3), dtype=frame.dtype)
+        out[:, :, 0] = np.take(rows[:, :, 0], np.arange(x - self.shift, x + w - self.shift), axis=1, mode='wrap')
+        out[:, :, 1] = rows[:, x:x + w, 1]
+        out[:, :, 2] = np.take(rows[:, :, 2], np.arange(x + self.shift, x + w + self.shift), axis=1, mode='wrap')
+        return out
+
+    def apply(self, frame, out=None):
+        if out is None:
+            out = np.empty_like(frame)
+        cols = frame.shape[1]
+        shift = self.shift % cols
+        out[:, :, 1] = frame[:, :, 1]
+        out[:, shift:, 0] = frame[:, :cols - shift, 0]
+        out[:, :shift, 0] = frame[:, cols - shift:, 0]
+        out[:, :cols - shift, 2] = frame[:, shift:, 2]
+        out[:, cols - shift:, 2] = frame[:, :shift, 2]
+        return out
+
+@register_effect("pixelate", defaults={"block_size": 10})
+class PixelateEffect(Effect):
+    def prepare(self, width, height, parameters):
+        super().prepare(width, height, parameters)
+        self.block_size = self.parameters["block_size"]
+        self.small = np.empty((max(1, height // self.block_size), max(1, width // self.block_size), 3), dtype=np.uint8)
+        return self
+
+    def render_region(self, frame, x, y, w, h):
+        # Blocks follow the whole frame's grid, which only falls on multiples of block_size when
+        # the frame divides evenly. The downscale is of the whole frame (it reads about two rows
+        # per block row); the box then picks the cells the nearest-neighbour upscale would
+        height, width = frame.shape[:2]
+        small_size = (max(1, width // self.block_size), max(1, height // self.block_size))
+        small = self.small if self.small.shape[1::-1] == small_size else None
+        small = cv2.resize(frame, small_size, dst=small, interpolation=cv2.INTER_LINEAR)
+        rows = nearest_cells(y, h, height, small_size[1])
+        cols = nearest_cells(x, w, width, small_size[0])
+        return small[rows[:, None], cols]
+
+    def apply(self, frame, out=None):
+        h, w = frame.shape[:2]
+        small_size = (max(1, w // self.block_size), max(1, h // self.block_size))
+        small = self.small if self.small.shape[1::-1] == small_size else None
+        
+        # Resize down
+        small = cv2.resize(frame, small_size, dst=small, interpolation=cv2.INTER_LINEAR)
+        
+        # Resize up
+        return cv2.resize(small, (w, h), dst=out, interpolation=cv2.INTER_NEAREST)
+
+def nearest_cells(start, length, size, cells):
+    # Source cell of each output pixel in start..start + length when cv2.resize with INTER_NEAREST
+    # scales cells up to size, using the same floating-point steps
+    return np.minimum(np.floor(np.arange(start, start + length) * (1.0 / (size / cells))).astype(np.intp), cells - 1)
+
+def load_effect_plugins(directory=EFFECT_PLUGIN_DIR):
+    # Importing a plugin module runs its @register_effect decorators
+    if not os.path.isdir(directory):
+        return
+    import importlib.util
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".py") and not filename.startswith("_"):
+            spec = importlib.util.spec_from_file_location(f"segmentfx_effects.{filename[:-3]}", os.path.join(directory, filename))
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+
+def create_effect(effect_name, width, height, parameters):
+    return EFFECTS.get(effect_name, Effect)().prepare(width, height, parameters)
+
+def list_effects():
+    return [{"name": cls.label, "type": "custom", "parameters": cls.defaults} for cls in EFFECTS.values()]
+
+def apply_glitch_effect(frame, intensity=0.5, frame_width=None, out=None):
     rows, cols = frame.shape[:2]
-    shift = int(intensity * cols / 10)  # Adjust shift based on intensity
-    
-    b = np.roll(b, shift, axis=1)
-    r = np.roll(r, -shift, axis=1)
-    
-    # Merge the channels back
-    glitched_frame = cv2.merge([b, g, r])
-    
-    return glitched_frame
+    return GlitchEffect().prepare(frame_width or cols, rows, {"intensity": intensity}).apply(frame, out)
 
-def apply_pixelate_effect(frame, block_size=10):
+def apply_pixelate_effect(frame, block_size=10, out=None):
     h, w = frame.shape[:2]
-    
-    # Resize down
-    temp = cv2.resize(frame, (w // block_size, h // block_size), interpolation=cv2.INTER_LINEAR)
-    
-    # Resize up
-    return cv2.resize(temp, (w, h), interpolation=cv2.INTER_NEAREST)
+    return PixelateEffect().prepare(w, h, {"block_size": block_size}).apply(frame, out)
 
-def process_video(input_path, effect_name, parameters, output_dir):
-    cap = cv2.VideoCapture(input_path)
-    
-    # Get video properties
+class MaskSource:
+    # Per-frame masks from segmentation output: a mask container (.sfxm, or a directory holding
+    # one), the per-object PNG layout, or combined_masks.mp4. get() returns a uint8 mask (0/255)
+    # of the selected objects, or None when the frame has no mask. A frame is decoded once into a
+    # label map, so selecting any set of objects from it is a single table lookup per pixel.
+    def __init__(self, path, object_ids=None):
+        self.path = path
+        self.object_ids = set(object_ids) if object_ids is not None else None
+        self.reader = None
+        self.png_files = None
+        self.video = None
+        self.video_frame = -1
+        self.cached_frame = None  # (frame_num, label map, object id of each label) so chained effects decode a frame once
+
+        if os.path.isdir(path) and os.path.exists(os.path.join(path, MASK_STORE_FILENAME)):
+            path = os.path.join(path, MASK_STORE_FILENAME)
+        if os.path.isfile(path) and path.endswith(".sfxm"):
+            self.reader = MaskStoreReader(path)
+        elif os.path.isdir(path):
+            self.png_files = {}
+            for filename in os.listdir(path):
+                match = MASK_PNG_PATTERN.match(filename)
+                if match:
+                    frame_num, object_id = int(match.group(1)), int(match.group(2))
+                    self.png_files.setdefault(frame_num, []).append((object_id, os.path.join(path, filename)))
+            if not self.png_files:
+                video_path = os.path.join(path, "combined_masks.mp4")
+                if not os.path.exists(video_path):
+                    raise ValueError(f"No masks found in {path}")
+                self.png_files = None
+                self.video = cv2.VideoCapture(video_path)
+        else:
+            raise ValueError(f"Unsupported mask source: {path}")
+
+    def _label_frame(self, frame_num):
+        if self.cached_frame is None or self.cached_frame[0] != frame_num:
+            labels = None
+            label_object_ids = []
+            if self.reader is not None:
+                if frame_num in self.reader.offsets:
+                    labels, meta = self.reader.read_labels(frame_num)
+                    label_object_ids = [entry['object_id'] for entry in meta]
+            else:
+                for label, (object_id, filename) in enumerate(self.png_files.get(frame_num, []), 1):
+                    mask = cv2.imread(filename, cv2.IMREAD_GRAYSCALE) > 127
+                    if labels is None:
+                        labels = np.zeros(mask.shape, dtype=np.uint8 if len(self.png_files[frame_num]) < 256 else np.uint16)
+                    labels[mask] = label
+                    label_object_ids.append(object_id)
+            self.cached_frame = (frame_num, labels, label_object_ids)
+        return self.cached_frame[1:]
+
+    def get(self, frame_num, object_ids=None):
+        # object_ids overrides the source-wide selection for this call
+        if object_ids is None:
+            object_ids = self.object_ids
+        if self.reader is not None or self.png_files is not None:
+            labels, label_object_ids = self._label_frame(frame_num)
+            if labels is None:
+                return None
+            return select_objects(labels, label_object_ids, object_ids)
+        # combined_masks.mp4 has no object ids and is read sequentially
+        if frame_num < self.video_frame:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+            self.video_frame = frame_num - 1
+        mask = None
+        while self.video_frame < frame_num:
+            ret, mask = self.video.read()
+            if not ret:
+                return None
+            self.video_frame += 1
+        mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
+        return np.where(mask > 127, 255, 0).astype(np.uint8)
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        if self.video is not None:
+            self.video.release()
+
+def apply_effect(frame, effect_name, parameters, out=None):
+    h, w = frame.shape[:2]
+    return create_effect(effect_name, w, h, parameters).apply(frame, out)
+
+def apply_prepared_masked(frame, mask, effect):
+    # Compute the effect only over the mask's bounding box and composite it back through the
+    # mask, with the same result as np.where(mask, full-frame effect, frame). The frame is
+    # modified in place.
+    x, y, w, h = cv2.boundingRect(mask)
+    if w == 0 or h == 0 or type(effect) is Effect:
+        return frame
+    processed = effect.render_region(frame, x, y, w, h)
+    np.copyto(frame[y:y + h, x:x + w], processed, where=mask[y:y + h, x:x + w, None] > 0)
+    return frame
+
+def apply_effect_masked(frame, mask, effect_name, parameters):
+    h, w = frame.shape[:2]
+    return apply_prepared_masked(frame, mask, create_effect(effect_name, w, h, parameters))
+
+def parse_effect_chain(spec):
+    # Ordered list of effect nodes: [{"name": "glitch", "parameters": {...}, "objects": [0, 2]}, ...],
+    # optionally wrapped as {"effects": [...]}. "objects" limits a node to those mask object ids.
+    if isinstance(spec, str):
+        spec = json.loads(spec)
+    if isinstance(spec, dict):
+        spec = spec.get("effects", [])
+    chain = []
+    for node in spec:
+        chain.append({
+            "name": node["name"].lower(),
+            "parameters": node.get("parameters") or {},
+            "objects": node.get("objects")
+        })
+    return chain
+
+def prepare_chain(chain, width, height):
+    return [(create_effect(node["name"], width, height, node["parameters"]), node["objects"]) for node in chain]
+
+def apply_effect_chain(frame, effects, scratch, mask_source=None, frame_num=0):
+    # Runs every prepared effect on the frame in memory. Full-frame effects ping-pong between the
+    # frame and a scratch buffer; masked effects composite in place. The result always ends up in frame.
+    src = frame
+    for effect, object_ids in effects:
+        if mask_source is not None:
+            mask = mask_source.get(frame_num, object_ids)
+            if mask is not None:
+                apply_prepared_masked(src, mask, effect)
+            continue
+        dst = scratch if src is frame else frame
+        effect.apply(src, out=dst)
+        src = dst
+    if src is not frame:
+        np.copyto(frame, src)
+    return frame
+
+def keyframe_ranges(input_path, total_frames, fps, chunk_size=120):
+    # Splits the clip into [start, end) frame ranges of at least chunk_size frames, each starting on
+    # a keyframe so a worker's seek lands exactly on its first frame. Without ffprobe the ranges are
+    # fixed-size and the decoder seeks from the nearest earlier keyframe instead.
+    starts = None
+    try:
+        info = probe_media(input_path)
+        # Frame numbers count from the first video frame, not from the container start
+        keyframes = sorted({int(round((t - info["start_offset"]) * fps)) for t in info["keyframes"]})
+        if keyframes:
+            starts = [0]
+            for keyframe in keyframes:
+                if keyframe - starts[-1] >= chunk_size and keyframe < total_frames:
+                    starts.append(keyframe)
+    except (OSError, RuntimeError, ValueError):
+        pass
+    if starts is None:
+        starts = list(range(0, max(total_frames, 1), chunk_size))
+    # The last range runs to the end of the stream, whatever the container's frame count says
+    return list(zip(starts, starts[1:] + [None]))
+
+def render_frames(cap, chain, writer, mask_source=None, start=0, end=None, progress_every=10, progress_callback=None):
+    # Decode [start, end) from an open capture, apply the chain and hand every frame to writer.
+    # progress_callback(done, total) is called along with the progress print.
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if start > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    # Frames are decoded straight into a small ring of buffers. The ring is larger than the
+    # writer's queue, so a buffer is only reused after the writer has finished with it.
+    frame_buffers = [np.empty((height, width, 3), dtype=np.uint8) for _ in range(WRITER_QUEUE_FRAMES + 3)]
+    scratch = np.empty((height, width, 3), dtype=np.uint8)
+    effects = prepare_chain(chain, width, height)
     
-    # Create output directory if it doesn't exist
-    os.makedirs(output_dir, exist_ok=True)
-    
-    frame_count = 0
-    while True:
-        ret, frame = cap.read()
+    frame_count = start
+    while end is None or frame_count < end:
+        decode_start = time.perf_counter()
+        ret, frame = cap.read(frame_buffers[frame_count % len(frame_buffers)])
         if not ret:
             break
+        effect_start = time.perf_counter()
+        metrics.observe_stage("decode", effect_start - decode_start)
         
-        if effect_name == "glitch":
-            intensity = parameters.get("intensity", 0.5)
-            processed_frame = apply_glitch_effect(frame, intensity)
-        elif effect_name == "pixelate":
-            block_size = parameters.get("block_size", 10)
-            processed_frame = apply_pixelate_effect(frame, block_size)
-        else:
-            processed_frame = frame  # No effect applied
+        processed_frame = apply_effect_chain(frame, effects, scratch, mask_source, frame_count)
+        metrics.observe_stage("effect", time.perf_counter() - effect_start)
         
-        # Save the processed frame
-        output_path = os.path.join(output_dir, f"frame_{frame_count:06d}.png")
-        cv2.imwrite(output_path, processed_frame)
+        # Save the processed frame (the writer thread times the actual write or encode)
+        writer.write(processed_frame)
         
         frame_count += 1
         
         # Print progress
-        if frame_count % 10 == 0:
+        if progress_every and frame_count % progress_every == 0:
             print(f"Processed {frame_count}/{total_frames} frames")
+            if progress_callback is not None:
+                progress_callback(frame_count, total_frames)
+    return frame_count - start
+
+def _render_chunk(task):
+    # Process-pool entry point: renders one frame range with its own capture, mask reader and writer.
+    # The chunk's stage metrics go back with its result for the parent to merge.
+    input_path, chain, start, end, mask_spec, output_mode, output_base, output_options = task
+    metrics.REGISTRY.reset()  # Pool processes are reused (and forked ones inherit the parent's metrics)
+    cv2.setNumThreads(1)  # Parallelism comes from the pool
+    load_effect_plugins()  # Spawned workers start with only the built-in effects
+    cap = cv2.VideoCapture(input_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    mask_source = MaskSource(*mask_spec) if mask_spec is not None else None
+    # PNG chunks write straight into the final directory under their global frame numbers
+    writer = create_writer(output_mode, output_base, (width, height), fps, start_frame=start, **output_options)
+    try:
+        frames = render_frames(cap, chain, writer, mask_source, start, end, progress_every=0)
+    finally:
+        cap.release()
+        writer.close()
+        if mask_source is not None:
+            mask_source.close()
+    return writer.output_path, frames, metrics.REGISTRY.state()
+
+def process_effect_chain_parallel(input_path, chain, output_dir, mask_source=None, output_mode="png", output_options=None,
+                                  workers=None, chunk_size=120, progress_callback=None):
+    if workers is None:
+        workers = max(1, multiprocessing.cpu_count() - 2)  # Leave two CPUs free
+    output_options = dict(output_options or {})
+    cap = cv2.VideoCapture(input_path)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    ranges = keyframe_ranges(input_path, total_frames, fps, chunk_size)
+    mask_spec = (mask_source.path, mask_source.object_ids) if mask_source is not None else None
+    chunk_dir = None
+    if output_mode == "png":
+        chunk_bases = [output_dir] * len(ranges)
+    else:
+        chunk_dir = output_dir + "_chunks"
+        os.makedirs(chunk_dir, exist_ok=True)
+        chunk_bases = [os.path.join(chunk_dir, f"chunk_{i:05d}") for i in range(len(ranges))]
+    tasks = [(input_path, chain, start, end, mask_spec, output_mode, base, output_options)
+             for (start, end), base in zip(ranges, chunk_bases)]
+
+    chunk_paths = []
+    frame_count = 0
+    with multiprocessing.Pool(min(workers, len(tasks))) as pool:
+        for i, (chunk_path, frames, chunk_metrics) in enumerate(pool.imap(_render_chunk, tasks)):
+            chunk_paths.append(chunk_path)
+            frame_count += frames
+            metrics.REGISTRY.merge(chunk_metrics)
+            print(f"Rendered chunk {i + 1}/{len(tasks)} ({frame_count}/{total_frames} frames)")
+            if progress_callback is not None:
+                progress_callback(frame_count, total_frames)
+    metrics.counter("frames_total", "Frames rendered", task="effects").inc(frame_count)
+
+    if output_mode == "png":
+        return output_dir
+    # Stitch the encoded chunks in order, with the same name the serial writer would have used
+    output_path = output_dir + os.path.splitext(chunk_paths[0])[1]
+    with metrics.stage("encode", items=0):
+        concat_videos(chunk_paths, output_path)
+    shutil.rmtree(chunk_dir)
+    return output_path
+
+def process_effect_chain(input_path, chain, output_dir, mask_source=None, output_mode="png", output_options=None,
+                         workers=1, chunk_size=120, progress_callback=None):
+    if workers != 1:
+        return process_effect_chain_parallel(input_path, chain, output_dir, mask_source, output_mode, output_options,
+                                             workers, chunk_size, progress_callback)
+    cap = cv2.VideoCapture(input_path)
+    
+    # Get video properties
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    
+    # Frames are handed to a writer thread (PNG sequence or an encoder) as soon as they are done
+    writer = create_writer(output_mode, output_dir, (width, height), fps, **(output_options or {}))
+
+    frame_count = render_frames(cap, chain, writer, mask_source, progress_callback=progress_callback)
     
     cap.release()
+    writer.close()
+    metrics.counter("frames_total", "Frames rendered", task="effects").inc(frame_count)
     
-    return output_dir
+    return writer.output_path
+
+def process_video(input_path, effect_name, parameters, output_dir, mask_source=None, output_mode="png", output_options=None,
+                  workers=1, chunk_size=120, progress_callback=None):
+    chain = [{"name": effect_name, "parameters": parameters, "objects": None}]
+    return process_effect_chain(input_path, chain, output_dir, mask_source, output_mode, output_options, workers, chunk_size,
+                                progress_callback)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python custom_effects.py <input_video_path> <effect_name> <parameters_json>")
-        sys.exit(1)
+    load_effect_plugins()
+    if "--list-effects" in sys.argv:
+        print(json.dumps({"custom_effects": list_effects()}))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(usage="python custom_effects.py <input_video_path> (<effect_name> <parameters_json> | --chain-file <spec.json>) [--mask <mask_source>]\n"
+                                           "       python custom_effects.py --list-effects")
+    parser.add_argument("input_path")
+    parser.add_argument("effect_name", nargs="?")
+    parser.add_argument("parameters", nargs="?", default="{}")
+    parser.add_argument("--chain", default=None, help="JSON effect chain, applied in order in a single pass")
+    parser.add_argument("--chain-file", default=None, help="File containing the JSON effect chain")
+    parser.add_argument("--mask", default=None,
+                        help="Segmentation output directory, mask container (.sfxm) or PNG mask directory")
+    parser.add_argument("--objects", default=None, help="Comma-separated object ids to apply the effect to")
+    parser.add_argument("--output-mode", choices=["png", "ffmpeg", "cv2"], default="png",
+                        help="PNG sequence, ffmpeg encoder over stdin, or cv2.VideoWriter")
+    parser.add_argument("--codec", default="libx264", help="ffmpeg video codec (e.g. libx264, prores_ks, ffv1)")
+    parser.add_argument("--intra-only", action="store_true", help="Encode every frame as a keyframe")
+    parser.add_argument("--lossless", action="store_true")
+    parser.add_argument("--png-compression", type=int, default=3, choices=range(10), metavar="0-9")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Render keyframe-aligned chunks in this many processes (0 = all but two CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=120, help="Minimum frames per parallel chunk")
+    parser.add_argument("--progress-file", default=None,
+                        help="JSON file kept up to date with progress, throughput and ETA (for the panel)")
+    parser.add_argument("--metrics-dir", default=None,
+                        help=f"Write stage metrics here as JSON lines and a Prometheus textfile (default: ${metrics.METRICS_DIR_ENV})")
+    args = parser.parse_args()
     
-    input_path = sys.argv[1]
-    effect_name = sys.argv[2]
-    parameters = json.loads(sys.argv[3])
+    input_path = args.input_path
+    if args.chain_file is not None:
+        with open(args.chain_file) as f:
+            chain = parse_effect_chain(f.read())
+    elif args.chain is not None:
+        chain = parse_effect_chain(args.chain)
+    elif args.effect_name is not None:
+        chain = [{"name": args.effect_name, "parameters": json.loads(args.parameters), "objects": None}]
+    else:
+        parser.error("an effect name or an effect chain is required")
+
+    mask_source = None
+    if args.mask is not None:
+        object_ids = [int(i) for i in args.objects.split(",")] if args.objects else None
+        mask_source = MaskSource(args.mask, object_ids)
     
-    output_dir = os.path.join(os.path.dirname(input_path), f"{effect_name}_output")
+    output_dir = os.path.join(os.path.dirname(input_path), "_".join(node["name"] for node in chain) + "_output")
     
-    result = process_video(input_path, effect_name, parameters, output_dir)
+    output_options = {"png_compression": args.png_compression}
+    if args.output_mode == "ffmpeg":
+        output_options.update({"codec": args.codec, "intra_only": args.intra_only, "lossless": args.lossless})
+
+    progress = metrics.ProgressTracker("effects", path=args.progress_file) if args.progress_file else None
+    try:
+        result = process_effect_chain(input_path, chain, output_dir, mask_source, args.output_mode, output_options,
+                                      args.workers or None, args.chunk_size, progress)
+    except Exception as e:
+        if progress is not None:
+            progress.finish("error", error=str(e))
+        raise
+    finally:
+        if mask_source is not None:
+            mask_source.close()
+        metrics.export(args.metrics_dir, "effects", video_path=os.path.abspath(input_path))
+    if progress is not None:
+        progress.finish(output_path=os.path.abspath(result))
+    metrics.REGISTRY.report()
     
     print(json.dumps({"output_path": result}))
\ No newline at end of file
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import numpy as np
+import os
+import threading
+import time
+
+import metrics
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "segmentfx", "embeddings")
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+
+def video_identity(video_path):
+    # Path, size and mtime identify the file contents without hashing a multi-GB clip
+    stat = os.stat(video_path)
+    identity = f"{os.path.realpath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    # Image-encoder outputs stored as one .npy per frame and read back memory-mapped.
+    # index.json tracks entry sizes and last use; the least recently used entries are
+    # evicted once the store grows past max_bytes.
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = {}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path) as f:
+                    self.index = json.load(f)
+            except ValueError:
+                print("Embedding cache index is corrupt, starting empty")
+
+    @staticmethod
+    def make_key(video_id, frame_num, model_type):
+        return hashlib.sha1(f"{video_id}|{frame_num}|{model_type}".encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def get(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            path = self._entry_path(key)
+            if entry is None or not os.path.exists(path):
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry["last_used"] = time.time()
+            return np.load(path, mmap_mode="r"), entry["original_size"], entry["input_size"]
+
+    def put(self, key, features, original_size, input_size):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, np.ascontiguousarray(features))
+        with self.lock:
+            self.index[key] = {
+                "size": os.path.getsize(path),
+                "last_used": time.time(),
+                "original_size": list(original_size),
+                "input_size": list(input_size)
+            }
+            self._evict()
+
+    def _evict(self):
+        total = sum(entry["size"] for entry in self.index.values())
+        if total <= self.max_bytes:
+            return
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+            del self.index[key]
+            total -= entry["size"]
+            if total <= self.max_bytes:
+                break
+
+    def save(self):
+        with self.lock:
+            # The server and local jobs may save the same index at once, so each writes its own temp file
+            metrics.write_atomic(self.index_path, json.dumps(self.index))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.index),
+            "bytes": sum(entry["size"] for entry in self.index.values())
+        }
+
+
+def set_features(predictor, features, original_size, input_size):
+    # Loads a precomputed image embedding (cached or batch-encoded) so only the mask decoder runs
+    predictor.reset_image()
+    try:
+        import torch
+    except ImportError:
+        torch = None  # The numpy-only benchmark stub predicts from the array as it is
+    if torch is not None:
+        if not isinstance(features, torch.Tensor):
+            features = torch.from_numpy(np.array(features))
+        features = features.to(predictor.device)
+    predictor.features = features
+    predictor.original_size = tuple(original_size)
+    predictor.input_size = tuple(input_size)
+    predictor.is_image_set = True
+
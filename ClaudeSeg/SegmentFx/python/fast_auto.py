@@ -0,0 +1,158 @@
+import cv2
+import numpy as np
+import torch
+
+
+def point_grid(points_per_side, width, height):
+    # Cell centres of a points_per_side x points_per_side grid, in pixels
+    offsets = (np.arange(points_per_side) + 0.5) / points_per_side
+    xs, ys = np.meshgrid(offsets * width, offsets * height)
+    return np.stack([xs.ravel(), ys.ravel()], axis=1)
+
+
+def interior_point(mask):
+    # The pixel farthest from the mask border; unlike the centroid it is inside any shape
+    distance = cv2.distanceTransform(mask.astype(np.uint8), cv2.DIST_L2, 3)
+    y, x = np.unravel_index(np.argmax(distance), distance.shape)
+    return float(x), float(y)
+
+
+class SeededMaskGenerator:
+    """
+        Automatic masks for video frames, at a cost that grows with max_masks instead of with a
+        dense point grid. The first frame (and every reseed_interval frames, after a scene change
+        or when an object is lost) is prompted from a coarse points_per_side grid. Every other
+        frame is prompted only with a box and an interior point per mask kept on the previous
+        frame. Candidates are capped at candidate_factor * max_masks by predicted IoU before any
+        mask is upscaled, so stability scoring and box NMS only run on those.
+
+        Has the generate() interface of SamAutomaticMaskGenerator and returns at most max_masks
+        masks, largest first. It holds state between calls, so feed it the frames of one clip in
+        order and call reset() before the next clip.
+    """
+    def __init__(self, predictor, max_masks, points_per_side=8, pred_iou_thresh=0.86, stability_score_thresh=0.92,
+                 stability_score_offset=1.0, box_nms_thresh=0.7, candidate_factor=3, reseed_interval=30,
+                 box_margin=0.15, min_mask_area=16):
+        self.predictor = predictor
+        self.model = predictor.model
+        self.max_masks = max_masks
+        self.points_per_side = points_per_side
+        self.pred_iou_thresh = pred_iou_thresh
+        self.stability_score_thresh = stability_score_thresh
+        self.stability_score_offset = stability_score_offset
+        self.box_nms_thresh = box_nms_thresh
+        self.candidate_factor = candidate_factor
+        self.reseed_interval = reseed_interval
+        self.box_margin = box_margin
+        self.min_mask_area = min_mask_area
+        self.grid_frames = 0
+        self.seeded_frames = 0
+        self.reset()
+
+    def reset(self):
+        self.previous = []
+        self.frames_since_grid = 0
+        self.needs_grid = True
+
+    def reseed(self):
+        # Prompt the next frame from the grid again, e.g. after a scene change
+        self.needs_grid = True
+
+    def _decode(self, points=None, labels=None, boxes=None, multimask_output=False):
+        # Low-resolution mask logits and predicted IoUs for a batch of prompts given in image pixels
+        original_size = self.predictor.original_size
+        transform = self.predictor.transform
+        point_input = None
+        if points is not None:
+            coords = transform.apply_coords_torch(torch.as_tensor(points, dtype=torch.float, device=self.predictor.device), original_size)
+            point_input = (coords, torch.as_tensor(labels, dtype=torch.int, device=self.predictor.device))
+        box_input = None
+        if boxes is not None:
+            box_input = transform.apply_boxes_torch(torch.as_tensor(boxes, dtype=torch.float, device=self.predictor.device), original_size)
+        sparse, dense = self.model.prompt_encoder(points=point_input, boxes=box_input, masks=None)
+        return self.model.mask_decoder(
+            image_embeddings=self.predictor.features,
+            image_pe=self.model.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse,
+            dense_prompt_embeddings=dense,
+            multimask_output=multimask_output,
+        )
+
+    def _grid_candidates(self, width, height):
+        points = point_grid(self.points_per_side, width, height)
+        low_res, iou_predictions = self._decode(points[:, None, :], np.ones((len(points), 1)), multimask_output=True)
+        # Best of the three multimask outputs per point, then drop the weak ones
+        best = iou_predictions.argmax(dim=1)
+        rows = torch.arange(len(points))
+        low_res = low_res[rows, best][:, None]
+        iou_predictions = iou_predictions[rows, best]
+        keep = iou_predictions > self.pred_iou_thresh
+        return low_res[keep], iou_predictions[keep], points[keep.cpu().numpy()]
+
+    def _seeded_candidates(self, width, height):
+        boxes = []
+        points = []
+        for mask_data in self.previous:
+            x, y, w, h = mask_data['bbox']
+            margin_x = max(w * self.box_margin, 4)
+            margin_y = max(h * self.box_margin, 4)
+            boxes.append([max(0, x - margin_x), max(0, y - margin_y), min(width, x + w + margin_x), min(height, y + h + margin_y)])
+            points.append([mask_data['point_coords'][0]])
+        low_res, iou_predictions = self._decode(np.array(points), np.ones((len(points), 1)), np.array(boxes))
+        return low_res, iou_predictions[:, 0], np.array(points)[:, 0]
+
+    @torch.no_grad()
+    def generate(self, image):
+        from mobile_sam.utils.amg import batched_mask_to_box, calculate_stability_score
+        from torchvision.ops.boxes import batched_nms
+
+        height, width = image.shape[:2]
+        self.predictor.set_image(image)
+        use_grid = self.needs_grid or not self.previous or self.frames_since_grid >= self.reseed_interval
+        if use_grid:
+            low_res, iou_predictions, points = self._grid_candidates(width, height)
+            self.frames_since_grid = 0
+            self.grid_frames += 1
+        else:
+            low_res, iou_predictions, points = self._seeded_candidates(width, height)
+            self.frames_since_grid += 1
+            self.seeded_frames += 1
+
+        # Cap the candidates before anything runs at full resolution
+        order = torch.argsort(iou_predictions, descending=True)[:self.max_masks * self.candidate_factor]
+        low_res, iou_predictions, points = low_res[order], iou_predictions[order], points[order.cpu().numpy()]
+        if len(order) == 0:
+            self.previous = []
+            self.needs_grid = True
+            return []
+
+        logits = self.model.postprocess_masks(low_res, self.predictor.input_size, self.predictor.original_size)[:, 0]
+        stability = calculate_stability_score(logits, self.model.mask_threshold, self.stability_score_offset)
+        masks = logits > self.model.mask_threshold
+        areas = masks.flatten(1).sum(dim=1)
+        keep = (stability >= self.stability_score_thresh) & (areas >= self.min_mask_area)
+        masks, iou_predictions, stability, areas, points = (
+            masks[keep], iou_predictions[keep], stability[keep], areas[keep], points[keep.cpu().numpy()])
+
+        boxes = batched_mask_to_box(masks)
+        keep = batched_nms(boxes.float(), iou_predictions, torch.zeros_like(iou_predictions), self.box_nms_thresh)
+        keep = keep[torch.argsort(areas[keep], descending=True)][:self.max_masks]
+
+        results = []
+        for i in keep.tolist():
+            segmentation = masks[i].cpu().numpy()
+            x1, y1, x2, y2 = boxes[i].tolist()
+            results.append({
+                'segmentation': segmentation,
+                'area': int(areas[i]),
+                'bbox': [x1, y1, x2 - x1, y2 - y1],
+                'predicted_iou': float(iou_predictions[i]),
+                'stability_score': float(stability[i]),
+                # Re-centred on the mask so the next frame's prompt starts inside the object
+                'point_coords': [list(interior_point(segmentation))],
+                'crop_box': [0, 0, width, height],
+            })
+        # A seeded object that did not survive needs the grid to be found again
+        self.needs_grid = not use_grid and len(results) < len(self.previous)
+        self.previous = results
+        return results
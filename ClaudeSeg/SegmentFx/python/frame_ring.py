@@ -0,0 +1,65 @@
+import numpy as np
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+
+class SharedFrameRing:
+    # Fixed pool of frame slots (RGB in) and label-map slots (object ID per pixel out)
+    # in shared memory. Only slot indices and small metadata need to cross the queues.
+    def __init__(self, slot_count, frame_size, label_dtype=np.uint8, names=None):
+        width, height = frame_size
+        self.slot_count = slot_count
+        self.frame_size = frame_size
+        self.label_dtype = np.dtype(label_dtype)
+        self.frame_shape = (slot_count, height, width, 3)
+        self.label_shape = (slot_count, height, width)
+        frame_bytes = int(np.prod(self.frame_shape))
+        label_bytes = int(np.prod(self.label_shape)) * self.label_dtype.itemsize
+
+        self.owner = names is None
+        if self.owner:
+            self.frame_shm = shared_memory.SharedMemory(create=True, size=frame_bytes)
+            self.label_shm = shared_memory.SharedMemory(create=True, size=label_bytes)
+        else:
+            self.frame_shm = self._attach(names[0])
+            self.label_shm = self._attach(names[1])
+
+        self.frames = np.ndarray(self.frame_shape, dtype=np.uint8, buffer=self.frame_shm.buf)
+        self.labels = np.ndarray(self.label_shape, dtype=self.label_dtype, buffer=self.label_shm.buf)
+
+    @staticmethod
+    def _attach(name):
+        # Only the owner unlinks. Before 3.13 attaching also registers the segment with the resource
+        # tracker, which then warns about (or, in a spawned worker, unlinks) memory it does not own.
+        # A forked worker shares the owner's tracker, so unregistering afterwards is no option either.
+        if sys.version_info >= (3, 13):
+            return shared_memory.SharedMemory(name=name, track=False)
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+    def info(self):
+        # Picklable description used by worker processes to attach to the same buffers
+        return (self.slot_count, self.frame_size, self.label_dtype.str, (self.frame_shm.name, self.label_shm.name))
+
+    @classmethod
+    def attach(cls, info):
+        slot_count, frame_size, label_dtype, names = info
+        return cls(slot_count, frame_size, np.dtype(label_dtype), names)
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes + self.labels.nbytes
+
+    def close(self):
+        # Drop the array views before closing, otherwise the buffers are still exported
+        del self.frames
+        del self.labels
+        self.frame_shm.close()
+        self.label_shm.close()
+        if self.owner:
+            self.frame_shm.unlink()
+            self.label_shm.unlink()
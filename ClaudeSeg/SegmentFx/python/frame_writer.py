@@ -0,0 +1,153 @@
+import cv2
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import metrics
+
+WRITER_QUEUE_FRAMES = 8
+
+OUTPUT_EXTENSIONS = {
+    "libx264": ".mp4",
+    "libx265": ".mp4",
+    "prores_ks": ".mov",
+    "dnxhd": ".mov",
+    "ffv1": ".mkv",
+}
+
+
+class PngSequenceWriter:
+    # One PNG per frame. Compression 0 is fastest, 9 smallest (OpenCV's default is 3).
+    stage = "write"
+
+    def __init__(self, output_dir, compression=3, start_frame=0):
+        self.output_path = output_dir
+        self.params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        self.frame_num = start_frame
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, frame):
+        cv2.imwrite(os.path.join(self.output_path, f"frame_{self.frame_num:06d}.png"), frame, self.params)
+        self.frame_num += 1
+
+    def close(self):
+        pass
+
+
+class FfmpegWriter:
+    # Streams raw BGR frames to an ffmpeg subprocess over stdin
+    stage = "encode"
+
+    def __init__(self, output_path, frame_size, fps, codec="libx264", intra_only=False, lossless=False, crf=18):
+        width, height = frame_size
+        self.output_path = output_path
+        command = [
+            "ffmpeg", "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+            "-c:v", codec
+        ]
+        if intra_only:
+            command += ["-g", "1"]
+        if codec in ("libx264", "libx265"):
+            if lossless:
+                command += ["-qp", "0", "-pix_fmt", "yuv444p"]
+            else:
+                command += ["-crf", str(crf), "-pix_fmt", "yuv420p"]
+        elif codec == "prores_ks":
+            command += ["-profile:v", "4444" if lossless else "3"]
+        elif codec == "ffv1":
+            command += ["-level", "3"]
+        command.append(output_path)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with code {self.process.returncode} while writing {self.output_path}")
+
+
+class Cv2VideoWriter:
+    stage = "encode"
+
+    def __init__(self, output_path, frame_size, fps, fourcc="mp4v"):
+        self.output_path = output_path
+        self.writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps, frame_size)
+        if not self.writer.isOpened():
+            raise RuntimeError(f"Could not open {output_path} for writing with fourcc {fourcc}")
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def close(self):
+        self.writer.release()
+
+
+class ThreadedWriter:
+    # Runs a writer on its own thread behind a bounded queue so effect computation never
+    # waits on compression or disk. Frames must not be modified after they are written.
+    def __init__(self, writer, max_queued_frames=WRITER_QUEUE_FRAMES):
+        self.writer = writer
+        self.output_path = writer.output_path
+        self.queue = queue.Queue(maxsize=max_queued_frames)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue  # Drain so the producer never blocks on a dead writer
+            try:
+                write_start = time.perf_counter()
+                self.writer.write(frame)
+                metrics.observe_stage(self.writer.stage, time.perf_counter() - write_start)
+            except Exception as e:
+                self.error = e
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+
+def create_writer(output_mode, output_base, frame_size, fps, codec="libx264", intra_only=False, lossless=False,
+                  png_compression=3, fourcc="mp4v", threaded=True, start_frame=0):
+    # output_base is a path without extension: the PNG directory, or the video file stem
+    if output_mode == "png":
+        writer = PngSequenceWriter(output_base, png_compression, start_frame)
+    elif output_mode == "ffmpeg":
+        writer = FfmpegWriter(output_base + OUTPUT_EXTENSIONS.get(codec, ".mov"), frame_size, fps, codec, intra_only, lossless)
+    elif output_mode == "cv2":
+        writer = Cv2VideoWriter(output_base + ".mp4", frame_size, fps, fourcc)
+    else:
+        raise ValueError(f"Unknown output mode: {output_mode}")
+    return ThreadedWriter(writer) if threaded else writer
+
+
+def concat_videos(paths, output_path):
+    # Joins same-format video files in order without re-encoding (ffmpeg concat demuxer)
+    list_path = output_path + ".concat.txt"
+    with open(list_path, "w") as f:
+        for path in paths:
+            f.write("file '{}'\n".format(os.path.abspath(path).replace("'", "'\\''")))
+    try:
+        subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path,
+                        "-c", "copy", output_path], check=True)
+    finally:
+        os.remove(list_path)
+    return output_path
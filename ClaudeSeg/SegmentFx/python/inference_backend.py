@@ -0,0 +1,319 @@
+import argparse
+import cv2
+import json
+import numpy as np
+import os
+import time
+import torch
+
+from propagation import mask_iou
+
+BACKENDS = ("eager", "torchscript", "onnx")
+DEFAULT_EXPORT_DIR = os.path.join("models", "exported")
+ONNX_OPSET = 17
+
+
+def model_tag(model_type, backend="eager", quantize=False):
+    # Identifies the embeddings a model produces, for the embedding cache. The eager float model
+    # keeps the plain model type so existing cache entries stay valid.
+    if backend == "eager" and not quantize:
+        return model_type
+    return f"{model_type}-{backend}" + ("-int8" if quantize else "")
+
+
+def quantize_dynamic(module):
+    # int8 weights for the Linear layers (attention and MLP in TinyViT and the two-way transformer);
+    # activations are quantized on the fly, so no calibration data is needed
+    return torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class DecoderCore(torch.nn.Module):
+    # The tensor-only part of MaskDecoder: every mask output for a batch of prompts. The
+    # multimask selection is a Python bool, so it stays outside the exported graph.
+    def __init__(self, mask_decoder):
+        super().__init__()
+        self.mask_decoder = mask_decoder
+
+    def forward(self, image_embeddings, image_pe, sparse_prompt_embeddings, dense_prompt_embeddings):
+        return self.mask_decoder.predict_masks(
+            image_embeddings=image_embeddings,
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse_prompt_embeddings,
+            dense_prompt_embeddings=dense_prompt_embeddings,
+        )
+
+
+class ExportedImageEncoder(torch.nn.Module):
+    # Drop-in for the image encoder. Sam and SamPredictor read img_size from it.
+    def __init__(self, graph, img_size):
+        super().__init__()
+        self.graph = graph
+        self.img_size = img_size
+
+    def forward(self, x):
+        return self.graph(x)
+
+
+class ExportedMaskDecoder(torch.nn.Module):
+    # Drop-in for MaskDecoder, called by SamPredictor.predict_torch with the same keywords
+    def __init__(self, graph):
+        super().__init__()
+        self.graph = graph
+
+    def forward(self, image_embeddings, image_pe, sparse_prompt_embeddings, dense_prompt_embeddings, multimask_output):
+        masks, iou_pred = self.graph(image_embeddings, image_pe, sparse_prompt_embeddings, dense_prompt_embeddings)
+        mask_slice = slice(1, None) if multimask_output else slice(0, 1)
+        return masks[:, mask_slice, :, :], iou_pred[:, mask_slice]
+
+
+class OnnxGraph(torch.nn.Module):
+    # Runs an ONNX model on ONNX Runtime's CPU provider with torch tensors in and out. The session
+    # is created on first use in each process: ONNX Runtime's thread pool does not survive a
+    # fork, and a pool worker's session should only use that worker's share of the cores.
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.session = None
+        self.session_pid = None
+
+    def _session(self):
+        if self.session is None or self.session_pid != os.getpid():
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = torch.get_num_threads()
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = onnxruntime.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+            self.session_pid = os.getpid()
+        return self.session
+
+    def forward(self, *inputs):
+        session = self._session()
+        feeds = {arg.name: tensor.detach().cpu().numpy() for arg, tensor in zip(session.get_inputs(), inputs)}
+        outputs = [torch.from_numpy(output) for output in session.run(None, feeds)]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["session"] = None  # Sessions do not pickle; spawned workers open their own
+        return state
+
+
+def _example_inputs(sam):
+    # Two frames and two prompts, so neither batch dimension gets traced as a constant 1
+    image_size = sam.image_encoder.img_size
+    images = torch.randn(2, 3, image_size, image_size)
+    with torch.no_grad():
+        embeddings = sam.image_encoder(images[:1])
+        points = torch.rand(2, 1, 2) * image_size
+        sparse, dense = sam.prompt_encoder(points=(points, torch.ones(2, 1, dtype=torch.int)), boxes=None, masks=None)
+        image_pe = sam.prompt_encoder.get_dense_pe()
+    return (images,), (embeddings, image_pe, sparse, dense)
+
+
+def _is_stale(path, checkpoint):
+    return not os.path.exists(path) or (checkpoint is not None and os.path.exists(checkpoint)
+                                        and os.path.getmtime(path) < os.path.getmtime(checkpoint))
+
+
+def _torchscript_graphs(sam, quantize, export_dir, prefix, checkpoint):
+    paths = [os.path.join(export_dir, f"{prefix}_{part}{'_int8' if quantize else ''}.pt") for part in ("encoder", "decoder")]
+    if any(_is_stale(path, checkpoint) for path in paths):
+        encoder_inputs, decoder_inputs = _example_inputs(sam)
+        modules = [sam.image_encoder, DecoderCore(sam.mask_decoder)]
+        if quantize:
+            modules = [quantize_dynamic(module) for module in modules]
+        for module, example, path in zip(modules, (encoder_inputs, decoder_inputs), paths):
+            with torch.no_grad():
+                traced = torch.jit.trace(module.eval(), example, check_trace=False)
+            torch.jit.save(torch.jit.freeze(traced), path)
+            print(f"Exported {path}")
+    return [torch.jit.load(path).eval() for path in paths]
+
+
+def _onnx_graphs(sam, quantize, export_dir, prefix, checkpoint):
+    paths = [os.path.join(export_dir, f"{prefix}_{part}.onnx") for part in ("encoder", "decoder")]
+    if any(_is_stale(path, checkpoint) for path in paths):
+        encoder_inputs, decoder_inputs = _example_inputs(sam)
+        with torch.no_grad():
+            torch.onnx.export(sam.image_encoder, encoder_inputs, paths[0], opset_version=ONNX_OPSET,
+                              input_names=["images"], output_names=["image_embeddings"],
+                              dynamic_axes={"images": {0: "frames"}, "image_embeddings": {0: "frames"}})
+            torch.onnx.export(DecoderCore(sam.mask_decoder), decoder_inputs, paths[1], opset_version=ONNX_OPSET,
+                              input_names=["image_embeddings", "image_pe", "sparse_prompt_embeddings", "dense_prompt_embeddings"],
+                              output_names=["masks", "iou_predictions"],
+                              dynamic_axes={"sparse_prompt_embeddings": {0: "prompts", 1: "tokens"},
+                                            "dense_prompt_embeddings": {0: "prompts"},
+                                            "masks": {0: "prompts"}, "iou_predictions": {0: "prompts"}})
+        for path in paths:
+            print(f"Exported {path}")
+    if quantize:
+        from onnxruntime.quantization import QuantType
+        from onnxruntime.quantization import quantize_dynamic as quantize_onnx
+        float_paths = paths
+        paths = [path.replace(".onnx", "_int8.onnx") for path in float_paths]
+        for float_path, path in zip(float_paths, paths):
+            if _is_stale(path, float_path):
+                # MatMul/Gemm only, matching the Linear-only quantization of the torch backends
+                quantize_onnx(float_path, path, op_types_to_quantize=["MatMul", "Gemm"], weight_type=QuantType.QInt8)
+                print(f"Quantized {path}")
+    return [OnnxGraph(path) for path in paths]
+
+
+def apply_backend(sam, backend="eager", quantize=False, model_type="vit_t", checkpoint=None, export_dir=DEFAULT_EXPORT_DIR):
+    """
+        Swaps the image encoder and mask decoder of a Sam model for the chosen backend. The prompt
+        encoder and all pre- and post-processing stay eager, so SamPredictor and
+        SamAutomaticMaskGenerator work unchanged. Exported graphs are written to export_dir once
+        and reused until the checkpoint changes.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend: {backend} (expected one of {', '.join(BACKENDS)})")
+    sam.eval()
+    if backend == "eager":
+        if quantize:
+            sam.image_encoder = quantize_dynamic(sam.image_encoder)
+            sam.mask_decoder = quantize_dynamic(sam.mask_decoder)
+    else:
+        os.makedirs(export_dir, exist_ok=True)
+        build = _torchscript_graphs if backend == "torchscript" else _onnx_graphs
+        encoder, decoder = build(sam, quantize, export_dir, f"mobile_sam_{model_type}", checkpoint)
+        sam.image_encoder = ExportedImageEncoder(encoder, sam.image_encoder.img_size)
+        sam.mask_decoder = ExportedMaskDecoder(decoder)
+    sam.model_tag = model_tag(model_type, backend, quantize)
+    return sam
+
+
+@torch.no_grad()
+def encode_batch(predictor, images):
+    # One image-encoder call for several same-sized RGB frames. Returns the embeddings and the
+    # (original_size, input_size) that set_features needs to load one of them into predictor.
+    model = predictor.model
+    inputs = []
+    for image in images:
+        input_image = predictor.transform.apply_image(image)
+        input_tensor = torch.as_tensor(input_image, device=predictor.device).permute(2, 0, 1).contiguous()
+        inputs.append(model.preprocess(input_tensor[None]))
+    features = model.image_encoder(torch.cat(inputs))
+    return features, tuple(images[0].shape[:2]), tuple(input_image.shape[:2])
+
+
+def point_masks(predictor, frame, points):
+    # One single-mask prediction per point prompt, used by the accuracy check
+    predictor.set_image(frame)
+    masks = []
+    for point in points:
+        frame_masks, _, _ = predictor.predict(point_coords=np.array([point]), point_labels=np.array([1]),
+                                              multimask_output=False)
+        masks.append(frame_masks[0])
+    return masks
+
+
+def sample_frames(video_path, count):
+    # Evenly spaced RGB frames across the clip
+    video = cv2.VideoCapture(video_path)
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for index in np.linspace(0, max(frame_count - 1, 0), count).astype(int):
+        video.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+        ret, frame = video.read()
+        if ret:
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    video.release()
+    if not frames:
+        raise ValueError(f"Could not read frames from {video_path}")
+    return frames
+
+
+def prompt_grid(frame, points_per_side=3):
+    h, w = frame.shape[:2]
+    return [((x + 0.5) * w / points_per_side, (y + 0.5) * h / points_per_side)
+            for y in range(points_per_side) for x in range(points_per_side)]
+
+
+def time_predictor(predictor, frames, points, batch_size):
+    # Seconds per frame for the encoder (one frame at a time and batched) and per prompt for the decoder
+    start = time.perf_counter()
+    for frame in frames:
+        predictor.set_image(frame)
+    encode_seconds = (time.perf_counter() - start) / len(frames)
+
+    start = time.perf_counter()
+    for batch_start in range(0, len(frames), batch_size):
+        encode_batch(predictor, frames[batch_start:batch_start + batch_size])
+    batched_seconds = (time.perf_counter() - start) / len(frames)
+
+    start = time.perf_counter()
+    for point in points:
+        predictor.predict(point_coords=np.array([point]), point_labels=np.array([1]), multimask_output=False)
+    decode_seconds = (time.perf_counter() - start) / len(points)
+    return encode_seconds, batched_seconds, decode_seconds
+
+
+def compare_backends(video_path, configurations, frame_count=8, batch_size=4, threads=None):
+    """
+        Accuracy and throughput of each (backend, quantize) configuration against the eager float
+        model on frames sampled from video_path. Accuracy is the IoU between the eager model's
+        mask and the backend's mask for a 3x3 grid of point prompts on every frame.
+    """
+    from mobile_sam import SamPredictor
+    from segmentation import build_sam
+
+    if threads is not None:
+        torch.set_num_threads(threads)
+    frames = sample_frames(video_path, frame_count)
+    points = prompt_grid(frames[0])
+    reference = SamPredictor(build_sam())
+    reference_masks = [point_masks(reference, frame, points) for frame in frames]
+
+    results = []
+    for backend, quantize in [("eager", False)] + [c for c in configurations if c != ("eager", False)]:
+        start = time.perf_counter()
+        predictor = reference if (backend, quantize) == ("eager", False) else SamPredictor(build_sam(backend, quantize))
+        load_seconds = time.perf_counter() - start
+        ious = [mask_iou(a, b) for frame, masks in zip(frames, reference_masks)
+                for a, b in zip(masks, point_masks(predictor, frame, points))]
+        encode_seconds, batched_seconds, decode_seconds = time_predictor(predictor, frames, points, batch_size)
+        results.append({
+            "backend": backend,
+            "quantize": quantize,
+            "load_seconds": load_seconds,
+            "mean_iou": float(np.mean(ious)),
+            "min_iou": float(np.min(ious)),
+            "encoder_fps": 1 / encode_seconds,
+            "batched_encoder_fps": 1 / batched_seconds,
+            "decoder_ms_per_prompt": decode_seconds * 1000,
+        })
+        del predictor
+    baseline = results[0]["encoder_fps"]
+    for result in results:
+        result["encoder_speedup"] = result["encoder_fps"] / baseline
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare MobileSAM inference backends against the eager model")
+    parser.add_argument("video_path", help="Clip to sample test frames from")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--quantize", choices=["off", "on", "both"], default="both",
+                        help="Test each backend with float weights, int8 weights or both")
+    parser.add_argument("--frames", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=4, help="Frames per batched image-encoder call")
+    parser.add_argument("--threads", type=int, default=None, help="Torch / ONNX Runtime threads")
+    parser.add_argument("--min-iou", type=float, default=0.9, help="Exit with an error below this mean mask IoU")
+    parser.add_argument("--json", default=None, help="Also write the results to this file")
+    args = parser.parse_args()
+
+    quantize_options = {"off": [False], "on": [True], "both": [False, True]}[args.quantize]
+    configurations = [(backend, quantize) for backend in args.backends for quantize in quantize_options]
+    results = compare_backends(args.video_path, configurations, args.frames, args.batch_size, args.threads)
+
+    print(f"{'backend':<18}{'mean IoU':>10}{'min IoU':>10}{'enc fps':>10}{'batched':>10}{'dec ms':>10}{'speedup':>10}")
+    for result in results:
+        name = result["backend"] + ("+int8" if result["quantize"] else "")
+        print(f"{name:<18}{result['mean_iou']:>10.4f}{result['min_iou']:>10.4f}{result['encoder_fps']:>10.2f}"
+              f"{result['batched_encoder_fps']:>10.2f}{result['decoder_ms_per_prompt']:>10.2f}{result['encoder_speedup']:>9.2f}x")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(result["mean_iou"] < args.min_iou for result in results):
+        raise SystemExit(f"Mean mask IoU below {args.min_iou} for at least one backend")
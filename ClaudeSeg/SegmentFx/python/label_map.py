@@ -0,0 +1,70 @@
+import cv2
+import numpy as np
+
+# A frame's masks travel as one label map: 0 is background and object i of the frame's object
+# list is label i + 1, so a frame costs one uint8 (uint16 past 255 objects) image however many
+# objects it has. Where masks overlap, the overlap policy decides which object keeps the pixel:
+#   smaller-on-top  smaller objects stay visible over the larger ones they sit on
+#   larger-on-top   the larger object keeps the shared pixels
+#   score           the object with the higher stability score keeps them
+OVERLAP_POLICIES = ("smaller-on-top", "larger-on-top", "score")
+
+
+def label_dtype(object_count):
+    return np.uint8 if object_count < 256 else np.uint16
+
+
+def paint_order(masks, overlap="smaller-on-top"):
+    # Indices into masks in painting order; the last one painted wins a shared pixel
+    if overlap == "smaller-on-top":
+        key = lambda i: -masks[i]['area']
+    elif overlap == "larger-on-top":
+        key = lambda i: masks[i]['area']
+    elif overlap == "score":
+        key = lambda i: masks[i].get('stability_score', 0)
+    else:
+        raise ValueError(f"Unknown overlap policy: {overlap}")
+    return sorted(range(len(masks)), key=key)
+
+
+def paint_labels(masks, shape, dtype=None, overlap="smaller-on-top", out=None):
+    # Label map of the masks' 'segmentation' arrays, all of the given (height, width) shape
+    if out is None:
+        out = np.zeros(shape, dtype=dtype or label_dtype(len(masks)))
+    else:
+        out[...] = 0
+    for i in paint_order(masks, overlap):
+        out[masks[i]['segmentation']] = i + 1
+    return out
+
+
+def upscale_labels(labels, size, out=None):
+    # Nearest neighbour, so labels are never blended into other labels
+    return cv2.resize(labels, size, dst=out, interpolation=cv2.INTER_NEAREST)
+
+
+def combined_mask(labels):
+    # 255 wherever any object is
+    return np.where(labels > 0, 255, 0).astype(np.uint8)
+
+
+def object_mask(labels, label):
+    return np.where(labels == label, 255, 0).astype(np.uint8)
+
+
+def object_selector(object_ids, selected):
+    # Lookup table from label to 255 (a selected object) or 0; object_ids[i] is the id of label i + 1
+    lut = np.zeros(len(object_ids) + 1, dtype=np.uint8)
+    lut[1:][np.isin(np.asarray(object_ids, dtype=np.int64), list(selected))] = 255
+    return lut
+
+
+def select_objects(labels, object_ids, selected=None):
+    # uint8 mask (0/255) of the selected object ids (all objects if selected is None), or None
+    # when none of them is in the frame
+    if selected is None:
+        return combined_mask(labels) if len(object_ids) else None
+    lut = object_selector(object_ids, selected)
+    if not lut.any():
+        return None
+    return lut[labels]
@@ -0,0 +1,235 @@
+import cv2
+import json
+import numpy as np
+import os
+import struct
+import sys
+
+# Layout of a .sfxm mask container:
+#   header   MAGIC, width, height, fps
+#   chunks   one per frame: frame_num, object_count, meta_len, data_len, compact JSON metadata,
+#            then the run-length counts (uint32) of every object's mask back to back
+#   index    (frame_num, chunk offset) for every frame, followed by the footer
+#   footer   index offset, frame count, INDEX_MAGIC
+# Readers seek straight to a frame through the index. If the footer is missing (the writer
+# is still running or was interrupted) the chunks are scanned in order instead.
+MAGIC = b"SFXMASK1"
+INDEX_MAGIC = b"SFXINDEX"
+HEADER = struct.Struct("<8sIIf")
+CHUNK = struct.Struct("<IIII")
+INDEX_ENTRY = struct.Struct("<IQ")
+FOOTER = struct.Struct("<QI8s")
+
+
+def encode_rle(mask):
+    # Row-major run lengths, alternating background/foreground and starting with background
+    flat = np.asarray(mask, dtype=bool).ravel()
+    boundaries = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.uint32)
+
+
+def encode_label_rle(labels, count):
+    # encode_rle(labels == label) for labels 1..count, from a single pass over the label map
+    flat = np.asarray(labels).ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], changes))
+    ends = np.concatenate((changes, [flat.size]))
+    values = flat[starts]
+    rle = []
+    for label in range(1, count + 1):
+        selected = values == label
+        run_starts, run_ends = starts[selected], ends[selected]
+        counts = np.empty(2 * len(run_starts) + 1, dtype=np.int64)
+        counts[0:-1:2] = run_starts - np.concatenate(([0], run_ends[:-1]))
+        counts[1::2] = run_ends - run_starts
+        counts[-1] = flat.size - (run_ends[-1] if len(run_ends) else 0)
+        if len(run_ends) and counts[-1] == 0:
+            counts = counts[:-1]
+        rle.append(counts.astype(np.uint32))
+    return rle
+
+
+def decode_rle(counts, shape):
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts).reshape(shape)
+
+
+class MaskStoreWriter:
+    def __init__(self, path, frame_size, fps):
+        self.path = path
+        self.frame_size = frame_size
+        self.index = []
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, frame_size[0], frame_size[1], fps))
+
+    def write_frame(self, frame_num, masks):
+        self._write_chunk(frame_num, masks, [encode_rle(mask_data['segmentation']) for mask_data in masks])
+
+    def write_labels(self, frame_num, labels, masks):
+        # masks[i] holds the metadata of label i + 1 of the label map (see label_map)
+        self._write_chunk(frame_num, masks, encode_label_rle(labels, len(masks)))
+
+    def _write_chunk(self, frame_num, masks, rle):
+        meta = []
+        data = []
+        for mask_data, counts in zip(masks, rle):
+            meta.append({
+                'object_id': int(mask_data.get('object_id', len(meta))),
+                'bbox': [int(v) for v in mask_data['bbox']],
+                'area': float(mask_data['area']),
+                'stability_score': float(mask_data['stability_score']),
+                'runs': len(counts)
+            })
+            data.append(counts.tobytes())
+        meta_bytes = json.dumps(meta, separators=(',', ':')).encode('utf-8')
+        data_bytes = b"".join(data)
+
+        self.index.append((frame_num, self.file.tell()))
+        self.file.write(CHUNK.pack(frame_num, len(masks), len(meta_bytes), len(data_bytes)))
+        self.file.write(meta_bytes)
+        self.file.write(data_bytes)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        index_offset = self.file.tell()
+        for frame_num, offset in self.index:
+            self.file.write(INDEX_ENTRY.pack(frame_num, offset))
+        self.file.write(FOOTER.pack(index_offset, len(self.index), INDEX_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class MaskStoreReader:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        magic, width, height, fps = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"Not a SegmentFX mask container: {path}")
+        self.frame_size = (width, height)
+        self.fps = fps
+        self.offsets = self._read_index()
+
+    def _read_index(self):
+        self.file.seek(0, os.SEEK_END)
+        file_size = self.file.tell()
+        if file_size >= HEADER.size + FOOTER.size:
+            self.file.seek(file_size - FOOTER.size)
+            index_offset, frame_count, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+            if magic == INDEX_MAGIC:
+                self.file.seek(index_offset)
+                raw = self.file.read(frame_count * INDEX_ENTRY.size)
+                return dict(INDEX_ENTRY.iter_unpack(raw))
+        return self._scan_chunks(file_size)
+
+    def _scan_chunks(self, file_size):
+        offsets = {}
+        offset = HEADER.size
+        while offset + CHUNK.size <= file_size:
+            self.file.seek(offset)
+            frame_num, _, meta_len, data_len = CHUNK.unpack(self.file.read(CHUNK.size))
+            end = offset + CHUNK.size + meta_len + data_len
+            if end > file_size:
+                break  # Chunk still being written
+            offsets[frame_num] = offset
+            offset = end
+        return offsets
+
+    def frames(self):
+        return sorted(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def _read_chunk_meta(self, frame_num):
+        self.file.seek(self.offsets[frame_num])
+        _, _, meta_len, data_len = CHUNK.unpack(self.file.read(CHUNK.size))
+        return json.loads(self.file.read(meta_len)), data_len
+
+    def read_metadata(self, frame_num):
+        # bbox, area and stability_score for every object, without touching the mask data
+        meta, _ = self._read_chunk_meta(frame_num)
+        for object_id, entry in enumerate(meta):
+            entry.setdefault('object_id', object_id)
+            del entry['runs']
+        return meta
+
+    def read_labels(self, frame_num):
+        # The frame as one label map plus its metadata, entry i being label i + 1. Masks written
+        # by write_labels never overlap; elsewhere the later object keeps a shared pixel.
+        meta, data_len = self._read_chunk_meta(frame_num)
+        counts = np.frombuffer(self.file.read(data_len), dtype=np.uint32)
+        shape = (self.frame_size[1], self.frame_size[0])
+        labels = np.zeros(shape, dtype=np.uint8 if len(meta) < 256 else np.uint16)
+        start = 0
+        for label, entry in enumerate(meta, 1):
+            runs = entry.pop('runs')
+            entry.setdefault('object_id', label - 1)
+            labels[decode_rle(counts[start:start + runs], shape)] = label
+            start += runs
+        return labels, meta
+
+    def read_frame(self, frame_num):
+        meta, data_len = self._read_chunk_meta(frame_num)
+        counts = np.frombuffer(self.file.read(data_len), dtype=np.uint32)
+        shape = (self.frame_size[1], self.frame_size[0])
+        masks = []
+        start = 0
+        for object_id, entry in enumerate(meta):
+            runs = entry.pop('runs')
+            entry.setdefault('object_id', object_id)
+            entry['segmentation'] = decode_rle(counts[start:start + runs], shape)
+            start += runs
+            masks.append(entry)
+        return masks
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def export_png_layout(store_path, output_dir):
+    # Recreates the per-object PNG files and mask_metadata.json that Premiere imports
+    os.makedirs(output_dir, exist_ok=True)
+    mask_metadata = []
+    with MaskStoreReader(store_path) as reader:
+        for frame_num in reader.frames():
+            for mask_data in reader.read_frame(frame_num):
+                mask_filename = f"mask_frame{frame_num:04d}_object{mask_data['object_id']:02d}.png"
+                cv2.imwrite(os.path.join(output_dir, mask_filename), mask_data['segmentation'].astype(np.uint8) * 255)
+                mask_metadata.append({
+                    'frame': frame_num,
+                    'object_id': mask_data['object_id'],
+                    'filename': mask_filename,
+                    'bbox': mask_data['bbox'],
+                    'area': mask_data['area'],
+                    'stability_score': mask_data['stability_score']
+                })
+    with open(os.path.join(output_dir, 'mask_metadata.json'), 'w') as f:
+        json.dump(mask_metadata, f, indent=2)
+    return output_dir
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] != "export":
+        print("Usage: python mask_store.py export <masks.sfxm> <output_dir>")
+        sys.exit(1)
+    print(json.dumps({"output_dir": export_png_layout(sys.argv[2], sys.argv[3])}))
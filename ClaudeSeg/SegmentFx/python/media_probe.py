@@ -0,0 +1,206 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "segmentfx", "media_probe.json")
+PROBE_VERSION = 3  # Entries written by another version are probed again
+FFPROBE_TIMEOUT = 300  # seconds; the packet scan reads the whole file, which takes a while for long footage
+
+
+def _parse_rate(rate):
+    # ffprobe frame rates are fractions such as "30000/1001"
+    try:
+        numerator, _, denominator = rate.partition("/")
+        return float(numerator) / float(denominator or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+def _parse_time(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default  # Missing or "N/A"
+
+
+def run_ffprobe(video_path):
+    # One demux pass over the file: container and stream properties plus the flags of every
+    # video packet, from which the keyframe index is built. Nothing is decoded.
+    # Packet timestamps are absolute, while ffmpeg's input -ss counts from the container's
+    # start_time (non-zero in most MPEG-TS and many camera files), so keyframes are stored
+    # relative to that start. start_offset is where the first video frame sits on that timeline.
+    command = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "format=duration,start_time"
+                         ":stream=codec_name,profile,level,pix_fmt,time_base,width,height,avg_frame_rate,r_frame_rate,"
+                         "nb_frames,has_b_frames,start_time"
+                         ":stream_tags=rotate:stream_side_data=rotation:packet=pts_time,flags",
+        "-of", "json", video_path
+    ]
+    try:
+        result = subprocess.run(command, capture_output=True, text=True, timeout=FFPROBE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        raise RuntimeError(f"ffprobe did not finish within {FFPROBE_TIMEOUT} seconds for {video_path}")
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed for {video_path}: {result.stderr.strip()}")
+    data = json.loads(result.stdout)
+    streams = data.get("streams") or [{}]
+    stream = streams[0]
+    packets = data.get("packets", [])
+    container_start = _parse_time(data.get("format", {}).get("start_time"))
+    video_start = _parse_time(stream.get("start_time"), container_start)
+
+    keyframes = sorted(
+        round(float(packet["pts_time"]) - container_start, 6) for packet in packets
+        if "K" in packet.get("flags", "") and packet.get("pts_time") not in (None, "N/A")
+    )
+    # Packets are listed in decode order. A frame decoded after a keyframe but shown before it is a
+    # leading frame of an open GOP, which references the GOP before the keyframe
+    open_gop = False
+    keyframe_pts = None
+    for packet in packets:
+        if packet.get("pts_time") in (None, "N/A"):
+            continue
+        if "K" in packet.get("flags", ""):
+            keyframe_pts = float(packet["pts_time"])
+        elif keyframe_pts is not None and float(packet["pts_time"]) < keyframe_pts:
+            open_gop = True
+            break
+    fps = _parse_rate(stream.get("avg_frame_rate", "0/1")) or _parse_rate(stream.get("r_frame_rate", "0/1"))
+    nb_frames = stream.get("nb_frames")
+    # Width and height are reported as displayed, like cv2.VideoCapture does for rotated phone footage
+    width, height = int(stream.get("width") or 0), int(stream.get("height") or 0)
+    rotation = stream.get("tags", {}).get("rotate") or next(
+        (side_data["rotation"] for side_data in stream.get("side_data_list", []) if "rotation" in side_data), 0)
+    if int(float(rotation)) % 180 != 0:
+        width, height = height, width
+    return {
+        "duration": float(data.get("format", {}).get("duration") or 0),
+        "fps": fps,
+        "frame_count": int(nb_frames) if nb_frames and nb_frames != "N/A" else len(packets),
+        "width": width,
+        "height": height,
+        "codec": stream.get("codec_name"),
+        "profile": stream.get("profile"),
+        "level": stream.get("level"),
+        "pix_fmt": stream.get("pix_fmt"),
+        "time_base": stream.get("time_base"),
+        "has_b_frames": int(stream.get("has_b_frames") or 0),
+        "start_offset": round(video_start - container_start, 6),
+        "open_gop": open_gop,
+        "keyframes": keyframes,
+        "version": PROBE_VERSION
+    }
+
+
+class _FileLock:
+    # Exclusive lock on a file shared by every process using the cache
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a+")
+        if fcntl is not None:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)  # Retries for 10 seconds, then raises OSError
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.file.close()
+
+
+class MediaProbeCache:
+    # ffprobe results stored in one JSON file, keyed by path, size and mtime so an edited or
+    # replaced file is probed again. Each file is probed once; later lookups are dictionary reads.
+    # The panel, the server and the GUI share the file: writes merge into what is on disk under
+    # a lock file, so one process never drops the entries another has added.
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except ValueError:
+            print("Media probe cache is corrupt, starting empty")
+            return {}
+
+    @staticmethod
+    def make_key(video_path):
+        stat = os.stat(video_path)
+        return f"{os.path.realpath(video_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def probe(self, video_path):
+        key = self.make_key(video_path)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry.get("version") == PROBE_VERSION:
+            return entry
+        entry = run_ffprobe(video_path)
+        self._save(key, entry, os.path.realpath(video_path) + "|")
+        return entry
+
+    def _save(self, key, entry, stale_prefix):
+        directory = os.path.dirname(self.cache_path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with self.lock, _FileLock(self.cache_path + ".lock"):
+            entries = self._load()
+            # Drop entries for older versions of the same file
+            for stale in [k for k in entries if k.startswith(stale_prefix)]:
+                del entries[stale]
+            entries[key] = entry
+            fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(self.cache_path) + ".", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(entries, f)
+                os.replace(tmp_path, self.cache_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+            self.entries = entries
+
+
+_default_cache = None
+
+
+def probe_media(video_path, cache=None):
+    # duration, fps, frame_count, width, height, codec, profile, level, pix_fmt, time_base, has_b_frames,
+    # start_offset, open_gop and keyframes of video_path.
+    # Times are in seconds from the container start, the origin of ffmpeg's -ss
+    global _default_cache
+    if cache is None:
+        if _default_cache is None:
+            _default_cache = MediaProbeCache()
+        cache = _default_cache
+    return cache.probe(video_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python media_probe.py <video_path>")
+        sys.exit(1)
+    info = probe_media(sys.argv[1])
+    print(json.dumps(dict(info, keyframes=len(info["keyframes"]))))
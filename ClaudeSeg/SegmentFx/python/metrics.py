@@ -0,0 +1,399 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import deque
+
+# Pipeline stages timed across segmentation, effects rendering and cutting
+STAGES = ("decode", "resize", "inference", "postprocess", "propagate", "effect", "write", "encode")
+# Histogram bucket upper bounds in seconds, from a fast mask write up to a whole ffmpeg run
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+METRICS_PREFIX = "segmentfx"
+METRICS_DIR_ENV = "SEGMENTFX_METRICS_DIR"
+JSON_LINES_FILENAME = "metrics.jsonl"
+PROMETHEUS_FILENAME = "segmentfx_{}.prom"  # One textfile per source, so processes never overwrite each other
+PROGRESS_WINDOW_SECONDS = 10  # Throughput is measured over this much recent history
+PROGRESS_WRITE_INTERVAL = 0.5  # Minimum seconds between progress file rewrites
+
+
+def write_atomic(path, text):
+    # Readers polling the file (the panel, node_exporter) never see a half-written version
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def state(self):
+        return {"value": self.value}
+
+    def merge(self, state):
+        self.value += state["value"]
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def state(self):
+        return {"value": self.value}
+
+    def merge(self, state):
+        self.value = state["value"]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)  # Per bucket, not cumulative
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation; values past the last bucket report max
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return bound
+        return self.max
+
+    def state(self):
+        return {"buckets": list(self.buckets), "counts": list(self.counts), "count": self.count, "sum": self.sum,
+                "min": self.min if self.count else None, "max": self.max}
+
+    def merge(self, state):
+        self.counts = [a + b for a, b in zip(self.counts, state["counts"])]
+        self.count += state["count"]
+        self.sum += state["sum"]
+        if state["count"]:
+            self.min = min(self.min, state["min"])
+            self.max = max(self.max, state["max"])
+
+
+class MetricsRegistry:
+    # Named counters, gauges and histograms, each optionally split by labels. Every process has
+    # its own registry; worker processes either send their stage timings back with their results
+    # or hand over state() for the parent to merge().
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.metrics = {}  # (name, sorted label items) -> metric
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labels, **kwargs):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(**kwargs)
+                if help_text:
+                    self.help[name] = help_text
+            return metric
+
+    def counter(self, name, help_text="", **labels):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text="", **labels):
+        return self._get(Gauge, name, help_text, labels)
+
+    def histogram(self, name, help_text="", buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def observe_stage(self, stage, seconds, items=1):
+        # One call of a stage that handled items frames (a batch, or a single frame)
+        histogram = self.histogram("stage_seconds", "Wall time per stage call", stage=stage)
+        counter = self.counter("stage_items_total", "Frames handled per stage", stage=stage)
+        with self.lock:
+            histogram.observe(seconds)
+            counter.inc(items)
+
+    def stage(self, stage, items=1):
+        return StageTimer(self, stage, items)
+
+    def stage_summary(self):
+        # {stage: {"calls", "items", "seconds", "mean_ms", "p95_ms", "fps"}} in pipeline order
+        summary = {}
+        for (name, labels), metric in sorted(self.state_items(), key=lambda item: _stage_order(item[0])):
+            if name != "stage_seconds" or not metric.count:
+                continue
+            stage = dict(labels)["stage"]
+            items = self.counter("stage_items_total", stage=stage).value
+            summary[stage] = {
+                "calls": metric.count,
+                "items": items,
+                "seconds": metric.sum,
+                "mean_ms": metric.sum / metric.count * 1000,
+                "p95_ms": metric.quantile(0.95) * 1000,
+                "fps": items / metric.sum if metric.sum > 0 else 0.0,
+            }
+        return summary
+
+    def report(self, stages=None):
+        for stage, stats in self.stage_summary().items():
+            if stages is None or stage in stages:
+                print(f"  {stage}: {stats['items']:.0f} frames in {stats['seconds']:.2f} s busy "
+                      f"({stats['fps']:.2f} fps, {stats['mean_ms']:.1f} ms/call, p95 {stats['p95_ms']:.0f} ms)")
+
+    def state(self):
+        with self.lock:
+            return [{"name": name, "labels": dict(labels), "kind": metric.kind, **metric.state()}
+                    for (name, labels), metric in self.metrics.items()]
+
+    def merge(self, state):
+        # Adds another process's state(): counters and histograms accumulate, gauges take the new value
+        kinds = {"counter": self.counter, "gauge": self.gauge, "histogram": self.histogram}
+        for entry in state:
+            kwargs = {"buckets": entry["buckets"]} if entry["kind"] == "histogram" else {}
+            metric = kinds[entry["kind"]](entry["name"], **kwargs, **entry["labels"])
+            with self.lock:
+                metric.merge(entry)
+
+    def reset(self):
+        with self.lock:
+            self.metrics.clear()
+
+    def write_json_lines(self, path, **fields):
+        # Appends one record per call, so a long-running server leaves a history of snapshots
+        record = {"time": time.time(), "pid": os.getpid(), **fields, "stages": self.stage_summary(), "metrics": self.state()}
+        with open(path, "a") as f:
+            f.write(json.dumps(record, default=_json_default) + "\n")
+
+    def prometheus_text(self, **const_labels):
+        # Prometheus text exposition format, as read by node_exporter's textfile collector.
+        # const_labels are added to every series.
+        const_labels = tuple(sorted(const_labels.items()))
+        lines = []
+        by_name = {}
+        for (name, labels), metric in sorted(self.state_items()):
+            by_name.setdefault(name, []).append((const_labels + labels, metric))
+        for name, series in by_name.items():
+            full_name = f"{self.prefix}_{name}"
+            if name in self.help:
+                lines.append(f"# HELP {full_name} {self.help[name]}")
+            lines.append(f"# TYPE {full_name} {series[0][1].kind}")
+            for labels, metric in series:
+                if metric.kind != "histogram":
+                    lines.append(f"{full_name}{_label_text(labels)} {_number(metric.value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets, metric.counts):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{_label_text(labels + (('le', _number(bound)),))} {cumulative}")
+                lines.append(f"{full_name}_bucket{_label_text(labels + (('le', '+Inf'),))} {metric.count}")
+                lines.append(f"{full_name}_sum{_label_text(labels)} {_number(metric.sum)}")
+                lines.append(f"{full_name}_count{_label_text(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+    def state_items(self):
+        with self.lock:
+            return list(self.metrics.items())
+
+    def write_prometheus(self, path, **const_labels):
+        write_atomic(path, self.prometheus_text(**const_labels))
+
+
+class StageTimer:
+    # Context manager that records its block as one call of a stage
+    def __init__(self, registry, stage, items=1):
+        self.registry = registry
+        self.stage = stage
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.registry.observe_stage(self.stage, time.perf_counter() - self.start, self.items)
+        return False
+
+
+def _stage_order(key):
+    name, labels = key
+    stage = dict(labels).get("stage")
+    return (name, STAGES.index(stage) if stage in STAGES else len(STAGES), labels)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _json_default(value):
+    # numpy scalars that end up in metric values or progress fields
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name, help_text="", **labels):
+    return REGISTRY.counter(name, help_text, **labels)
+
+
+def gauge(name, help_text="", **labels):
+    return REGISTRY.gauge(name, help_text, **labels)
+
+
+def histogram(name, help_text="", buckets=DEFAULT_BUCKETS, **labels):
+    return REGISTRY.histogram(name, help_text, buckets, **labels)
+
+
+def stage(name, items=1):
+    return REGISTRY.stage(name, items)
+
+
+def observe_stage(name, seconds, items=1):
+    REGISTRY.observe_stage(name, seconds, items)
+
+
+def metrics_dir(path=None):
+    # An explicit directory, else $SEGMENTFX_METRICS_DIR, else None (no export)
+    return path or os.environ.get(METRICS_DIR_ENV) or None
+
+
+def export(directory, source, **fields):
+    # Writes the process registry to <directory>/metrics.jsonl (appended) and segmentfx_<source>.prom
+    # (replaced). source names the exporting program ("segmentation", "effects", ...) and labels its series.
+    directory = metrics_dir(directory)
+    if directory is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    REGISTRY.write_json_lines(os.path.join(directory, JSON_LINES_FILENAME), source=source, **fields)
+    REGISTRY.write_prometheus(os.path.join(directory, PROMETHEUS_FILENAME.format(source)), source=source)
+    return directory
+
+
+class ProgressTracker:
+    """
+        Throughput and ETA for one task, optionally mirrored to a JSON file that the panel polls
+        instead of parsing stdout. update(done, total) has the signature of the progress_callback
+        arguments used across the pipeline, so a tracker can be passed wherever one is accepted.
+        Throughput is measured over the last PROGRESS_WINDOW_SECONDS so it follows the current
+        rate rather than the average since the start.
+    """
+    def __init__(self, task, total=0, path=None, unit="frames", write_interval=PROGRESS_WRITE_INTERVAL):
+        self.task = task
+        self.total = total
+        self.path = path
+        self.unit = unit
+        self.write_interval = write_interval
+        self.done = 0
+        self.status = "running"
+        self.fields = {}
+        self.start_time = time.time()
+        self.last_write = 0.0
+        self.history = deque([(self.start_time, 0)])
+        self.lock = threading.Lock()
+        self._write(force=True)
+
+    def __call__(self, done, total=None):
+        self.update(done, total)
+
+    def update(self, done, total=None):
+        now = time.time()
+        with self.lock:
+            if total:
+                self.total = total
+            self.done = done
+            self.history.append((now, done))
+            while len(self.history) > 2 and now - self.history[1][0] > PROGRESS_WINDOW_SECONDS:
+                self.history.popleft()
+        self._write()
+
+    def rate(self):
+        # Units per second over the recent window
+        (start, start_done), (end, end_done) = self.history[0], self.history[-1]
+        return (end_done - start_done) / (end - start) if end > start else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            rate = self.rate()
+            remaining = max(self.total - self.done, 0) if self.total else None
+            eta = remaining / rate if remaining is not None and rate > 0 else None
+            return {
+                "task": self.task,
+                "status": self.status,
+                "done": self.done,
+                "total": self.total,
+                "unit": self.unit,
+                "progress": self.done / self.total * 100 if self.total else 0.0,
+                "rate": rate,
+                "eta_seconds": 0.0 if self.status == "complete" else eta,
+                "elapsed_seconds": time.time() - self.start_time,
+                "stages": REGISTRY.stage_summary(),
+                "pid": os.getpid(),
+                "updated": time.time(),
+                **self.fields,
+            }
+
+    def _write(self, force=False):
+        if self.path is None:
+            return
+        now = time.time()
+        if not force and now - self.last_write < self.write_interval:
+            return
+        self.last_write = now
+        try:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            write_atomic(self.path, json.dumps(self.snapshot(), default=_json_default))
+        except OSError as e:
+            print(f"Could not write progress file {self.path}: {str(e)}")
+
+    def finish(self, status="complete", **fields):
+        # fields (e.g. the output path or an error) ride along in the final write
+        with self.lock:
+            self.status = status
+            self.fields.update(fields)
+            if status == "complete" and self.total:
+                self.done = max(self.done, self.total)
+        self._write(force=True)
+
+
+def read_progress(path):
+    # The last snapshot written to a progress file, or None if there is none (yet)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
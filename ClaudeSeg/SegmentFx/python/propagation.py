@@ -0,0 +1,130 @@
+import cv2
+import numpy as np
+
+
+def to_gray(frame):
+    return cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+
+
+def scene_change_score(prev_gray, gray, bins=32):
+    # 0 for identical luminance histograms, up to 1 for completely different shots
+    prev_hist = cv2.calcHist([prev_gray], [0], None, [bins], [0, 256])
+    hist = cv2.calcHist([gray], [0], None, [bins], [0, 256])
+    cv2.normalize(prev_hist, prev_hist)
+    cv2.normalize(hist, hist)
+    return float(1 - max(cv2.compareHist(prev_hist, hist, cv2.HISTCMP_CORREL), 0))
+
+
+def compute_flow(prev_gray, gray):
+    # Backward flow: for every pixel of the current frame, where it was in the previous one
+    return cv2.calcOpticalFlowFarneback(gray, prev_gray, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+
+
+def upscale_flow(flow, size):
+    # Resize a flow field computed at low resolution to size (width, height), scaling the vectors too
+    width, height = size
+    scale_x = width / flow.shape[1]
+    scale_y = height / flow.shape[0]
+    flow = cv2.resize(flow, (width, height), interpolation=cv2.INTER_LINEAR)
+    flow[..., 0] *= scale_x
+    flow[..., 1] *= scale_y
+    return flow
+
+
+def motion_score(prev_gray, gray):
+    # Mean absolute luminance change, 0 (static) to 1
+    return float(cv2.absdiff(prev_gray, gray).mean() / 255)
+
+
+def warp_mask(mask, flow):
+    h, w = flow.shape[:2]
+    grid_x, grid_y = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+    map_x = grid_x + flow[..., 0]
+    map_y = grid_y + flow[..., 1]
+    warped = cv2.remap(mask.astype(np.uint8), map_x, map_y, cv2.INTER_NEAREST, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    return warped > 0
+
+
+def mask_iou(a, b):
+    union = np.logical_or(a, b).sum()
+    if union == 0:
+        return 0.0
+    return float(np.logical_and(a, b).sum() / union)
+
+
+def mask_bbox(mask):
+    # XYWH like SamAutomaticMaskGenerator, or None for an empty mask
+    ys, xs = np.nonzero(mask)
+    if len(xs) == 0:
+        return None
+    return [int(xs.min()), int(ys.min()), int(xs.max() - xs.min()), int(ys.max() - ys.min())]
+
+
+class ObjectTracker:
+    # Keeps object IDs stable across frames by greedily matching new masks to the
+    # current tracks by IoU. Unmatched masks start new tracks.
+    def __init__(self, iou_threshold=0.3):
+        self.iou_threshold = iou_threshold
+        self.tracks = {}  # object_id -> mask data dict (segmentation at working resolution)
+        self.next_id = 0
+
+    def assign(self, masks):
+        candidates = []
+        for track_id, track in self.tracks.items():
+            for i, mask_data in enumerate(masks):
+                iou = mask_iou(track['segmentation'], mask_data['segmentation'])
+                if iou >= self.iou_threshold:
+                    candidates.append((iou, track_id, i))
+        candidates.sort(reverse=True)
+
+        assigned = {}
+        used_tracks = set()
+        for iou, track_id, i in candidates:
+            if track_id in used_tracks or i in assigned:
+                continue
+            assigned[i] = track_id
+            used_tracks.add(track_id)
+        for i in range(len(masks)):
+            if i not in assigned:
+                assigned[i] = self.next_id
+                self.next_id += 1
+
+        self.tracks = {}
+        for i, mask_data in enumerate(masks):
+            mask_data['object_id'] = assigned[i]
+            self.tracks[assigned[i]] = mask_data
+        return masks
+
+    def propagate(self, flow, predictor=None, min_refit_iou=0.5):
+        # Warp every track into the current frame; optionally re-fit it with a box prompt.
+        # predictor must already hold the current frame (set_image).
+        propagated = []
+        for object_id, track in self.tracks.items():
+            warped = warp_mask(track['segmentation'], flow)
+            bbox = mask_bbox(warped)
+            if bbox is None:
+                continue  # Object left the frame
+            segmentation = warped
+            score = track['stability_score']
+            if predictor is not None:
+                x, y, w, h = bbox
+                masks, scores, _ = predictor.predict(
+                    point_coords=None,
+                    point_labels=None,
+                    box=np.array([x, y, x + w, y + h]),
+                    multimask_output=False,
+                )
+                # Keep the warped mask if SAM jumped to a different object
+                if mask_iou(masks[0], warped) >= min_refit_iou:
+                    segmentation = masks[0]
+                    score = float(scores[0])
+                    bbox = mask_bbox(segmentation)
+            propagated.append({
+                'segmentation': segmentation,
+                'bbox': bbox,
+                'area': int(segmentation.sum()),
+                'stability_score': score,
+                'object_id': object_id
+            })
+        self.tracks = {mask_data['object_id']: mask_data for mask_data in propagated}
+        return propagated
@@ -1,3 +1,4 @@
+import argparse
 import cv2
 import gc
 import json
@@ -7,222 +8,779 @@ import os
 from PIL import Image
 import queue
 import sys
+import threading
 import time
 import traceback
 # import torch
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import warnings
 
-def manual_process_batch(batch_frames, predictor, user_mask, input_box):
-    predictor.set_image(np.stack(batch_frames))
-    masks, _, _ = predictor.predict(
-        point_coords=None,
-        point_labels=None,
-        box=np.tile(input_box[None, :], (len(batch_frames), 1)),
-        multimask_output=False,
-    )
-    return np.logical_and(masks, user_mask > 0).astype(np.uint8) * 255
-
-def process_frame(process_id, task_queue, result_queue, object_count, resize_factor):
+import metrics
+from embedding_cache import EmbeddingCache, set_features, video_identity
+from frame_ring import SharedFrameRing
+from label_map import OVERLAP_POLICIES, combined_mask, label_dtype, object_mask, paint_labels, upscale_labels
+from mask_store import MaskStoreWriter
+from media_probe import probe_media
+from propagation import (ObjectTracker, compute_flow, mask_bbox, motion_score, scene_change_score, to_gray,
+                         upscale_flow, warp_mask)
+from worker_pool import SegmentationWorkerPool, default_worker_count, memory_usage_mb, report_memory
+
+MASK_STORE_FILENAME = "masks.sfxm"
+MODEL_TYPE = "vit_t" # tiny model
+SAM_CHECKPOINT = "models/mobile_sam.pt"
+ENCODER_BATCH_SIZE = 4  # Frames per image-encoder call in manual mode
+
+def encode_frames(predictor, frames):
+    # (features, original_size, input_size) per frame, from one image-encoder call. Without torch
+    # (the numpy-only benchmark stub) each frame goes through predictor.set_image instead
+    try:
+        from inference_backend import encode_batch
+    except ImportError:
+        entries = []
+        for frame in frames:
+            predictor.set_image(frame)
+            entries.append((predictor.features, predictor.original_size, predictor.input_size))
+        return entries
+    features, original_size, input_size = encode_batch(predictor, frames)
+    return [(frame_features[None], original_size, input_size) for frame_features in features]
+
+def manual_process_batch(batch_frames, predictor, user_mask, input_box, batch_indices=None, cache=None, video_id=None,
+                         encoder_batch_size=ENCODER_BATCH_SIZE):
+    # Frames whose embeddings are not cached go through the image encoder encoder_batch_size at a
+    # time; SamPredictor then holds one frame's embedding at a time for the mask decoder
+    tag = getattr(predictor.model, "model_tag", MODEL_TYPE)
+    masks = []
+    for chunk_start in range(0, len(batch_frames), encoder_batch_size):
+        chunk = batch_frames[chunk_start:chunk_start + encoder_batch_size]
+        keys = [None] * len(chunk)
+        if cache is not None and batch_indices is not None:
+            keys = [cache.make_key(video_id, index, tag) for index in batch_indices[chunk_start:chunk_start + len(chunk)]]
+        entries = [cache.get(key) if key is not None else None for key in keys]
+        missing = [j for j, entry in enumerate(entries) if entry is None]
+        if missing:
+            for j, entry in zip(missing, encode_frames(predictor, [chunk[j] for j in missing])):
+                entries[j] = entry
+                if keys[j] is not None:
+                    features = entry[0].cpu().numpy() if hasattr(entry[0], "cpu") else entry[0]
+                    cache.put(keys[j], features, entry[1], entry[2])
+        for entry in entries:
+            set_features(predictor, *entry)
+            frame_masks, _, _ = predictor.predict(
+                point_coords=None,
+                point_labels=None,
+                box=input_box,
+                multimask_output=False,
+            )
+            masks.append(frame_masks[0])
+    return np.logical_and(np.stack(masks), user_mask > 0).astype(np.uint8) * 255
+
+def segment_frame(mask_generator, frame, object_count, resize_factor, original_size, labels=None, timings=None,
+                  overlap="smaller-on-top"):
+    # Returns (label map at original_size, metadata of every kept object), object i being label
+    # i + 1. labels, if given, is the output buffer (a shared-memory slot). timings, if given,
+    # receives the seconds spent in each stage ("resize", "inference", "postprocess"); workers
+    # send it back with their result since their own metrics registry never reaches the parent
+    stage_start = time.perf_counter()
+    # Resize frame for segmentation
+    h, w = frame.shape[:2]
+    small_frame = cv2.resize(frame, (int(w * resize_factor), int(h * resize_factor)))
+    resized = time.perf_counter()
+
+    masks = mask_generator.generate(small_frame)
+    generated = time.perf_counter()
+    top_masks = sorted(masks, key=lambda x: x['area'], reverse=True)[:object_count]
+
+    # Paint the kept masks into a small label map and upscale it once, instead of every mask
+    small_labels = paint_labels(top_masks, small_frame.shape[:2], labels.dtype if labels is not None else None, overlap)
+    labels = upscale_labels(small_labels, original_size, out=labels)
+
+    for mask in top_masks:
+        del mask['segmentation']
+        # Adjust bounding box
+        x1, y1, x2, y2 = mask['bbox']
+        mask['bbox'] = [
+            int(x1 / resize_factor),
+            int(y1 / resize_factor),
+            int(x2 / resize_factor),
+            int(y2 / resize_factor)
+        ]
+        mask['area'] = mask['area'] / (resize_factor ** 2)
+    if timings is not None:
+        timings.update(resize=resized - stage_start, inference=generated - resized,
+                       postprocess=time.perf_counter() - generated)
+    return labels, top_masks
+
+
+def observe_timings(timings):
+    # Records a worker's per-stage timings in this process; returns their total
+    for stage, seconds in timings.items():
+        metrics.observe_stage(stage, seconds)
+    return sum(timings.values())
+
+def set_torch_threads(threads):
+    # Intra-op threads for this process. Models that run without torch (the benchmark stub) have none to set
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+def process_frame(process_id, task_queue, result_queue, object_count, resize_factor, ring_info=None, mask_generator=None,
+                  threads=None, backend="eager", quantize=False, overlap="smaller-on-top"):
     print(f"Worker {process_id} starting")
-    mask_generator = load_model()
-    print(f"Worker {process_id} loaded model")
+    if threads is not None:
+        set_torch_threads(threads)
+    if mask_generator is None:
+        mask_generator = load_model(backend=backend, quantize=quantize)
+        print(f"Worker {process_id} loaded model")
+    ring = SharedFrameRing.attach(ring_info) if ring_info is not None else None
     while True:
         try:
             task = task_queue.get(timeout=60)
             if task is None:  # Signal to end the process
                 print(f"Worker {process_id} received end signal")
                 break
-            frame_num, frame, original_size = task
-            start_time = time.time()
+            if ring is not None:
+                frame_num, slot, original_size = task
+                frame = ring.frames[slot]
+                result_key = (frame_num, slot)  # The parent frees the slot once it has read the labels
+            else:
+                frame_num, frame, original_size = task
+                result_key = frame_num
             print(f"Worker {process_id} processing frame {frame_num}")
             try:
-                # Resize frame for segmentation
-                h, w = frame.shape[:2]
-                small_frame = cv2.resize(frame, (int(w * resize_factor), int(h * resize_factor)))
-                
-                masks = mask_generator.generate(small_frame)
-                top_masks = sorted(masks, key=lambda x: x['area'], reverse=True)[:object_count]
-                
-                # Resize masks back to original size
-                for mask in top_masks:
-                    mask['segmentation'] = cv2.resize(mask['segmentation'].astype(np.uint8), original_size) > 0
-                    # Adjust bounding box
-                    x1, y1, x2, y2 = mask['bbox']
-                    mask['bbox'] = [
-                        int(x1 / resize_factor),
-                        int(y1 / resize_factor),
-                        int(x2 / resize_factor),
-                        int(y2 / resize_factor)
-                    ]
-                    mask['area'] = mask['area'] / (resize_factor ** 2)
-                
-                process_time = time.time() - start_time
-                result_queue.put((frame_num, top_masks, process_time))
-                print(f"Worker {process_id} completed frame {frame_num} in {process_time:.2f} seconds")
+                timings = {}
+                labels, top_masks = segment_frame(mask_generator, frame, object_count, resize_factor, original_size,
+                                                  ring.labels[slot] if ring is not None else None, timings, overlap)
+                # With the ring the label map is already in the slot; otherwise it is the one array sent back
+                result_queue.put((result_key, (labels if ring is None else None, top_masks), timings))
+                print(f"Worker {process_id} completed frame {frame_num} in {sum(timings.values()):.2f} seconds")
             except Exception as e:
                 print(f"Worker {process_id} error processing frame {frame_num}: {str(e)}")
                 traceback.print_exc()
-                result_queue.put((frame_num, None, 0))
+                result_queue.put((result_key, None, {}))
             gc.collect()
             
             # Periodic status update
             if frame_num % 10 == 0:
-                memory_usage = psutil.Process().memory_info().rss / 1024 / 1024  # in MB
-                print(f"Worker {process_id} status: Frame {frame_num}, Memory usage: {memory_usage:.2f} MB")
+                rss, _ = memory_usage_mb()
+                if rss is not None:
+                    print(f"Worker {process_id} status: Frame {frame_num}, Memory usage: {rss:.2f} MB")
                 
         except Exception as e:
             print(f"Error in worker process {process_id}: {str(e)}")
             traceback.print_exc()
+    if ring is not None:
+        ring.close()
     print(f"Worker {process_id} finishing")
 
 
-def prepare_frames(video_path, max_frames=None):
+def get_video_properties(video_path):
+    # Probed once per file through the media probe cache; OpenCV is the fallback without ffprobe
+    try:
+        info = probe_media(video_path)
+        if info["frame_count"] and info["fps"] and info["width"]:
+            return info["frame_count"], info["fps"], (info["width"], info["height"])
+    except (OSError, RuntimeError, ValueError):
+        pass
     video = cv2.VideoCapture(video_path)
     frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
     fps = video.get(cv2.CAP_PROP_FPS)
     width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    
-    frames = []
-    for frame_num in range(frame_count):
-        if max_frames is not None and frame_num >= max_frames:
-            break
-        ret, frame = video.read()
-        if not ret:
-            break
-        frames.append((frame_num, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), (width, height)))
-    
     video.release()
-    return frames, fps, (width, height)
+    return frame_count, fps, (width, height)
 
-def load_model(manual=False):
-    from mobile_sam import sam_model_registry, SamPredictor, SamAutomaticMaskGenerator
-    model_type = "vit_t" # tiny model
-    sam_checkpoint = "models/mobile_sam.pt"
+
+def iter_frames(video_path, max_frames=None):
+    # Decode lazily so only the frames currently in flight are held in memory
+    video = cv2.VideoCapture(video_path)
+    width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    frame_num = 0
+    try:
+        while max_frames is None or frame_num < max_frames:
+            decode_start = time.perf_counter()
+            ret, frame = video.read()
+            if not ret:
+                break
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            metrics.observe_stage("decode", time.perf_counter() - decode_start)
+            yield frame_num, frame, (width, height)
+            frame_num += 1
+    finally:
+        video.release()
+
+
+class FrameProducer(threading.Thread):
+    # Feeds (frame_num, frame, original_size) tasks into a bounded queue. put() blocks
+    # once the queue is full, so decoding runs only as fast as the workers consume.
+    # With a shared-memory ring the frame is copied into a free slot and only the slot
+    # index is queued; waiting for a free slot provides the back-pressure instead.
+    # task_prefix is prepended to every task (the job header of a persistent worker pool).
+    # With a writer, decoding also waits for the writer's reorder window (AutoMaskWriter).
+    # Every wait polls stop_event, so stop() releases the thread even when the workers have died
+    # with every slot taken or the task queue full.
+    def __init__(self, video_path, task_queue, num_workers, max_frames=None, ring=None, free_slots=None, task_prefix=(),
+                 writer=None):
+        super().__init__(daemon=True)
+        self.video_path = video_path
+        self.task_queue = task_queue
+        self.task_prefix = tuple(task_prefix)
+        self.writer = writer
+        self.ring = ring
+        self.free_slots = free_slots
+        self.num_workers = num_workers
+        self.max_frames = max_frames
+        self.frames_produced = 0
+        self.done = threading.Event()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        try:
+            for task in iter_frames(self.video_path, self.max_frames):
+                if self.writer is not None:
+                    self.writer.wait_for_window(task[0], self.stop_event)
+                if self.stop_event.is_set():
+                    break
+                if self.ring is not None:
+                    frame_num, frame, original_size = task
+                    slot = self._free_slot()
+                    if slot is None:
+                        break
+                    self.ring.frames[slot] = frame
+                    task = (frame_num, slot, original_size)
+                if not self._put(self.task_prefix + tuple(task)):
+                    break
+                self.frames_produced += 1
+        except Exception as e:
+            print(f"Error while decoding frames: {str(e)}")
+            traceback.print_exc()
+        finally:
+            # One end signal per worker (none for a pool, whose workers outlive the job)
+            for _ in range(self.num_workers):
+                if not self._put(None):
+                    break
+            self.done.set()
+            print(f"Producer finished after {self.frames_produced} frames")
+
+    def _free_slot(self):
+        # A free ring slot, or None once the job is stopped
+        while not self.stop_event.is_set():
+            try:
+                return self.free_slots.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return None
+
+    def _put(self, item):
+        # False if the job was stopped while the task queue stayed full
+        while True:
+            try:
+                self.task_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                if self.stop_event.is_set():
+                    return False
+
+    def stop(self):
+        self.stop_event.set()
+
+def build_sam(backend="eager", quantize=False):
+    # backend selects how the image encoder and mask decoder run: "eager" PyTorch, or a graph
+    # exported to "torchscript" or "onnx" (ONNX Runtime). quantize uses int8 weights.
+    from mobile_sam import sam_model_registry
+    model_type = MODEL_TYPE
+    sam_checkpoint = SAM_CHECKPOINT
     device = "cpu"
     # device = "cuda" if torch.cuda.is_available() else "cpu"
 
+    mobile_sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
+    mobile_sam.to(device=device)
+    if backend != "eager" or quantize:
+        from inference_backend import apply_backend
+        apply_backend(mobile_sam, backend, quantize, model_type, sam_checkpoint)
+    return mobile_sam
+
+
+def load_model(manual=False, backend="eager", quantize=False):
+    from mobile_sam import SamPredictor, SamAutomaticMaskGenerator
+    mobile_sam = build_sam(backend, quantize)
     if not manual:
-        mobile_sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
-        mobile_sam.to(device=device)
         mask_generator = SamAutomaticMaskGenerator(mobile_sam)
     else:
-        mobile_sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
-        mobile_sam.to(device=device)
         mask_generator = SamPredictor(mobile_sam)
     return mask_generator
 
 
-def auto_segment(video_path, object_count, num_processes=None, max_frames=None, resize_factor=0.5):
-    if num_processes is None:
-        num_processes = max(1, multiprocessing.cpu_count() - 2)  # Leave two CPUs free
+def load_models(backend="eager", quantize=False):
+    # Both interfaces over a single copy of the weights, for processes that serve auto and manual jobs
+    from mobile_sam import SamPredictor, SamAutomaticMaskGenerator
+    mobile_sam = build_sam(backend, quantize)
+    return SamAutomaticMaskGenerator(mobile_sam), SamPredictor(mobile_sam)
 
-    start_time = time.time()
-    
-    print("Preparing frames...")
-    frames, fps, original_size = prepare_frames(video_path, max_frames)
-    print(f"Prepared {len(frames)} frames")
 
-    output_dir = "segmentation_output"
-    os.makedirs(output_dir, exist_ok=True)
+class AutoMaskWriter:
+    # Reorder buffer in front of the automatic-mode outputs. Results arrive in any order from the
+    # workers; each frame's masks, metadata and combined-mask frame are written as soon as every
+    # earlier frame has been, so only the frames finished ahead of the slowest one are held.
+    # With a window set, wait_for_window() keeps the decoder at most that many frames ahead of
+    # the last written frame, which bounds the buffer by worker skew rather than clip length.
+    # The container is flushed after every frame and mask_objects.json is rewritten when a new
+    # object appears, so the output directory is usable before the job finishes. The PNG layout's
+    # mask_metadata.json is streamed: each frame's records are appended to a JSON array that
+    # close() terminates, so neither memory nor the write per frame grows with the clip.
+    def __init__(self, output_dir, original_size, fps, frame_count, mask_format="container", window=None):
+        if mask_format not in ("container", "png"):
+            raise ValueError(f"Unknown mask format: {mask_format}")
+        self.output_dir = output_dir
+        self.width, self.height = original_size
+        self.frame_count = frame_count
+        self.window = window
+        self.pending = {}
+        self.max_pending = 0
+        self.next_frame = 0
+        self.frames_processed = 0
+        self.object_ids = set()
+        self.condition = threading.Condition()
+        self.store = None
+        self.metadata_file = None
+        self.metadata_count = 0
+        if mask_format == "container":
+            self.store = MaskStoreWriter(os.path.join(output_dir, MASK_STORE_FILENAME), original_size, fps)
+        else:
+            self.metadata_file = open(os.path.join(output_dir, 'mask_metadata.json'), 'w')
+            self.metadata_file.write("[")
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self.video = cv2.VideoWriter(os.path.join(output_dir, 'combined_masks.mp4'), fourcc, fps,
+                                     original_size, isColor=False)
+
+    def wait_for_window(self, frame_num, stop_event):
+        # Called by the decoder before handing frame_num to the workers
+        if self.window is None:
+            return
+        with self.condition:
+            while frame_num >= self.next_frame + self.window and not stop_event.is_set():
+                self.condition.wait(0.5)
+
+    def add(self, frame_num, frame_masks):
+        # frame_masks is (label map, object metadata), or None for a frame that failed to segment
+        self.pending[frame_num] = frame_masks
+        self.max_pending = max(self.max_pending, len(self.pending))
+        while self.next_frame in self.pending:
+            self._write(self.next_frame, self.pending.pop(self.next_frame))
+
+    def _write(self, frame_num, frame_masks):
+        if frame_masks is None:
+            metrics.counter("frame_errors_total", "Frames that failed to segment", task="auto").inc()
+            frame_combined = np.zeros((self.height, self.width), dtype=np.uint8)
+        else:
+            labels, frame_masks = frame_masks
+            self.frames_processed += 1
+            write_start = time.perf_counter()
+            if self.store is not None:
+                self.store.write_labels(frame_num, labels, frame_masks)
+                self.store.flush()
+            new_objects = False
+            for i, mask_data in enumerate(frame_masks):
+                object_id = mask_data.get('object_id', i)
+                new_objects |= object_id not in self.object_ids
+                self.object_ids.add(object_id)
+                if self.store is not None:
+                    continue
+                mask_filename = f"mask_frame{frame_num:04d}_object{object_id:02d}.png"
+                cv2.imwrite(os.path.join(self.output_dir, mask_filename), object_mask(labels, i + 1))
+                self._append_metadata({
+                    'frame': frame_num,
+                    'object_id': object_id,
+                    'filename': mask_filename,
+                    'bbox': mask_data['bbox'],
+                    'area': float(mask_data['area']),
+                    'stability_score': float(mask_data['stability_score'])
+                })
+            if self.metadata_file is not None:
+                self.metadata_file.flush()
+            elif new_objects:
+                self._write_sidecar()
+            metrics.observe_stage("write", time.perf_counter() - write_start)
+            frame_combined = combined_mask(labels)
+        with metrics.stage("encode"):
+            self.video.write(frame_combined)
+
+        with self.condition:
+            self.next_frame = frame_num + 1
+            self.condition.notify_all()
+        if frame_num % 30 == 0:
+            progress = (frame_num + 1) / max(self.frame_count, 1) * 100
+            print(f"Processing progress: {progress:.2f}%")
+
+    def _write_sidecar(self, complete=False):
+        # The panel only needs the object IDs to build its adjustment layers; per-frame
+        # metadata stays in the container (mask_store.export_png_layout recreates the old files)
+        metrics.write_atomic(os.path.join(self.output_dir, 'mask_objects.json'), json.dumps({
+            'mask_store': MASK_STORE_FILENAME, 'object_ids': sorted(self.object_ids), 'complete': complete}))
+
+    def _append_metadata(self, record):
+        # One array element per line; the opening bracket is written in __init__, the closing one in close()
+        separator = "," if self.metadata_count else ""
+        self.metadata_file.write(f"{separator}\n  {json.dumps(record)}")
+        self.metadata_count += 1
 
-    # Create queues for tasks and results
-    task_queue = multiprocessing.Queue()
-    result_queue = multiprocessing.Queue()
+    def close(self, complete=True):
+        # Frames still buffered here follow one that never arrived (a worker died or the job
+        # timed out); they are written in order, with a blank combined-mask frame for each gap
+        if self.pending:
+            last_frame = max(self.pending)
+            print(f"Writing {len(self.pending)} buffered frames after missing frame {self.next_frame}")
+            for frame_num in range(self.next_frame, last_frame + 1):
+                self._write(frame_num, self.pending.pop(frame_num, None))
+        if self.store is not None:
+            self.store.close()
+            self._write_sidecar(complete)
+        else:
+            self.metadata_file.write("\n]\n")
+            self.metadata_file.close()
+        self.video.release()
+        metrics.gauge("reorder_buffer_peak_frames", "Most frames held waiting for an earlier one",
+                      task="auto").set(self.max_pending)
 
-    # Start worker processes
+
+def segment_with_workers(video_path, object_count, frame_count, original_size, writer, num_processes=None, max_frames=None,
+                         resize_factor=0.5, queue_depth=None, transport="shm", mask_generator=None, progress_callback=None,
+                         pool=None, worker_loading="shared", threads_per_worker=None, backend="eager", quantize=False,
+                         reorder_window=None, overlap="smaller-on-top"):
+    # Workers come from, in order of preference: a warm pool passed in (kept across videos), a
+    # warm generator run on a single in-process thread, or a pool started for this video alone.
+    # worker_loading="per-worker" keeps the old behaviour of every process loading its own model.
+    start_time = time.time()
+    own_pool = False
+    loading = worker_loading
+    if pool is not None:
+        num_processes = pool.num_workers
+        loading = "warm pool"
+    elif mask_generator is not None:
+        # A warm generator is shared by a single in-process worker thread; nothing is pickled
+        num_processes = 1
+        transport = "queue"
+        loading = "warm generator"
+    else:
+        if num_processes is None:
+            num_processes = default_worker_count()
+        if threads_per_worker is None:
+            threads_per_worker = max(1, multiprocessing.cpu_count() // num_processes)
+        if worker_loading == "shared":
+            pool = SegmentationWorkerPool(num_processes, threads_per_worker, backend=backend, quantize=quantize)
+            own_pool = True
+        elif worker_loading != "per-worker":
+            raise ValueError(f"Unknown worker loading: {worker_loading}")
+    if queue_depth is None:
+        queue_depth = num_processes * 2  # Enough to keep every worker busy without buffering the clip
+    if reorder_window is None:
+        reorder_window = 2 * (queue_depth + num_processes)  # Room for one slow frame without stalling the rest
+    writer.window = reorder_window
+    print(f"Streaming {frame_count} frames (queue depth {queue_depth}, reorder window {reorder_window}, {transport} transport)")
+
+    # With the shared-memory transport, frames and label maps live in a ring of slots.
+    # Every queued task plus every frame being processed needs its own slot.
+    ring = None
+    free_slots = None
+    ring_info = None
+    if transport == "shm":
+        ring = SharedFrameRing(queue_depth + num_processes, original_size, label_dtype(object_count))
+        ring_info = ring.info()
+        free_slots = queue.Queue()
+        for slot in range(ring.slot_count):
+            free_slots.put(slot)
+        print(f"Allocated {ring.slot_count} shared-memory slots ({ring.nbytes / 1024 / 1024:.1f} MB)")
+    elif transport != "queue":
+        raise ValueError(f"Unknown transport: {transport}")
+
+    # Create queues for tasks and results. The task queue is bounded so decoding
+    # applies back-pressure instead of loading the whole clip into memory.
     processes = []
-    for i in range(num_processes):
-        p = multiprocessing.Process(target=process_frame, args=(i, task_queue, result_queue, object_count, resize_factor))
-        p.start()
-        processes.append(p)
-
-    # Add tasks to the queue
-    for frame in frames:
-        task_queue.put(frame)
-    print(f"Added {len(frames)} frames to task queue")
-
-    # Add end signals
-    for _ in range(num_processes):
-        task_queue.put(None)
-    print("Added end signals to task queue")
-
-    # Collect results
-    results = []
+    if pool is not None:
+        job_id = pool.begin_job()
+        task_queue = pool.task_queue
+        producer = FrameProducer(video_path, task_queue, 0, max_frames, ring, free_slots,
+                                 (job_id, object_count, resize_factor, ring_info, overlap), writer)
+        get_result = lambda timeout: pool.get_result(job_id, timeout)
+        workers_alive = pool.alive
+        worker_pids = pool.pids
+    else:
+        if mask_generator is not None:
+            task_queue = queue.Queue(maxsize=queue_depth)
+            result_queue = queue.Queue()
+            p = threading.Thread(target=process_frame, args=(0, task_queue, result_queue, object_count, resize_factor, None, mask_generator),
+                                 kwargs={"overlap": overlap}, daemon=True)
+            p.start()
+            processes.append(p)
+        else:
+            task_queue = multiprocessing.Queue(maxsize=queue_depth)
+            result_queue = multiprocessing.Queue()
+            for i in range(num_processes):
+                p = multiprocessing.Process(target=process_frame, args=(i, task_queue, result_queue, object_count, resize_factor,
+                                                                        ring_info, None, threads_per_worker, backend, quantize,
+                                                                        overlap))
+                p.start()
+                processes.append(p)
+        producer = FrameProducer(video_path, task_queue, num_processes, max_frames, ring, free_slots, writer=writer)
+        get_result = lambda timeout: result_queue.get(timeout=timeout)
+        workers_alive = lambda: any(p.is_alive() for p in processes)
+        worker_pids = lambda: [p.pid for p in processes if isinstance(p, multiprocessing.Process) and p.is_alive()]
+
+    # Decode in the background; workers start on the first frame instead of waiting for the clip
+    producer.start()
+
+    # Collect results; the writer puts them back in frame order
+    received = 0
     total_process_time = 0
-    timeout_counter = 0
-    while len(results) < len(frames):
-        try:
-            frame_num, frame_result, process_time = result_queue.get(timeout=600)  # Increased timeout to 10 minutes
-            results.append((frame_num, frame_result))
-            if frame_result is not None:
-                total_process_time += process_time
-            print(f"Received result for frame {frame_num}. Total frames processed: {len(results)}/{len(frames)}")
-            timeout_counter = 0  # Reset timeout counter on successful receive
-        except Exception as e:
-            print(f"Error while collecting results: {str(e)}")
-            traceback.print_exc()
-            timeout_counter += 1
-            if timeout_counter > 5:  # Break after 5 consecutive timeouts
-                print("Too many consecutive timeouts. Breaking loop.")
+    idle_seconds = 0
+    try:
+        while not (producer.done.is_set() and received >= producer.frames_produced):
+            try:
+                frame_num, frame_result, timings = get_result(1)
+                if ring is not None:
+                    frame_num, slot = frame_num
+                    if frame_result is not None:
+                        # One copy of the label map frees the slot; the writer extracts objects from it
+                        frame_result = (ring.labels[slot].copy(), frame_result[1])
+                    free_slots.put(slot)
+                received += 1
+                if frame_result is not None:
+                    total_process_time += observe_timings(timings)
+                writer.add(frame_num, frame_result)
+                if received == 1:
+                    first_mask_seconds = time.time() - start_time
+                    metrics.gauge("first_mask_seconds", "Time from job start to the first mask").set(first_mask_seconds)
+                    print(f"Time to first mask: {first_mask_seconds:.2f} seconds ({loading})")
+                if received == max(1, frame_count // 2):
+                    # Every worker has loaded its model by mid-clip, so this is the steady-state footprint
+                    report_memory([os.getpid()] + worker_pids(), loading)
+                print(f"Received result for frame {frame_num}. Total frames processed: {received}/{frame_count} "
+                      f"({len(writer.pending)} waiting to be written)")
+                if progress_callback is not None:
+                    progress_callback(received, frame_count)
+                idle_seconds = 0  # Reset idle counter on successful receive
+            except queue.Empty:
+                idle_seconds += 1
+                if not workers_alive():
+                    print("All workers exited before every frame was processed. Breaking loop.")
+                    break
+                if idle_seconds > 600:  # No result for 10 minutes
+                    print("Timed out waiting for results. Breaking loop.")
+                    break
+            except Exception as e:
+                print(f"Error while collecting results: {str(e)}")
+                traceback.print_exc()
                 break
+    finally:
+        producer.stop()
+        if pool is not None:
+            pool.end_job()
+            if own_pool:
+                pool.close()
 
     # Wait for all processes to finish
     for p in processes:
         p.join(timeout=120)  # Increased timeout to 2 minutes
-        if p.is_alive():
+        if p.is_alive() and isinstance(p, multiprocessing.Process):
             print(f"Worker process {p.pid} did not finish in time. Terminating.")
             p.terminate()
 
-    # Sort results by frame number
-    results.sort(key=lambda x: x[0])
+    if ring is not None:
+        ring.close()
 
-    # Process results
-    all_masks = []
-    mask_metadata = []
-    frame_num = 0
-    for batch_result in results:
-        for frame_masks in batch_result:
-            frame_mask_data = []
-            for i, mask_data in enumerate(frame_masks):
-                mask = mask_data['segmentation'].astype(np.uint8) * 255
-                mask_filename = f"mask_frame{frame_num:04d}_object{i:02d}.png"
-                cv2.imwrite(os.path.join(output_dir, mask_filename), mask)
-                frame_mask_data.append(mask)
-                mask_metadata.append({
-                    'frame': frame_num,
-                    'object_id': i,
-                    'filename': mask_filename,
-                    'bbox': mask_data['bbox'],
-                    'area': float(mask_data['area']),
-                    'stability_score': float(mask_data['stability_score'])
-                })
-            all_masks.append(frame_mask_data)
+    return total_process_time
 
-            if frame_num % 30 == 0:
-                progress = (frame_num + 1) / frame_count * 100
-                print(f"Processing progress: {progress:.2f}%")
-            
-            frame_num += 1
 
-    # Save metadata as JSON
-    with open(os.path.join(output_dir, 'mask_metadata.json'), 'w') as f:
-        json.dump(mask_metadata, f, indent=2)
+def scale_masks(small_masks, small_shape, original_size, resize_factor, overlap="smaller-on-top"):
+    # Tracked masks as one label map at original size, plus their scaled metadata
+    labels = upscale_labels(paint_labels(small_masks, small_shape, overlap=overlap), original_size)
+    frame_masks = []
+    for mask in small_masks:
+        x1, y1, x2, y2 = mask['bbox']
+        frame_masks.append({
+            'bbox': [int(x1 / resize_factor), int(y1 / resize_factor), int(x2 / resize_factor), int(y2 / resize_factor)],
+            'area': mask['area'] / (resize_factor ** 2),
+            'stability_score': float(mask['stability_score']),
+            'object_id': mask['object_id']
+        })
+    return labels, frame_masks
+
+
+def segment_with_keyframes(video_path, object_count, frame_count, writer, max_frames=None, resize_factor=0.5,
+                           keyframe_interval=15, scene_threshold=0.3, refine=True,
+                           mask_generator=None, predictor=None, progress_callback=None, backend="eager", quantize=False,
+                           overlap="smaller-on-top"):
+    # Full automatic mask generation only on keyframes (every keyframe_interval frames or on a
+    # scene change); the frames in between get the previous masks warped by optical flow and,
+    # with refine, re-fitted by SamPredictor from box prompts. Object IDs come from IoU matching.
+    if mask_generator is None or (refine and predictor is None):
+        mask_generator, predictor = load_models(backend, quantize)
+    print(f"Segmenting {frame_count} frames from keyframes (interval {keyframe_interval}, scene threshold {scene_threshold})")
+
+    tracker = ObjectTracker()
+    frames_done = 0
+    total_process_time = 0
+    prev_gray = None
+    last_keyframe = None
+    keyframes = 0
+    for frame_num, frame, original_size in iter_frames(video_path, max_frames):
+        start_time = time.time()
+        with metrics.stage("resize"):
+            h, w = frame.shape[:2]
+            small_frame = cv2.resize(frame, (int(w * resize_factor), int(h * resize_factor)))
+            gray = to_gray(small_frame)
+
+        is_keyframe = prev_gray is None or frame_num - last_keyframe >= keyframe_interval
+        if not is_keyframe:
+            score = scene_change_score(prev_gray, gray)
+            is_keyframe = score > scene_threshold
+            if is_keyframe:
+                print(f"Scene change at frame {frame_num} (score {score:.2f})")
+
+        try:
+            if prev_gray is not None:
+                with metrics.stage("propagate", items=0):  # Counted as a frame by the tracking below
+                    flow = compute_flow(prev_gray, gray)
+            if is_keyframe:
+                with metrics.stage("inference"):
+                    masks = mask_generator.generate(small_frame)
+                top_masks = sorted(masks, key=lambda x: x['area'], reverse=True)[:object_count]
+                if prev_gray is not None:
+                    tracker.propagate(flow)  # Match against where the objects are now
+                small_masks = tracker.assign(top_masks)
+                last_keyframe = frame_num
+                keyframes += 1
+            else:
+                with metrics.stage("propagate"):
+                    if refine:
+                        predictor.set_image(small_frame)
+                    small_masks = tracker.propagate(flow, predictor if refine else None)
+
+            with metrics.stage("postprocess"):
+                frame_masks = scale_masks(small_masks, small_frame.shape[:2], original_size, resize_factor, overlap)
+        except Exception as e:
+            print(f"Error processing frame {frame_num}: {str(e)}")
+            traceback.print_exc()
+            frame_masks = None
+        prev_gray = gray
+
+        process_time = time.time() - start_time
+        total_process_time += process_time
+        writer.add(frame_num, frame_masks)
+        frames_done += 1
+        print(f"Processed {'keyframe' if is_keyframe else 'frame'} {frame_num} in {process_time:.2f} seconds")
+        if progress_callback is not None:
+            progress_callback(frames_done, frame_count)
+
+    print(f"Ran automatic mask generation on {keyframes}/{frames_done} frames")
+    return total_process_time
 
-    # Create a video of all masks combined
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(os.path.join(output_dir, 'combined_masks.mp4'), fourcc, fps, (width, height), isColor=False)
-    for frame_masks in all_masks:
-        combined_mask = np.zeros((height, width), dtype=np.uint8)
-        for mask in frame_masks:
-            combined_mask = np.maximum(combined_mask, mask)
-        out.write(combined_mask)
-    out.release()
+
+def segment_with_seeds(video_path, object_count, frame_count, writer, max_frames=None, resize_factor=0.5, scene_threshold=0.3,
+                       points_per_side=8, reseed_interval=30, predictor=None, progress_callback=None,
+                       backend="eager", quantize=False, overlap="smaller-on-top"):
+    # Fast automatic masks: a coarse grid on the first frame, then only prompts seeded by the
+    # previous frame's kept masks (see fast_auto.SeededMaskGenerator). Frames run in order since
+    # each one seeds the next. Object IDs come from IoU matching.
+    from fast_auto import SeededMaskGenerator
+    if predictor is None:
+        predictor = load_model(manual=True, backend=backend, quantize=quantize)
+    generator = SeededMaskGenerator(predictor, object_count, points_per_side=points_per_side, reseed_interval=reseed_interval)
+    print(f"Segmenting {frame_count} frames from seeded prompts ({points_per_side}x{points_per_side} grid, "
+          f"reseed every {reseed_interval} frames)")
+
+    tracker = ObjectTracker()
+    frames_done = 0
+    total_process_time = 0
+    prev_gray = None
+    for frame_num, frame, original_size in iter_frames(video_path, max_frames):
+        start_time = time.time()
+        with metrics.stage("resize"):
+            h, w = frame.shape[:2]
+            small_frame = cv2.resize(frame, (int(w * resize_factor), int(h * resize_factor)))
+            gray = to_gray(small_frame)
+        if prev_gray is not None:
+            score = scene_change_score(prev_gray, gray)
+            if score > scene_threshold:
+                print(f"Scene change at frame {frame_num} (score {score:.2f})")
+                generator.reseed()
+        prev_gray = gray
+
+        try:
+            with metrics.stage("inference"):
+                masks = generator.generate(small_frame)
+            with metrics.stage("postprocess"):
+                frame_masks = scale_masks(tracker.assign(masks), small_frame.shape[:2], original_size, resize_factor, overlap)
+        except Exception as e:
+            print(f"Error processing frame {frame_num}: {str(e)}")
+            traceback.print_exc()
+            frame_masks = None
+            generator.reseed()
+
+        process_time = time.time() - start_time
+        total_process_time += process_time
+        writer.add(frame_num, frame_masks)
+        frames_done += 1
+        print(f"Processed frame {frame_num} in {process_time:.2f} seconds")
+        if progress_callback is not None:
+            progress_callback(frames_done, frame_count)
+
+    print(f"Prompted {generator.grid_frames} frames from the grid and {generator.seeded_frames} from the previous masks")
+    return total_process_time
+
+
+def auto_segment(video_path, object_count, num_processes=None, max_frames=None, resize_factor=0.5, queue_depth=None,
+                 transport="shm", mask_generator=None, output_dir="segmentation_output", progress_callback=None,
+                 mask_format="container", mode="full", keyframe_interval=15, scene_threshold=0.3, predictor=None,
+                 pool=None, worker_loading="shared", threads_per_worker=None, backend="eager", quantize=False,
+                 points_per_side=8, reseed_interval=30, reorder_window=None, overlap="smaller-on-top"):
+    # Every frame's masks are kept as one label map; overlap (see label_map.OVERLAP_POLICIES)
+    # decides which object keeps a pixel claimed by several
+    if overlap not in OVERLAP_POLICIES:
+        raise ValueError(f"Unknown overlap policy: {overlap}")
+    start_time = time.time()
+
+    frame_count, fps, original_size = get_video_properties(video_path)
+    if max_frames is not None:
+        frame_count = min(frame_count, max_frames)
+
+    os.makedirs(output_dir, exist_ok=True)
+    # Masks are written in frame order as they come in rather than after the whole clip
+    writer = AutoMaskWriter(output_dir, original_size, fps, frame_count, mask_format)
+
+    segment_start_time = time.time()
+    try:
+        if mode == "full":
+            total_process_time = segment_with_workers(
+                video_path, object_count, frame_count, original_size, writer, num_processes, max_frames, resize_factor,
+                queue_depth, transport, mask_generator, progress_callback, pool, worker_loading, threads_per_worker,
+                backend, quantize, reorder_window, overlap)
+        elif mode == "keyframe":
+            total_process_time = segment_with_keyframes(
+                video_path, object_count, frame_count, writer, max_frames, resize_factor, keyframe_interval,
+                scene_threshold, mask_generator=mask_generator, predictor=predictor, progress_callback=progress_callback,
+                backend=backend, quantize=quantize, overlap=overlap)
+            transport = "in-process"
+        elif mode == "fast":
+            total_process_time = segment_with_seeds(
+                video_path, object_count, frame_count, writer, max_frames, resize_factor, scene_threshold,
+                points_per_side, reseed_interval, predictor=predictor, progress_callback=progress_callback,
+                backend=backend, quantize=quantize, overlap=overlap)
+            transport = "in-process"
+        else:
+            raise ValueError(f"Unknown mode: {mode}")
+    except BaseException:
+        writer.close(complete=False)  # Keep what was written readable
+        raise
+    writer.close()
+    segment_time = time.time() - segment_start_time
+    frames_processed = writer.frames_processed
+    if writer.max_pending > 1:
+        print(f"Reorder buffer peaked at {writer.max_pending} frames")
 
     end_time = time.time()
     total_time = end_time - start_time
-    frames_processed = sum(len(batch) for batch in batches)
     frames_per_second = frames_processed / total_process_time if total_process_time > 0 else 0
 
     print(f"Segmentation complete. Output saved to {output_dir}")
@@ -230,66 +788,361 @@ def auto_segment(video_path, object_count, num_processes=None, max_frames=None,
     print(f"Total segmentation time: {total_process_time:.2f} seconds")
     print(f"Frames processed: {frames_processed}")
     print(f"Frames per second (during segmentation): {frames_per_second:.2f}")
+    print(f"Frames per second (end to end, {mode} mode, {transport} transport): {frames_processed / segment_time if segment_time > 0 else 0:.2f}")
+    metrics.counter("frames_total", "Frames segmented", task="auto", mode=mode).inc(frames_processed)
+    metrics.counter("jobs_total", "Completed jobs", task="auto", mode=mode).inc()
+    metrics.histogram("job_seconds", "Wall time per job", task="auto", mode=mode).observe(total_time)
+    print("Stage timings (this process, including workers' results):")
+    metrics.REGISTRY.report()
     
     return output_dir, total_time, frames_per_second
 
 
-def manual_segment(video_path, mask_path, batch_size=32, skip_frames=2):
-    predictor = load_model(manual=True)
-    video = cv2.VideoCapture(video_path)
-    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+class AdaptiveFrameSampler(threading.Thread):
+    # Reads the clip sequentially and decides which frames go to SAM. With a budget, frames are
+    # sampled once the accumulated motion since the last sample passes a threshold that adapts to
+    # keep the sampled fraction at or below the budget; scene cuts are sampled first whenever the
+    # budget allows. Without a budget every skip_frames-th frame is sampled.
+    # Queued items are (frame_num, frame, None) for sampled frames and (frame_num, None, flow)
+    # for skipped ones, where flow is the low-resolution backward flow from the previous frame.
+    def __init__(self, video_path, frame_queue, skip_frames=2, budget=None, scene_threshold=0.3, analysis_width=320):
+        super().__init__(daemon=True)
+        self.video_path = video_path
+        self.frame_queue = frame_queue
+        self.skip_frames = skip_frames
+        self.budget = budget
+        self.scene_threshold = scene_threshold
+        self.analysis_width = analysis_width
+        self.motion_threshold = 0.02
+        self.frames_read = 0
+        self.frames_sampled = 0
+        self.stop_event = threading.Event()
+
+    def should_sample(self, frame_num, prev_gray, gray, accumulated_motion):
+        if prev_gray is None:
+            return True
+        if self.budget is None:
+            return frame_num % self.skip_frames == 0
+        if self.frames_sampled + 1 > self.budget * (frame_num + 1):
+            return False  # Over budget, whatever the content does
+        if scene_change_score(prev_gray, gray) > self.scene_threshold:
+            return True
+        return accumulated_motion >= self.motion_threshold
+
+    def run(self):
+        video = cv2.VideoCapture(self.video_path)
+        prev_gray = None
+        accumulated_motion = 0.0
+        try:
+            while not self.stop_event.is_set():
+                start_time = time.perf_counter()
+                ret, frame = video.read()
+                if not ret:
+                    break
+                h, w = frame.shape[:2]
+                scale = min(1.0, self.analysis_width / w)
+                gray = cv2.cvtColor(cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+                if prev_gray is not None:
+                    accumulated_motion += motion_score(prev_gray, gray)
+
+                frame_num = self.frames_read
+                if self.should_sample(frame_num, prev_gray, gray, accumulated_motion):
+                    item = (frame_num, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), None)
+                    self.frames_sampled += 1
+                    accumulated_motion = 0.0
+                else:
+                    item = (frame_num, None, compute_flow(prev_gray, gray))
+                if self.budget is not None:
+                    # Nudge the threshold so the sampled fraction tracks the budget
+                    if self.frames_sampled / (frame_num + 1) > self.budget:
+                        self.motion_threshold *= 1.05
+                    else:
+                        self.motion_threshold /= 1.05
+                metrics.observe_stage("decode", time.perf_counter() - start_time)
+                self.frame_queue.put(item)
+                prev_gray = gray
+                self.frames_read += 1
+        finally:
+            video.release()
+            self.frame_queue.put(None)
+
+
+class ManualMaskWriter:
+    # Writes masks in frame order as they arrive. Skipped frames get the previous frame's mask
+    # warped by optical flow, so nothing but the last written mask is kept in memory.
+    def __init__(self, output_dir, fps):
+        self.output_dir = output_dir
+        self.fps = fps
+        self.video = None
+        self.store = None
+        self.prev_mask = None
+        self.next_frame = 0
+
+    def _open(self, mask):
+        height, width = mask.shape[:2]
+        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        self.video = cv2.VideoWriter(os.path.join(self.output_dir, 'combined_masks.mp4'), fourcc, self.fps, (width, height), isColor=False)
+        self.store = MaskStoreWriter(os.path.join(self.output_dir, MASK_STORE_FILENAME), (width, height), self.fps)
+
+    def _write(self, mask):
+        self.video.write(mask)
+        segmentation = mask > 127
+        bbox = mask_bbox(segmentation)
+        masks = []
+        if bbox is not None:
+            masks.append({'segmentation': segmentation, 'bbox': bbox, 'area': int(segmentation.sum()),
+                          'stability_score': 1.0, 'object_id': 0})
+        self.store.write_frame(self.next_frame, masks)
+        self.prev_mask = mask
+        self.next_frame += 1
+
+    def add(self, mask):
+        mask = np.squeeze(mask).astype(np.uint8)
+        if self.video is None:
+            self._open(mask)
+        self._write(mask)
+
+    def add_skipped(self, flow):
+        height, width = self.prev_mask.shape[:2]
+        warped = warp_mask(self.prev_mask > 127, upscale_flow(flow, (width, height)))
+        self._write(warped.astype(np.uint8) * 255)
+
+    def close(self, complete=True):
+        if self.video is not None:
+            self.video.release()
+            self.store.close()
+            metrics.write_atomic(os.path.join(self.output_dir, 'mask_objects.json'), json.dumps(
+                {'mask_store': MASK_STORE_FILENAME, 'object_ids': [0], 'complete': complete}))
+
+
+def manual_segment(video_path, mask_path, batch_size=32, skip_frames=2, predictor=None, progress_callback=None,
+                   cache=None, output_dir="manual_segmentation_output", queue_depth=None, budget=None,
+                   scene_threshold=0.3, backend="eager", quantize=False, encoder_batch_size=ENCODER_BATCH_SIZE):
+    if predictor is None:
+        predictor = load_model(manual=True, backend=backend, quantize=quantize)
+    video_id = video_identity(video_path) if cache is not None else None
+    frame_count, fps, _ = get_video_properties(video_path)
+    if queue_depth is None:
+        queue_depth = batch_size * 2
+    os.makedirs(output_dir, exist_ok=True)
+    start_time = time.time()
     
     user_mask = np.array(Image.open(mask_path).convert('L'))
     rows, cols = np.where(user_mask > 0)
     top, left, bottom, right = np.min(rows), np.min(cols), np.max(rows), np.max(cols)
     input_box = np.array([left, top, right, bottom])
 
-    all_masks = [None] * frame_count
-    
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        for start_frame in range(0, frame_count, batch_size * skip_frames):
-            batch_frames = []
-            batch_indices = []
-            for i in range(start_frame, min(start_frame + batch_size * skip_frames, frame_count), skip_frames):
-                video.set(cv2.CAP_PROP_POS_FRAMES, i)
-                ret, frame = video.read()
-                if not ret:
+    # decode -> bounded queue -> batched inference -> bounded queue -> streaming writer
+    frame_queue = queue.Queue(maxsize=queue_depth)
+    mask_queue = queue.Queue(maxsize=2)
+    errors = []
+
+    def run_inference():
+        try:
+            done = False
+            while not done:
+                item = frame_queue.get()
+                if item is None:
                     break
-                batch_frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-                batch_indices.append(i)
+                batch = [item]
+                sampled = 1 if item[1] is not None else 0
+                # Take whatever else is already decoded, up to batch_size sampled frames
+                while sampled < batch_size:
+                    try:
+                        item = frame_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        done = True
+                        break
+                    batch.append(item)
+                    if item[1] is not None:
+                        sampled += 1
+                batch_indices = [index for index, frame, _ in batch if frame is not None]
+                batch_frames = [frame for _, frame, _ in batch if frame is not None]
+                batch_masks = []
+                if batch_frames:
+                    batch_start = time.perf_counter()
+                    batch_masks = manual_process_batch(batch_frames, predictor, user_mask, input_box,
+                                                       batch_indices, cache, video_id, encoder_batch_size)
+                    metrics.observe_stage("inference", time.perf_counter() - batch_start, len(batch_frames))
+                # Skipped frames travel with the batch so the writer sees every frame in order
+                batch_masks = iter(batch_masks)
+                mask_queue.put([(index, next(batch_masks) if frame is not None else None, flow)
+                                for index, frame, flow in batch])
+        except Exception as e:
+            print(f"Error during inference: {str(e)}")
+            traceback.print_exc()
+            errors.append(e)
+        finally:
+            mask_queue.put(None)
 
-            if not batch_frames:
-                break
+    decoder = AdaptiveFrameSampler(video_path, frame_queue, skip_frames, budget, scene_threshold)
+    inference_thread = threading.Thread(target=run_inference, daemon=True)
+    decoder.start()
+    inference_thread.start()
 
-            future = executor.submit(manual_process_batch, batch_frames, predictor, user_mask, input_box)
-            future_to_indices = (future, batch_indices)
-
-            for future, indices in as_completed([future_to_indices]):
-                batch_masks = future.result()
-                for mask, index in zip(batch_masks, indices):
-                    all_masks[index] = mask
-                    # Interpolate for skipped frames
-                    if skip_frames > 1 and index + skip_frames < frame_count:
-                        next_mask = all_masks[index + skip_frames]
-                        if next_mask is not None:
-                            for j in range(1, skip_frames):
-                                interp_mask = (mask * (skip_frames - j) + next_mask * j) / skip_frames
-                                all_masks[index + j] = interp_mask.astype(np.uint8)
-
-            # Report progress
-            progress = (start_frame + len(batch_frames) * skip_frames) / frame_count * 100
-            print(f"Progress: {progress:.2f}%")
+    writer = ManualMaskWriter(output_dir, fps)
+    while True:
+        item = mask_queue.get()
+        if item is None:
+            break
+        write_start = time.perf_counter()
+        frames_before = writer.next_frame
+        for index, mask, flow in item:
+            if mask is not None:
+                writer.add(mask)
+            else:
+                writer.add_skipped(flow)
+        metrics.observe_stage("write", time.perf_counter() - write_start, writer.next_frame - frames_before)
 
-    video.release()
-    return [mask for mask in all_masks if mask is not None]
+        # Report progress
+        progress = writer.next_frame / max(frame_count, 1) * 100
+        print(f"Progress: {progress:.2f}%")
+        if progress_callback is not None:
+            progress_callback(min(writer.next_frame, frame_count), frame_count)
+
+    if errors:
+        # Unblock the decoder if inference died early
+        decoder.stop_event.set()
+        while decoder.is_alive():
+            try:
+                frame_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    decoder.join()
+    inference_thread.join()
+    writer.close(complete=not errors)
+    if errors:
+        raise errors[0]
+
+    total_time = time.time() - start_time
+    print(f"Manual segmentation complete. Output saved to {output_dir}")
+    print(f"Total processing time: {total_time:.2f} seconds ({writer.next_frame / total_time if total_time > 0 else 0:.2f} fps)")
+    print(f"Segmented {decoder.frames_sampled}/{decoder.frames_read} frames "
+          f"({decoder.frames_sampled / max(decoder.frames_read, 1) * 100:.1f}%)")
+    sampling = "adaptive" if budget is not None else "skip"
+    metrics.counter("frames_total", "Frames segmented", task="manual", mode=sampling).inc(writer.next_frame)
+    metrics.counter("warped_frames_total", "Frames filled by warping the previous mask",
+                    task="manual").inc(writer.next_frame - decoder.frames_sampled)
+    metrics.counter("jobs_total", "Completed jobs", task="manual", mode=sampling).inc()
+    metrics.histogram("job_seconds", "Wall time per job", task="manual", mode=sampling).observe(total_time)
+    metrics.REGISTRY.report(("decode", "inference", "write"))
+    if cache is not None:
+        cache.save()
+        stats = cache.stats()
+        metrics.gauge("embedding_cache_hit_ratio", "Embedding cache hits over lookups").set(stats['hit_rate'])
+        metrics.gauge("embedding_cache_bytes", "Size of the embedding cache on disk").set(stats['bytes'])
+        print(f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+              f"({stats['hit_rate'] * 100:.1f}% hit rate, {stats['bytes'] / 1024 / 1024:.1f} MB cached)")
+    return output_dir
 
 if __name__ == "__main__":
-    mode = sys.argv[1]
-    if mode == "auto":
-        video_path = str(sys.argv[2])
-        object_count = int(sys.argv[3])
-        auto_segment(video_path, object_count)
-    elif mode == "manual":
-        video_path = str(sys.argv[2])
-        mask_path = sys.argv[3]
-        manual_segment(video_path, mask_path)
+    parser = argparse.ArgumentParser(description="SegmentFX video segmentation")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    auto_parser = subparsers.add_parser("auto")
+    auto_parser.add_argument("video_path")
+    auto_parser.add_argument("object_count", type=int)
+    auto_parser.add_argument("--num-processes", type=int, default=None)
+    auto_parser.add_argument("--max-frames", type=int, default=None)
+    auto_parser.add_argument("--transport", choices=["shm", "queue"], default="shm",
+                             help="How frames and masks move between the parent and the workers")
+    auto_parser.add_argument("--mode", dest="auto_mode", choices=["full", "keyframe", "fast"], default="full",
+                             help="Automatic mask generation on every frame, only on keyframes with tracking in between, "
+                                  "or prompted from the previous frame's masks")
+    auto_parser.add_argument("--keyframe-interval", type=int, default=15)
+    auto_parser.add_argument("--scene-threshold", type=float, default=0.3)
+    auto_parser.add_argument("--grid-points", type=int, default=8,
+                             help="Fast mode: points per side of the grid used to find objects")
+    auto_parser.add_argument("--reseed-interval", type=int, default=30,
+                             help="Fast mode: prompt from the grid again after this many frames")
+    auto_parser.add_argument("--worker-loading", choices=["shared", "per-worker"], default="shared",
+                             help="Load the model once and share it with the workers, or load it in every worker")
+    auto_parser.add_argument("--threads-per-worker", type=int, default=None,
+                             help="Torch threads per worker (default: the cores divided between the workers)")
+    auto_parser.add_argument("--mask-format", choices=["container", "png"], default="container",
+                             help="Single-file mask container, or one PNG per object per frame")
+    auto_parser.add_argument("--overlap", choices=OVERLAP_POLICIES, default="smaller-on-top",
+                             help="Which object keeps the pixels where masks overlap")
+
+    manual_parser = subparsers.add_parser("manual")
+    manual_parser.add_argument("video_path")
+    manual_parser.add_argument("mask_path")
+    manual_parser.add_argument("--skip-frames", type=int, default=2, help="Segment every Nth frame and warp masks into the rest")
+    manual_parser.add_argument("--budget", type=float, default=None,
+                               help="Sample adaptively by motion and scene cuts, segmenting at most this fraction of frames (e.g. 0.2)")
+    manual_parser.add_argument("--no-cache", action="store_true", help="Do not read or write cached image embeddings")
+    manual_parser.add_argument("--cache-size-mb", type=int, default=None, help="Embedding cache size limit")
+
+    manual_parser.add_argument("--encoder-batch-size", type=int, default=ENCODER_BATCH_SIZE,
+                               help="Frames per image-encoder call")
+
+    for mode_parser in (auto_parser, manual_parser):
+        mode_parser.add_argument("--local", action="store_true",
+                                 help="Run in this process instead of submitting to the segmentation server")
+        mode_parser.add_argument("--backend", choices=["eager", "torchscript", "onnx"], default="eager",
+                                 help="Inference backend for --local runs (the server uses its own --backend)")
+        mode_parser.add_argument("--quantize", action="store_true",
+                                 help="int8 weights for the encoder and decoder in --local runs")
+        mode_parser.add_argument("--progress-file", default=None,
+                                 help="JSON file kept up to date with progress, throughput and ETA (for the panel)")
+        mode_parser.add_argument("--metrics-dir", default=None,
+                                 help=f"Write stage metrics here as JSON lines and a Prometheus textfile "
+                                      f"(default: ${metrics.METRICS_DIR_ENV})")
+
+    args = parser.parse_args()
+    progress = metrics.ProgressTracker(args.mode, path=args.progress_file) if args.progress_file else None
+    if args.local:
+        try:
+            if args.mode == "auto":
+                output_dir, _, _ = auto_segment(
+                    args.video_path, args.object_count, num_processes=args.num_processes,
+                    max_frames=args.max_frames, transport=args.transport, mask_format=args.mask_format,
+                    mode=args.auto_mode, keyframe_interval=args.keyframe_interval, scene_threshold=args.scene_threshold,
+                    worker_loading=args.worker_loading, threads_per_worker=args.threads_per_worker,
+                    backend=args.backend, quantize=args.quantize, points_per_side=args.grid_points,
+                    reseed_interval=args.reseed_interval, overlap=args.overlap, progress_callback=progress)
+            elif args.mode == "manual":
+                cache = None
+                if not args.no_cache:
+                    cache = EmbeddingCache() if args.cache_size_mb is None else EmbeddingCache(max_bytes=args.cache_size_mb * 1024 * 1024)
+                output_dir = manual_segment(args.video_path, args.mask_path, skip_frames=args.skip_frames, cache=cache,
+                                            budget=args.budget, backend=args.backend, quantize=args.quantize,
+                                            encoder_batch_size=args.encoder_batch_size, progress_callback=progress)
+        except Exception as e:
+            if progress is not None:
+                progress.finish("error", error=str(e))
+            raise
+        finally:
+            metrics.export(args.metrics_dir, "segmentation", task=args.mode, video_path=os.path.abspath(args.video_path))
+        if progress is not None:
+            progress.finish(output_dir=os.path.abspath(output_dir))
+    else:
+        # Thin client: the server keeps the model warm between jobs
+        from segmentation_server import submit_job
+        job = {"mode": args.mode, "video_path": os.path.abspath(args.video_path)}
+        if args.mode == "auto":
+            job.update({"object_count": args.object_count, "max_frames": args.max_frames, "mask_format": args.mask_format,
+                        "auto_mode": args.auto_mode, "keyframe_interval": args.keyframe_interval,
+                        "scene_threshold": args.scene_threshold, "grid_points": args.grid_points,
+                        "reseed_interval": args.reseed_interval, "overlap": args.overlap,
+                        "output_dir": os.path.abspath("segmentation_output")})
+        elif args.mode == "manual":
+            job.update({"mask_path": os.path.abspath(args.mask_path), "use_cache": not args.no_cache,
+                        "skip_frames": args.skip_frames, "budget": args.budget,
+                        "output_dir": os.path.abspath("manual_segmentation_output")})
+        if metrics.metrics_dir(args.metrics_dir):
+            job["metrics_dir"] = os.path.abspath(metrics.metrics_dir(args.metrics_dir))
+        result = None
+        for message in submit_job(job):
+            print(json.dumps(message), flush=True)
+            if progress is not None and message.get("status") == "progress":
+                progress.update(message["done"], message["total"])
+            result = message
+        if result is None or result.get("status") != "complete":
+            if progress is not None:
+                progress.finish("error", error=(result or {}).get("error", "No result from the segmentation server"))
+            sys.exit(1)
+        if progress is not None:
+            progress.finish(output_dir=result["output_dir"])
@@ -0,0 +1,243 @@
+import hmac
+import json
+import os
+import secrets
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+import segmentation
+from embedding_cache import EmbeddingCache
+from worker_pool import SegmentationWorkerPool
+
+HOST = "127.0.0.1"
+PORT = int(os.environ.get("SEGMENTFX_PORT", 8765))
+STARTUP_TIMEOUT = 120  # seconds to wait for a freshly started server to load the model
+# Every request must carry the token the running server wrote here (readable by this user only),
+# so other local users and processes cannot submit jobs or shut the server down
+STATE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "segmentfx")
+TOKEN_FILENAME = "server_token_{}"
+LOG_FILENAME = "segmentation_server.log"
+
+
+def token_path(port=PORT):
+    return os.path.join(STATE_DIR, TOKEN_FILENAME.format(port))
+
+
+def write_token(port=PORT):
+    token = secrets.token_hex(32)
+    os.makedirs(STATE_DIR, exist_ok=True)
+    path = token_path(port)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    os.replace(tmp_path, path)
+    return token
+
+
+def read_token(port=PORT):
+    try:
+        with open(token_path(port)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+class SegmentationService:
+    # Holds the warm models. Jobs run one at a time since they share the same weights. Full auto
+    # jobs fan out over a worker pool that maps the same shared-memory copy of the weights.
+    def __init__(self, num_workers=None, backend="eager", quantize=False, metrics_dir=None):
+        self.pool = SegmentationWorkerPool(num_workers, backend=backend, quantize=quantize)
+        self.metrics_dir = metrics_dir
+        self.mask_generator = None
+        self.predictor = None
+        self.embedding_cache = EmbeddingCache()
+        self.job_lock = threading.Lock()
+
+    def load(self):
+        # The workers are started before this process runs any inference
+        start_time = time.time()
+        self.mask_generator, self.predictor = self.pool.generators()
+        print(f"Segmentation server loaded model in {time.time() - start_time:.2f} seconds", flush=True)
+
+    def run_job(self, job, send):
+        tracker = metrics.ProgressTracker(job["mode"])
+
+        def report_progress(done, total):
+            tracker.update(done, total)
+            snapshot = tracker.snapshot()
+            send({"status": "progress", "done": done, "total": total, "progress": snapshot["progress"],
+                  "rate": snapshot["rate"], "eta_seconds": snapshot["eta_seconds"]})
+
+        with self.job_lock:
+            try:
+                return self._run_job(job, send, report_progress)
+            finally:
+                # Metrics accumulate over the server's lifetime; every job appends a snapshot
+                metrics.export(job.get("metrics_dir") or self.metrics_dir, "segmentation_server", task=job["mode"],
+                               video_path=job.get("video_path"))
+
+    def _run_job(self, job, send, report_progress):
+        send({"status": "loading", "message": f"Starting {job['mode']} segmentation..."})
+        start_time = time.time()
+        if job["mode"] == "auto":
+            output_dir, total_time, frames_per_second = segmentation.auto_segment(
+                job["video_path"], int(job["object_count"]),
+                max_frames=job.get("max_frames"),
+                mask_generator=self.mask_generator,
+                output_dir=job.get("output_dir", "segmentation_output"),
+                mask_format=job.get("mask_format", "container"),
+                mode=job.get("auto_mode", "full"),
+                keyframe_interval=job.get("keyframe_interval", 15),
+                scene_threshold=job.get("scene_threshold", 0.3),
+                points_per_side=job.get("grid_points", 8),
+                reseed_interval=job.get("reseed_interval", 30),
+                overlap=job.get("overlap", "smaller-on-top"),
+                predictor=self.predictor,
+                pool=self.pool,
+                progress_callback=report_progress)
+        elif job["mode"] == "manual":
+            output_dir = segmentation.manual_segment(
+                job["video_path"], job["mask_path"],
+                skip_frames=job.get("skip_frames", 2),
+                budget=job.get("budget"),
+                predictor=self.predictor,
+                progress_callback=report_progress,
+                cache=self.embedding_cache if job.get("use_cache", True) else None,
+                output_dir=job.get("output_dir", "manual_segmentation_output"))
+        else:
+            raise ValueError(f"Unknown mode: {job['mode']}")
+        result = {"status": "complete", "output_dir": output_dir, "total_time": time.time() - start_time}
+        if job["mode"] == "manual":
+            result["embedding_cache"] = self.embedding_cache.stats()
+        return result
+
+
+class SegmentationRequestHandler(socketserver.StreamRequestHandler):
+    # One JSON job per connection; progress and the final result are streamed back as JSON lines
+    def handle(self):
+        def send(message):
+            self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            job = json.loads(self.rfile.readline().decode("utf-8"))
+            if not hmac.compare_digest(str(job.pop("token", "")), self.server.token):
+                print("Rejected a request without a valid token", flush=True)
+                send({"status": "unauthorized", "error": "Invalid or missing server token"})
+                return
+            if job.get("mode") == "ping":
+                send({"status": "ok", "pid": os.getpid()})
+            elif job.get("mode") == "shutdown":
+                send({"status": "ok"})
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            else:
+                send(self.server.service.run_job(job, send))
+        except (BrokenPipeError, ConnectionResetError):
+            print("Client disconnected before the job finished", flush=True)
+        except Exception as e:
+            traceback.print_exc()
+            try:
+                send({"status": "error", "error": str(e)})
+            except OSError:
+                pass
+
+
+class SegmentationServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, service, host=HOST, port=PORT):
+        super().__init__((host, port), SegmentationRequestHandler)
+        self.service = service
+        # Written once the port is ours, so clients never pick up the token of a server that failed to bind
+        self.token = write_token(port)
+
+    def server_close(self):
+        super().server_close()
+        if read_token(self.server_address[1]) == self.token:
+            os.remove(token_path(self.server_address[1]))
+
+
+def send_request(job, host=HOST, port=PORT, timeout=None):
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        job = dict(job, token=read_token(port) or "")
+        sock.sendall((json.dumps(job) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as stream:
+            for line in stream:
+                yield json.loads(line)
+    finally:
+        sock.close()
+
+
+def is_server_running(host=HOST, port=PORT):
+    try:
+        return any(message.get("status") == "ok" for message in send_request({"mode": "ping"}, host, port, timeout=2))
+    except OSError:
+        return False
+
+
+def start_server(host=HOST, port=PORT):
+    # Detach so the server outlives the client (and the panel click) that started it. Its output,
+    # model-load errors and crashes included, goes to a log next to the token
+    command = [sys.executable, os.path.abspath(__file__), "--host", host, "--port", str(port)]
+    os.makedirs(STATE_DIR, exist_ok=True)
+    log_path = os.path.join(STATE_DIR, LOG_FILENAME)
+    log = open(log_path, "a")
+    kwargs = {"stdout": log, "stderr": subprocess.STDOUT, "stdin": subprocess.DEVNULL}
+    if os.name == "nt":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs["start_new_session"] = True
+    try:
+        process = subprocess.Popen(command, **kwargs)
+    finally:
+        log.close()  # The server has its own handle
+
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        if is_server_running(host, port):
+            return True
+        if process.poll() is not None:
+            print(f"Segmentation server exited with code {process.returncode}, see {log_path}", file=sys.stderr)
+            return False
+        time.sleep(0.5)
+    print(f"Segmentation server did not start within {STARTUP_TIMEOUT} seconds, see {log_path}", file=sys.stderr)
+    return False
+
+
+def submit_job(job, host=HOST, port=PORT, autostart=True):
+    if not is_server_running(host, port):
+        if not autostart or not start_server(host, port):
+            yield {"status": "error", "error": f"Segmentation server is not reachable on {host}:{port}"}
+            return
+    yield from send_request(job, host, port)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="SegmentFX segmentation server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=None, help="Automatic segmentation worker processes")
+    parser.add_argument("--backend", choices=["eager", "torchscript", "onnx"], default="eager",
+                        help="Inference backend for the image encoder and mask decoder")
+    parser.add_argument("--quantize", action="store_true", help="int8 weights for the encoder and decoder")
+    parser.add_argument("--metrics-dir", default=None,
+                        help=f"Export metrics here after every job (default: ${metrics.METRICS_DIR_ENV})")
+    args = parser.parse_args()
+
+    service = SegmentationService(args.workers, args.backend, args.quantize, args.metrics_dir)
+    service.load()
+    # The socket only opens once the model is warm, so a successful ping means jobs will run immediately
+    with SegmentationServer(service, args.host, args.port) as server:
+        print(f"Segmentation server listening on {args.host}:{args.port}", flush=True)
+        server.serve_forever()
@@ -0,0 +1,232 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+from frame_ring import SharedFrameRing
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+RING_IDLE_SECONDS = 5  # Detach from a finished job's frame ring after this long without tasks
+
+
+def default_worker_count():
+    return max(1, multiprocessing.cpu_count() - 2)  # Leave two CPUs free
+
+
+def start_method():
+    # fork hands the loaded weights to the workers without pickling anything. macOS and Windows
+    # spawn instead; torch.multiprocessing then pickles the shared tensors as shared-memory handles.
+    if sys.platform != "darwin" and "fork" in multiprocessing.get_all_start_methods():
+        return "fork"
+    return "spawn"
+
+
+def memory_usage_mb(pid=None):
+    # (rss, pss) in MB. RSS counts the shared weights in every process that maps them; PSS splits
+    # shared pages between those processes, so summing PSS gives the real footprint (Linux only).
+    pid = pid or os.getpid()
+    try:
+        values = {}
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    values[key] = int(rest.split()[0]) / 1024
+        return values.get("Rss"), values.get("Pss")
+    except (OSError, ValueError):
+        pass
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss / 1024 / 1024, None
+        except psutil.Error:
+            pass
+    return None, None
+
+
+def report_memory(pids, label):
+    usage = [memory_usage_mb(pid) for pid in pids]
+    rss = [r for r, _ in usage if r is not None]
+    pss = [p for _, p in usage if p is not None]
+    if not rss:
+        print(f"Memory ({label}): not available on this platform")
+        return None
+    line = f"Memory ({label}, {len(pids)} processes): RSS {sum(rss):.0f} MB total, {max(rss):.0f} MB max"
+    metrics.gauge("memory_rss_bytes", "Summed RSS of the segmentation processes").set(sum(rss) * 1024 * 1024)
+    if len(pss) == len(usage):
+        line += f", PSS {sum(pss):.0f} MB total"
+        metrics.gauge("memory_pss_bytes", "Summed PSS of the segmentation processes").set(sum(pss) * 1024 * 1024)
+    print(line)
+    return sum(pss) if len(pss) == len(usage) else sum(rss)
+
+
+def pool_worker(worker_id, model, task_queue, result_queue, threads, backend="eager", quantize=False):
+    # Runs in a pool process. Tasks carry their job's settings, so the same worker serves one
+    # video after another without restarting:
+    # (job_id, object_count, resize_factor, ring_info, overlap, frame_num, slot or frame, original_size)
+    from mobile_sam import SamAutomaticMaskGenerator
+    from segmentation import build_sam, segment_frame, set_torch_threads
+
+    set_torch_threads(threads)
+    if model is None:
+        model = build_sam(backend, quantize)  # Exported graphs that could not be handed over
+    mask_generator = SamAutomaticMaskGenerator(model)
+    ring = None
+    print(f"Worker {worker_id} ready ({threads} torch threads)", flush=True)
+    while True:
+        try:
+            task = task_queue.get(timeout=RING_IDLE_SECONDS)
+        except queue.Empty:
+            if ring is not None:
+                ring.close()  # The job is over; let its shared memory go
+                ring = None
+            continue
+        if task is None:
+            break
+        job_id, object_count, resize_factor, ring_info, overlap, frame_num, payload, original_size = task
+        result_key = frame_num
+        try:
+            labels = None
+            if ring_info is not None:
+                if ring is None or ring.info() != ring_info:
+                    if ring is not None:
+                        ring.close()
+                    ring = SharedFrameRing.attach(ring_info)
+                frame = ring.frames[payload]
+                labels = ring.labels[payload]
+                result_key = (frame_num, payload)  # The parent frees the slot once it has read the labels
+            else:
+                frame = payload
+            timings = {}
+            labels, masks = segment_frame(mask_generator, frame, object_count, resize_factor, original_size, labels, timings,
+                                          overlap)
+            result_queue.put((job_id, result_key, (labels if ring_info is None else None, masks), timings))
+        except Exception as e:
+            print(f"Worker {worker_id} error processing frame {frame_num}: {str(e)}")
+            traceback.print_exc()
+            result_queue.put((job_id, result_key, None, {}))
+    if ring is not None:
+        ring.close()
+    print(f"Worker {worker_id} finishing", flush=True)
+
+
+class SegmentationWorkerPool:
+    # Loads MobileSAM once in this process, moves the weights to shared memory and starts the
+    # workers from it, so N workers cost one checkpoint read and one copy of the weights. The
+    # workers stay up between videos; jobs run one at a time.
+    #
+    # The workers are started before this process runs any inference, so they do not inherit
+    # a busy intra-op thread pool. Each worker gets its own share of the cores for torch.
+    def __init__(self, num_workers=None, threads_per_worker=None, queue_depth=None, model=None, backend="eager",
+                 quantize=False):
+        self.num_workers = num_workers or default_worker_count()
+        self.threads_per_worker = threads_per_worker or max(1, multiprocessing.cpu_count() // self.num_workers)
+        self.queue_depth = queue_depth or self.num_workers * 2
+        self.model = model
+        self.backend = backend
+        self.quantize = quantize
+        self.context = multiprocessing.get_context(start_method())
+        self.processes = []
+        self.task_queue = None
+        self.result_queue = None
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()  # Held for the duration of a job
+        self.load_seconds = 0.0
+        self.start_seconds = None
+
+    def start(self):
+        if self.processes:
+            return self
+        start_time = time.time()
+        if self.model is None:
+            from segmentation import build_sam
+            self.model = build_sam(self.backend, self.quantize)
+            self.model.eval()
+            self.load_seconds = time.time() - start_time
+        self.model.share_memory()
+        if self.context.get_start_method() != "fork":
+            try:
+                import torch.multiprocessing  # Registers the reductions that pickle tensors as shared-memory handles
+            except ImportError:
+                pass  # A model that runs without torch (the benchmark stub) has no tensors to share
+        self.task_queue = self.context.Queue(maxsize=self.queue_depth)
+        self.result_queue = self.context.Queue()
+        # TorchScript modules do not pickle, so spawned workers load an exported model themselves
+        # (from the files this process just exported, without another export)
+        worker_model = self.model
+        if self.context.get_start_method() != "fork" and self.backend == "torchscript":
+            worker_model = None
+        for i in range(self.num_workers):
+            p = self.context.Process(target=pool_worker, daemon=True,
+                                     args=(i, worker_model, self.task_queue, self.result_queue, self.threads_per_worker,
+                                           self.backend, self.quantize))
+            p.start()
+            self.processes.append(p)
+        self.start_seconds = time.time() - start_time
+        print(f"Started {self.num_workers} segmentation workers ({self.context.get_start_method()}, "
+              f"{self.threads_per_worker} threads each) in {self.start_seconds:.2f} seconds, "
+              f"model loaded once in {self.load_seconds:.2f} seconds", flush=True)
+        return self
+
+    def generators(self):
+        # Automatic and prompt-based interfaces over this process's copy of the shared weights
+        from mobile_sam import SamAutomaticMaskGenerator, SamPredictor
+        self.start()
+        return SamAutomaticMaskGenerator(self.model), SamPredictor(self.model)
+
+    def begin_job(self):
+        self.lock.acquire()
+        try:
+            self.start()
+        except Exception:
+            self.lock.release()
+            raise
+        return next(self.job_ids)
+
+    def end_job(self):
+        # Frames an abandoned job left in the queue would only be segmented and thrown away
+        try:
+            while True:
+                self.task_queue.get_nowait()
+        except queue.Empty:
+            pass
+        self.lock.release()
+
+    def get_result(self, job_id, timeout=None):
+        # (result_key, (labels, masks), timings) for job_id; late results of earlier jobs are dropped
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.time())
+            result = self.result_queue.get(timeout=remaining)
+            if result[0] == job_id:
+                return result[1:]
+
+    def alive(self):
+        return any(p.is_alive() for p in self.processes)
+
+    def pids(self):
+        return [p.pid for p in self.processes if p.is_alive()]
+
+    def close(self, timeout=30):
+        for _ in self.processes:
+            self.task_queue.put(None)
+        for p in self.processes:
+            p.join(timeout=timeout)
+            if p.is_alive():
+                print(f"Worker process {p.pid} did not finish in time. Terminating.")
+                p.terminate()
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+    Offline benchmarks for the segmentation, effects and cutting paths.
+
+    python -m benchmarks.run_benchmarks --suite quick --output results.json
+    python -m benchmarks.run_benchmarks --suite quick --baseline main.json --threshold 0.15
+
+    Every case runs in its own process on a synthetic clip, so peak memory is measured from a
+    clean start. The runner samples the RSS and PSS of the case's whole process tree (workers
+    included). The model is a deterministic stub unless --model real is given. Results are
+    saved as JSON; with --baseline the run fails when a case's fps drops, or its peak memory
+    grows, by more than --threshold.
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEGMENTFX_PYTHON_DIR = os.path.join(REPO_DIR, 'ClaudeSeg', 'SegmentFx', 'python')
+for path in (REPO_DIR, SEGMENTFX_PYTHON_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from benchmarks import stub_model
+from benchmarks.synthetic_clips import clip_name, make_clip, make_mask
+from worker_pool import memory_usage_mb
+
+SAMPLE_INTERVAL = 0.05  # seconds between memory samples
+CLIP_FPS = 30
+OBJECT_COUNT = 3
+SUITES = {
+    'quick': {'resolutions': [(640, 360)], 'workers': [1, 2], 'frames': 48},
+    'full': {'resolutions': [(640, 360), (1280, 720), (1920, 1080)], 'workers': [1, 2, 4], 'frames': 96},
+}
+BENCHMARKS = ('auto_segment', 'manual_segment', 'process_video', 'cut_video')
+# Metrics compared against a baseline, and whether higher is better
+REGRESSION_METRICS = {'fps': True, 'peak_pss_mb': False}
+
+class StageTimer:
+    # Wraps module functions or class methods for the duration of a case and accumulates their
+    # wall time. Only calls made in the case process are seen, not those in worker processes.
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - start)
+
+        setattr(owner, name, timed)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            calls, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (calls + 1, total + seconds)
+
+    def report(self):
+        return {stage: {'calls': calls, 'total_seconds': total, 'mean_ms': total / calls * 1000}
+                for stage, (calls, total) in self.stages.items()}
+
+def bench_auto_segment(case, clip, work_dir, timer):
+    import segmentation
+    timer.wrap(segmentation, 'get_video_properties', 'probe')
+    for name in ('segment_with_workers', 'segment_with_keyframes', 'segment_with_seeds'):
+        timer.wrap(segmentation, name, 'segment')
+    timer.wrap(segmentation.AutoMaskWriter, 'add', 'write')
+    timer.wrap(segmentation.MaskStoreWriter, 'write_labels', 'write_masks')
+    segmentation.auto_segment(clip, OBJECT_COUNT, num_processes=case['workers'], mode=case['mode'],
+                              output_dir=os.path.join(work_dir, 'auto'))
+    return case['frames']
+
+def bench_manual_segment(case, clip, work_dir, timer):
+    import segmentation
+    timer.wrap(segmentation, 'get_video_properties', 'probe')
+    timer.wrap(segmentation, 'manual_process_batch', 'inference')
+    timer.wrap(segmentation.ManualMaskWriter, 'add', 'write')
+    timer.wrap(segmentation.ManualMaskWriter, 'add_skipped', 'warp')
+    mask_path = make_mask(os.path.join(work_dir, 'user_mask.png'), case['width'], case['height'])
+    segmentation.manual_segment(clip, mask_path, output_dir=os.path.join(work_dir, 'manual'))
+    return case['frames']
+
+def bench_process_video(case, clip, work_dir, timer):
+    import custom_effects
+    timer.wrap(custom_effects, 'keyframe_ranges', 'plan')
+    timer.wrap(custom_effects, 'render_frames', 'render')
+    custom_effects.process_video(clip, case['effect'], {}, os.path.join(work_dir, 'effects'), workers=case['workers'])
+    return case['frames']
+
+def bench_cut_video(case, clip, work_dir, timer):
+    from src import video_cutter
+    timer.wrap(video_cutter, 'probe_media', 'probe')
+    timer.wrap(video_cutter, 'run', 'ffmpeg')
+    # The cut lands next to its source, so cut a copy inside the work directory
+    source = shutil.copy(clip, os.path.join(work_dir, os.path.basename(clip)))
+    duration = case['frames'] / CLIP_FPS
+    start_time, end_time = duration * 0.25, duration * 0.75
+    video_cutter.cut_video(source, start_time, end_time, case['mode'])
+    return int((end_time - start_time) * CLIP_FPS)
+
+BENCHMARK_FUNCTIONS = {
+    'auto_segment': bench_auto_segment,
+    'manual_segment': bench_manual_segment,
+    'process_video': bench_process_video,
+    'cut_video': bench_cut_video,
+}
+
+def missing_requirements(case, model):
+    # Reasons a case cannot run here; it is recorded as skipped instead of failing the run
+    # The stub model is numpy only; the real model and the seeded fast mode (torch tensors throughout) need torch
+    missing = []
+    if (model == 'real' or case.get('mode') == 'fast') and importlib.util.find_spec('torch') is None:
+        missing.append('torch')
+    if case['benchmark'] == 'cut_video':
+        missing += [tool for tool in ('ffmpeg', 'ffprobe') if shutil.which(tool) is None]
+    return missing
+
+def build_cases(resolutions, worker_counts, frame_count, benchmarks):
+    cases = []
+    for width, height in resolutions:
+        common = {'width': width, 'height': height, 'frames': frame_count}
+        size = f'{width}x{height}'
+        if 'auto_segment' in benchmarks:
+            for workers in worker_counts:
+                cases.append(dict(common, benchmark='auto_segment', mode='full', workers=workers,
+                                  id=f'auto_segment/full/{size}/w{workers}'))
+            cases.append(dict(common, benchmark='auto_segment', mode='keyframe', workers=1,
+                              id=f'auto_segment/keyframe/{size}'))
+        if 'manual_segment' in benchmarks:
+            cases.append(dict(common, benchmark='manual_segment', id=f'manual_segment/{size}'))
+        if 'process_video' in benchmarks:
+            for effect in ('glitch', 'pixelate'):
+                for workers in worker_counts:
+                    cases.append(dict(common, benchmark='process_video', effect=effect, workers=workers,
+                                      id=f'process_video/{effect}/{size}/w{workers}'))
+        if 'cut_video' in benchmarks:
+            for mode in ('copy', 'smart', 'accurate'):
+                cases.append(dict(common, benchmark='cut_video', mode=mode, id=f'cut_video/{mode}/{size}'))
+    return cases
+
+def run_case(case, clip, work_dir, model, stub_delay_ms, connection, verbose):
+    # Runs in the case process. The pipeline's own output goes to a log file unless verbose.
+    if not verbose:
+        log = open(os.path.join(work_dir, 'output.log'), 'w')
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    try:
+        if model == 'stub':
+            stub_model.install(stub_delay_ms)
+        timer = StageTimer()
+        start = time.perf_counter()
+        frames = BENCHMARK_FUNCTIONS[case['benchmark']](case, clip, work_dir, timer)
+        wall_seconds = time.perf_counter() - start
+        result = {'status': 'ok', 'frames': frames, 'wall_seconds': wall_seconds, 'stages': timer.report()}
+    except Exception as e:
+        traceback.print_exc()
+        result = {'status': 'error', 'error': f'{type(e).__name__}: {e}'}
+    try:
+        import resource
+        # Fallback peak for platforms without per-process sampling (kilobytes on Linux)
+        result['max_rss_mb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    except ImportError:
+        pass
+    sys.stdout.flush()
+    connection.send(result)
+
+def process_tree(pid):
+    # pid and all its descendants (Linux /proc, or psutil where installed)
+    pids = [pid]
+    for parent in pids:
+        try:
+            for task in os.listdir(f'/proc/{parent}/task'):
+                with open(f'/proc/{parent}/task/{task}/children') as f:
+                    pids += [int(child) for child in f.read().split()]
+        except OSError:
+            try:
+                import psutil
+                return [pid] + [child.pid for child in psutil.Process(pid).children(recursive=True)]
+            except Exception:
+                return pids
+    return pids
+
+def sample_memory(pid):
+    rss_total = 0.0
+    pss_total = 0.0
+    for tree_pid in process_tree(pid):
+        rss, pss = memory_usage_mb(tree_pid)
+        rss_total += rss or 0.0
+        pss_total += pss if pss is not None else (rss or 0.0)
+    return rss_total, pss_total
+
+def measure_case(case, clip, work_dir, model, stub_delay_ms, verbose):
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_case, args=(case, clip, work_dir, model, stub_delay_ms, sender, verbose))
+    process.start()
+    peak_rss = 0.0
+    peak_pss = 0.0
+    result = None
+    while result is None:
+        rss, pss = sample_memory(process.pid)
+        peak_rss = max(peak_rss, rss)
+        peak_pss = max(peak_pss, pss)
+        if receiver.poll(SAMPLE_INTERVAL):
+            result = receiver.recv()
+        elif not process.is_alive():
+            result = {'status': 'error', 'error': f'Case process exited with code {process.exitcode}'}
+    process.join()
+    if result['status'] == 'ok':
+        result['fps'] = result['frames'] / result['wall_seconds'] if result['wall_seconds'] > 0 else 0.0
+        if peak_rss:
+            result['peak_rss_mb'] = peak_rss
+            result['peak_pss_mb'] = peak_pss
+        elif 'max_rss_mb' in result:
+            result['peak_rss_mb'] = result['peak_pss_mb'] = result['max_rss_mb']
+    return result
+
+def run_suite(cases, work_dir, model='stub', stub_delay_ms=0, repeat=1, verbose=False):
+    clip_dir = os.path.join(work_dir, 'clips')
+    results = []
+    for index, case in enumerate(cases, 1):
+        clip = make_clip(os.path.join(clip_dir, clip_name(case['width'], case['height'], case['frames'], CLIP_FPS)),
+                         case['width'], case['height'], case['frames'], CLIP_FPS)
+        record = dict(case)
+        missing = missing_requirements(case, model)
+        if missing:
+            record.update(status='skipped', reason='missing ' + ', '.join(missing))
+        else:
+            runs = []
+            for run_index in range(repeat):
+                case_dir = os.path.join(work_dir, 'cases', case['id'].replace('/', '_') + f'_{run_index}')
+                shutil.rmtree(case_dir, ignore_errors=True)
+                os.makedirs(case_dir)
+                runs.append(measure_case(case, clip, case_dir, model, stub_delay_ms, verbose))
+                if runs[-1]['status'] != 'ok':
+                    break
+            ok_runs = [run for run in runs if run['status'] == 'ok']
+            if len(ok_runs) == len(runs):
+                # The fastest run, with the highest memory peak seen in any run
+                record.update(max(ok_runs, key=lambda run: run['fps']))
+                record['wall_seconds_all'] = [run['wall_seconds'] for run in ok_runs]
+                for key in ('peak_rss_mb', 'peak_pss_mb'):
+                    if key in record:
+                        record[key] = max(run[key] for run in ok_runs)
+            else:
+                record.update(runs[-1])
+        results.append(record)
+        print(format_result(record, index, len(cases)), flush=True)
+    return results
+
+def format_result(record, index, total):
+    prefix = f'[{index}/{total}] {record["id"]:<36}'
+    if record['status'] == 'skipped':
+        return f'{prefix} skipped ({record["reason"]})'
+    if record['status'] != 'ok':
+        return f'{prefix} ERROR {record["error"]}'
+    memory = f'{record["peak_pss_mb"]:8.0f} MB' if 'peak_pss_mb' in record else '       n/a'
+    stages = ', '.join(f'{stage} {stats["total_seconds"]:.2f}s' for stage, stats in record['stages'].items())
+    return f'{prefix} {record["fps"]:9.2f} fps {memory}  {stages}'
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results, baseline, threshold):
+    # Returns (regressions, comparisons); a metric regresses when it is worse than the
+    # baseline by more than threshold (a fraction, 0.15 = 15%)
+    baseline_results = {record['id']: record for record in baseline['results'] if record.get('status') == 'ok'}
+    comparisons = []
+    regressions = []
+    for record in results:
+        base = baseline_results.get(record['id'])
+        if record.get('status') != 'ok' or base is None:
+            continue
+        for metric, higher_is_better in REGRESSION_METRICS.items():
+            if not record.get(metric) or not base.get(metric):
+                continue
+            ratio = record[metric] / base[metric]
+            regressed = ratio < 1 - threshold if higher_is_better else ratio > 1 + threshold
+            comparison = {'id': record['id'], 'metric': metric, 'baseline': base[metric], 'value': record[metric],
+                          'ratio': ratio, 'regressed': regressed}
+            comparisons.append(comparison)
+            if regressed:
+                regressions.append(comparison)
+    return regressions, comparisons
+
+def parse_resolutions(text):
+    return [tuple(int(v) for v in size.lower().split('x')) for size in text.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SegmentFX offline benchmarks')
+    parser.add_argument('--suite', choices=sorted(SUITES), default='quick')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument('--resolutions', type=parse_resolutions, default=None, help='e.g. 640x360,1920x1080')
+    parser.add_argument('--workers', type=lambda text: [int(v) for v in text.split(',')], default=None, help='e.g. 1,2,4')
+    parser.add_argument('--frames', type=int, default=None, help='Frames per synthetic clip')
+    parser.add_argument('--model', choices=['stub', 'real'], default='stub',
+                        help='Deterministic stub model, or the real MobileSAM weights in models/')
+    parser.add_argument('--stub-delay-ms', type=float, default=0, help='Simulated inference time per stub model call')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case; the fastest is kept')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='Earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.15, help='Allowed regression as a fraction of the baseline')
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'segmentfx_benchmarks'))
+    parser.add_argument('--verbose', action='store_true', help="Show the pipeline's own output")
+    args = parser.parse_args(argv)
+
+    suite = SUITES[args.suite]
+    cases = build_cases(args.resolutions or suite['resolutions'], args.workers or suite['workers'],
+                        args.frames or suite['frames'], args.benchmarks)
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = run_suite(cases, os.path.abspath(args.work_dir), args.model, args.stub_delay_ms, args.repeat, args.verbose)
+
+    report = {
+        'meta': {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'suite': args.suite,
+            'model': args.model,
+            'stub_delay_ms': args.stub_delay_ms,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': multiprocessing.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved {len(results)} results to {args.output}')
+
+    failed = [record for record in results if record['status'] == 'error']
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions, comparisons = compare_results(results, baseline, args.threshold)
+        for comparison in comparisons:
+            flag = 'REGRESSION' if comparison['regressed'] else ''
+            print(f'{comparison["id"]:<36} {comparison["metric"]:<12} {comparison["baseline"]:10.2f} -> '
+                  f'{comparison["value"]:10.2f} ({(comparison["ratio"] - 1) * 100:+.1f}%) {flag}')
+        if regressions:
+            print(f'{len(regressions)} regressions beyond {args.threshold * 100:.0f}%')
+            return 1
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
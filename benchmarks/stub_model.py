@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+    Deterministic stand-in for the mobile_sam package, for benchmarking the pipeline around the
+    model without weights. install() registers it as mobile_sam, so build_sam, load_model, the
+    worker pool and the server all pick it up unchanged. Masks are connected regions of a few
+    luminance bands; delay_ms adds a fixed sleep per encoder or generator call to stand in for
+    inference cost.
+
+    The automatic mask generator and SamPredictor.set_image/predict are numpy only, so the
+    benchmarks run without torch; manual mode then encodes frame by frame through set_image
+    instead of inference_backend.encode_batch.
+"""
+
+import sys
+import time
+import types
+
+import cv2
+import numpy as np
+
+STUB_INPUT_SIZE = 64  # Longest side of the stub "embedding"
+LUMINANCE_BANDS = (64, 128, 192)
+MAX_MASKS = 16
+
+_delay_seconds = 0.0
+
+def _simulate_inference():
+    if _delay_seconds:
+        time.sleep(_delay_seconds)
+
+class StubTransform:
+    def apply_image(self, image):
+        h, w = image.shape[:2]
+        scale = STUB_INPUT_SIZE / max(h, w)
+        return cv2.resize(image, (max(1, int(w * scale + 0.5)), max(1, int(h * scale + 0.5))), interpolation=cv2.INTER_AREA)
+
+class StubImageEncoder:
+    img_size = STUB_INPUT_SIZE
+
+    def __call__(self, images):
+        _simulate_inference()
+        return images
+
+class StubSam:
+    image_format = 'RGB'
+    mask_threshold = 0.0
+    model_tag = 'stub'
+
+    def __init__(self, checkpoint=None):
+        self.image_encoder = StubImageEncoder()
+
+    def to(self, device=None):
+        return self
+
+    def eval(self):
+        return self
+
+    def share_memory(self):
+        return self
+
+    def preprocess(self, images):
+        return images.float() / 255
+
+class StubPredictor:
+    def __init__(self, model):
+        self.model = model
+        self.device = 'cpu'
+        self.transform = StubTransform()
+        self.reset_image()
+
+    def reset_image(self):
+        self.features = None
+        self.original_size = None
+        self.input_size = None
+        self.is_image_set = False
+
+    def set_image(self, image, image_format='RGB'):
+        _simulate_inference()
+        small = self.transform.apply_image(image)
+        self.features = (small.astype(np.float32) / 255).transpose(2, 0, 1)[None]
+        self.original_size = image.shape[:2]
+        self.input_size = small.shape[:2]
+        self.is_image_set = True
+
+    def predict(self, point_coords=None, point_labels=None, box=None, multimask_output=False, return_logits=False):
+        # Bright regions of the frame, limited to the box prompt
+        h, w = self.original_size
+        in_h, in_w = self.input_size
+        luminance = np.asarray(self.features)[0, :, :in_h, :in_w].mean(axis=0)
+        logits = cv2.resize(luminance, (w, h), interpolation=cv2.INTER_LINEAR) - 0.4
+        mask = logits > 0
+        if box is not None:
+            x1, y1, x2, y2 = [int(v) for v in box]
+            region = np.zeros_like(mask)
+            region[max(y1, 0):y2 + 1, max(x1, 0):x2 + 1] = True
+            mask &= region
+        return mask[None], np.array([0.9]), luminance[None]
+
+class StubMaskGenerator:
+    def __init__(self, model, **kwargs):
+        self.model = model
+
+    def generate(self, image):
+        _simulate_inference()
+        h, w = image.shape[:2]
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        min_area = max(1, h * w // 1000)
+        masks = []
+        for low, high in zip((0,) + LUMINANCE_BANDS, LUMINANCE_BANDS + (256,)):
+            band = ((gray >= low) & (gray < high)).astype(np.uint8)
+            count, labels, stats, centroids = cv2.connectedComponentsWithStats(band, connectivity=4)
+            for label in range(1, count):
+                x, y, bw, bh, area = stats[label]
+                if area < min_area:
+                    continue
+                masks.append({
+                    'segmentation': labels == label,
+                    'area': int(area),
+                    'bbox': [int(x), int(y), int(bw), int(bh)],
+                    'predicted_iou': 0.9,
+                    'point_coords': [[float(centroids[label][0]), float(centroids[label][1])]],
+                    'stability_score': 0.95,
+                    'crop_box': [0, 0, w, h],
+                })
+        masks.sort(key=lambda mask: mask['area'], reverse=True)
+        return masks[:MAX_MASKS]
+
+def install(delay_ms=0):
+    global _delay_seconds
+    _delay_seconds = delay_ms / 1000
+    module = types.ModuleType('mobile_sam')
+    module.sam_model_registry = {'vit_t': StubSam, 'default': StubSam}
+    module.SamPredictor = StubPredictor
+    module.SamAutomaticMaskGenerator = StubMaskGenerator
+    sys.modules['mobile_sam'] = module
+    return module
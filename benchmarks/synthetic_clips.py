@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+    Deterministic test clips for the benchmarks, written locally with cv2.VideoWriter.
+
+    A clip is a smooth gradient with a few solid shapes moving across it and a cut to a
+    recoloured shot half way through, so segmentation has objects to find and the scene-change
+    logic is exercised. The same parameters always give the same pixels.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+SHAPE_COUNT = 4
+
+def clip_name(width, height, frame_count, fps=30, seed=0):
+    return f'synthetic_{width}x{height}_{frame_count}f_{fps}fps_s{seed}.mp4'
+
+def render_frame(frame_num, width, height, shapes, second_shot):
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame[..., 0] = (x * 0.3 + y * 0.2).astype(np.uint8)
+    frame[..., 1] = (y * 0.4 + 20).astype(np.uint8)
+    frame[..., 2] = (255 - x * 0.3).astype(np.uint8)
+    if second_shot:
+        frame = frame[..., ::-1].copy()
+    for cx, cy, vx, vy, radius, color, is_circle in shapes:
+        # Bounce off the edges
+        px = int(abs((cx + vx * frame_num) % (2 * width) - width))
+        py = int(abs((cy + vy * frame_num) % (2 * height) - height))
+        if is_circle:
+            cv2.circle(frame, (px, py), radius, color, -1)
+        else:
+            cv2.rectangle(frame, (px - radius, py - radius), (px + radius, py + radius), color, -1)
+    return frame
+
+def make_clip(path, width, height, frame_count, fps=30, seed=0):
+    # Returns path; an existing clip is reused since the content is fully determined by the name
+    if os.path.exists(path):
+        return path
+    random = np.random.RandomState(seed)
+    shapes = []
+    for i in range(SHAPE_COUNT):
+        radius = int(min(width, height) * random.uniform(0.06, 0.15))
+        shapes.append((
+            random.uniform(0, width), random.uniform(0, height),
+            random.uniform(-0.01, 0.01) * width, random.uniform(-0.01, 0.01) * height,
+            radius, tuple(int(c) for c in random.randint(0, 256, 3)), i % 2 == 0
+        ))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + '.tmp.mp4'
+    writer = cv2.VideoWriter(tmp_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f'Could not open {tmp_path} for writing')
+    for frame_num in range(frame_count):
+        writer.write(render_frame(frame_num, width, height, shapes, frame_num >= frame_count // 2))
+    writer.release()
+    os.replace(tmp_path, path)
+    return path
+
+def make_mask(path, width, height):
+    # User mask for manual segmentation: the centre quarter of the frame
+    if not os.path.exists(path):
+        mask = np.zeros((height, width), dtype=np.uint8)
+        mask[height // 4:height * 3 // 4, width // 4:width * 3 // 4] = 255
+        cv2.imwrite(path, mask)
+    return path
@@ -1,20 +1,261 @@
 import sys
-import uuid
 import pathlib
 import os
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
 
-from metaseg import SegManualMaskPredictor
 from PIL import Image
 import PyQt5
 from PyQt5 import QtCore, QtWidgets
-from PyQt5.QtCore import Qt, QObject, QUrl, QRect, pyqtSignal, QPoint, QSize, QBuffer
-from PyQt5.QtGui import QPainter, QImage, QFont
+from PyQt5.QtCore import Qt, QObject, QUrl, QRect, pyqtSignal, QPoint, QSize, QBuffer, QThread
+from PyQt5.QtGui import QPainter, QImage, QFont, QColor
 from PyQt5.QtWidgets import (QWidget, QApplication, QMainWindow, QGridLayout, QToolBar,
-QAction, QPushButton, QStyle, QHBoxLayout, QVBoxLayout, QSlider, QStatusBar)
+QAction, QPushButton, QStyle, QHBoxLayout, QVBoxLayout, QSlider, QStatusBar, QProgressBar)
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent, QAbstractVideoBuffer, \
-    QVideoFrame, QVideoSurfaceFormat, QAbstractVideoSurface
+    QVideoFrame, QVideoSurfaceFormat, QAbstractVideoSurface, QMediaPlaylist
 from PyQt5.QtMultimediaWidgets import QVideoWidget
 
+# The SegmentFX backend provides the MobileSAM loader used by the live preview
+SEGMENTFX_PYTHON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ClaudeSeg', 'SegmentFx', 'python')
+
+PREVIEW_WIDTH = 480
+PREVIEW_COLOR = (30, 144, 255, 110)  # RGBA of the mask overlay
+SEGMENT_COLOR = (255, 144, 30)  # BGR of the mask in segmented output
+SEGMENT_SECONDS = 2  # Length of each finished piece the player can start on
+# Prompts in source pixels for the preview and segmentation jobs
+INPUT_POINT = ((50, 50), (100, 100))
+INPUT_LABEL = (0, 1)
+# QImage formats whose pixels can be viewed directly as (height, width, channels) arrays
+ARRAY_FORMATS = {
+    QImage.Format_RGB32: (4, cv2.COLOR_BGRA2RGB),
+    QImage.Format_ARGB32: (4, cv2.COLOR_BGRA2RGB),
+    QImage.Format_ARGB32_Premultiplied: (4, cv2.COLOR_BGRA2RGB),
+    QImage.Format_RGB888: (3, None),
+}
+
+
+def frame_to_array(frame, image_format):
+    # View of a mapped QVideoFrame's pixels without copying; only valid until unmap()
+    if image_format not in ARRAY_FORMATS:
+        return None
+    channels = ARRAY_FORMATS[image_format][0]
+    bits = frame.bits()
+    bits.setsize(frame.mappedBytes())
+    rows = np.frombuffer(bits, dtype=np.uint8).reshape(frame.height(), frame.bytesPerLine())
+    return rows[:, :frame.width() * channels].reshape(frame.height(), frame.width(), channels)
+
+
+class RateMeter:
+    # Events per second over the last few events
+    def __init__(self, window=30):
+        self.times = deque(maxlen=window)
+
+    def tick(self):
+        self.times.append(time.perf_counter())
+
+    @property
+    def rate(self):
+        if len(self.times) < 2 or time.perf_counter() - self.times[-1] > 2:
+            return 0.0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+
+_session_predictor = None
+# Held around set_image + predict: the preview and segmentation jobs share one predictor
+predictor_lock = threading.Lock()
+
+
+def get_session_predictor():
+    # The MobileSAM predictor from the SegmentFX backend, built on first use and kept for the session
+    global _session_predictor
+    with predictor_lock:
+        if _session_predictor is None:
+            if SEGMENTFX_PYTHON_DIR not in sys.path:
+                sys.path.append(SEGMENTFX_PYTHON_DIR)
+            from segmentation import load_model
+            _session_predictor = load_model(manual=True)
+        return _session_predictor
+
+
+def predict_mask(predictor, image, input_point, input_label):
+    with predictor_lock:
+        predictor.set_image(image)
+        masks, _, _ = predictor.predict(
+            point_coords=input_point,
+            point_labels=input_label,
+            multimask_output=False,
+        )
+    return masks[0]
+
+
+class LatestFrameSlot:
+    # Single-entry mailbox between playback and the preview worker. put() replaces a frame that
+    # has not been picked up yet, so the worker always gets the newest frame and never a backlog.
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.item is not None or self.closed, timeout)
+            item, self.item = self.item, None
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class PreviewWorker(QThread):
+    # Segments the newest preview frame with a predictor that stays loaded for the whole session
+    maskReady = pyqtSignal(object)
+    statusChanged = pyqtSignal(str)
+
+    def __init__(self, slot, input_point=INPUT_POINT, input_label=INPUT_LABEL, parent=None):
+        super().__init__(parent)
+        self.slot = slot
+        self.input_point = np.array(input_point, dtype=np.float32)
+        self.input_label = np.array(input_label)
+        self.rate = RateMeter()
+
+    def run(self):
+        self.statusChanged.emit("Loading preview model...")
+        predictor = get_session_predictor()
+        self.statusChanged.emit("Live preview running")
+        while not self.isInterruptionRequested():
+            item = self.slot.take(timeout=0.1)
+            if item is None:
+                continue
+            image, scale = item
+            # Prompts are given in source pixels; the predictor sees the preview size
+            mask = predict_mask(predictor, image, self.input_point * scale, self.input_label)
+            self.rate.tick()
+            self.maskReady.emit(mask)
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
+
+
+class SegmentationJob(QThread):
+    """
+        Segments a clip off the GUI thread and writes the result as a series of short mp4
+        files. Each file is announced through segmentReady once it is closed, so the player
+        can start on the first one while the rest are still being produced.
+    """
+    segmentReady = pyqtSignal(str)
+    progressChanged = pyqtSignal(int)  # percent
+    statusChanged = pyqtSignal(str)
+    failed = pyqtSignal(str)
+
+    def __init__(self, source, output_dir, input_point=INPUT_POINT, input_label=INPUT_LABEL, parent=None):
+        super().__init__(parent)
+        self.source = source
+        self.output_dir = output_dir
+        self.input_point = np.array(input_point, dtype=np.float32)
+        self.input_label = np.array(input_label)
+        self.segments = []
+        self.fourcc = None
+
+    def cancel(self):
+        self.requestInterruption()
+
+    def _open_segment(self, index, fps, size):
+        path = os.path.join(self.output_dir, "segment_{:04d}.mp4".format(index))
+        # H.264 plays everywhere QMediaPlayer does; fall back to MPEG-4 where OpenCV lacks an encoder
+        for fourcc in ([self.fourcc] if self.fourcc else ["avc1", "mp4v"]):
+            writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+            if writer.isOpened():
+                self.fourcc = fourcc
+                return path, writer
+        raise RuntimeError("Could not open {} for writing".format(path))
+
+    def run(self):
+        writer = None
+        path = None
+        try:
+            self.statusChanged.emit("Loading segmentation model...")
+            predictor = get_session_predictor()
+            os.makedirs(self.output_dir, exist_ok=True)
+
+            video = cv2.VideoCapture(self.source)
+            fps = video.get(cv2.CAP_PROP_FPS) or 30
+            frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+            size = (int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+            frames_per_segment = max(1, int(round(fps * SEGMENT_SECONDS)))
+            self.statusChanged.emit("Segmenting " + pathlib.Path(self.source).name)
+
+            frame_num = 0
+            while not self.isInterruptionRequested():
+                ret, frame = video.read()
+                if not ret:
+                    break
+                mask = predict_mask(predictor, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), self.input_point, self.input_label)
+                frame[mask] = (frame[mask] // 2 + np.array(SEGMENT_COLOR, dtype=np.uint8) // 2)
+
+                if writer is None:
+                    path, writer = self._open_segment(len(self.segments), fps, size)
+                writer.write(frame)
+                frame_num += 1
+                if frame_num % frames_per_segment == 0:
+                    writer.release()
+                    writer = None
+                    self.segments.append(path)
+                    self.segmentReady.emit(path)
+                if frame_count > 0:
+                    self.progressChanged.emit(min(100, frame_num * 100 // frame_count))
+            video.release()
+
+            if writer is not None:
+                writer.release()
+                writer = None
+                if self.isInterruptionRequested():
+                    os.remove(path)  # Unfinished piece
+                else:
+                    self.segments.append(path)
+                    self.segmentReady.emit(path)
+            if not self.isInterruptionRequested():
+                self.progressChanged.emit(100)
+        except Exception as e:
+            if writer is not None:
+                writer.release()
+            self.failed.emit(str(e))
+
+
+class VideoWidget(QWidget):
+    # Paints the grabber's current frame and overlay; takes the place of QVideoWidget so frames
+    # pass through the grabber
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.grabber = None
+        self.setAttribute(Qt.WA_OpaquePaintEvent)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(event.rect(), Qt.black)
+        if self.grabber is not None and self.grabber.isActive():
+            self.grabber.paint(painter)
+        painter.end()
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if self.grabber is not None and self.grabber.isActive():
+            self.grabber.updateVideoRect()
+
 
 class VideoFrameGrabber(QAbstractVideoSurface):
     frameAvailable = pyqtSignal(QImage)
@@ -23,6 +264,18 @@ class VideoFrameGrabber(QAbstractVideoSurface):
         super().__init__(parent)
 
         self.widget = widget
+        self.widget.grabber = self
+        self.currentFrame = QVideoFrame()
+        self.targetRect = QRect()
+        self.sourceRect = QRect()
+        self.imageFormat = QImage.Format_Invalid
+
+        # Live preview: set preview_slot to receive downscaled frames
+        self.preview_slot = None
+        self.preview_worker = None
+        self.overlay = None
+        self.overlay_pixels = None
+        self.playback_rate = RateMeter()
 
     def supportedPixelFormats(self, handleType):
         return [QVideoFrame.Format_ARGB32, QVideoFrame.Format_ARGB32_Premultiplied,
@@ -73,12 +326,16 @@ class VideoFrameGrabber(QAbstractVideoSurface):
 
     def present(self, frame):
         if frame.isValid():
-            cloneFrame = QVideoFrame(frame)
-            cloneFrame.map(QAbstractVideoBuffer.ReadOnly)
-            image = QImage(cloneFrame.bits(), cloneFrame.width(), cloneFrame.height(),
-                           QVideoFrame.imageFormatFromPixelFormat(cloneFrame.pixelFormat()))
-            self.frameAvailable.emit(image)  # this is very important
-            cloneFrame.unmap()
+            self.playback_rate.tick()
+            if self.preview_slot is not None:
+                self.send_preview(frame)
+            elif self.receivers(self.frameAvailable) > 0:
+                cloneFrame = QVideoFrame(frame)
+                cloneFrame.map(QAbstractVideoBuffer.ReadOnly)
+                image = QImage(cloneFrame.bits(), cloneFrame.width(), cloneFrame.height(),
+                               QVideoFrame.imageFormatFromPixelFormat(cloneFrame.pixelFormat()))
+                self.frameAvailable.emit(image)  # this is very important
+                cloneFrame.unmap()
 
         if self.surfaceFormat().pixelFormat() != frame.pixelFormat() or \
                 self.surfaceFormat().frameSize() != frame.size():
@@ -89,10 +346,45 @@ class VideoFrameGrabber(QAbstractVideoSurface):
         else:
             self.currentFrame = frame
 
-            self.widget.repaint(self.targetRect)
+            self.widget.update(self.targetRect)
 
             return True
 
+    def send_preview(self, frame):
+        # Downscale straight from the mapped frame into a fresh preview-sized array; that small
+        # array is the only copy made. The slot drops it if the worker is still busy.
+        cloneFrame = QVideoFrame(frame)
+        if not cloneFrame.map(QAbstractVideoBuffer.ReadOnly):
+            return
+        try:
+            image_format = QVideoFrame.imageFormatFromPixelFormat(cloneFrame.pixelFormat())
+            pixels = frame_to_array(cloneFrame, image_format)
+            if pixels is None:
+                return
+            if self.surfaceFormat().scanLineDirection() == QVideoSurfaceFormat.BottomToTop:
+                pixels = pixels[::-1]
+            scale = min(1.0, PREVIEW_WIDTH / pixels.shape[1])
+            size = (max(1, int(pixels.shape[1] * scale)), max(1, int(pixels.shape[0] * scale)))
+            small = cv2.resize(pixels, size, interpolation=cv2.INTER_AREA)
+        finally:
+            cloneFrame.unmap()
+        conversion = ARRAY_FORMATS[image_format][1]
+        if conversion is not None:
+            small = cv2.cvtColor(small, conversion)
+        self.preview_slot.put((small, scale))
+
+    def set_overlay(self, mask):
+        # Runs on the GUI thread; the QImage wraps overlay_pixels, which must stay referenced
+        if mask is None:
+            self.overlay = None
+            self.overlay_pixels = None
+        else:
+            self.overlay_pixels = np.zeros(mask.shape + (4,), dtype=np.uint8)
+            self.overlay_pixels[mask] = PREVIEW_COLOR
+            height, width = mask.shape
+            self.overlay = QImage(self.overlay_pixels.data, width, height, width * 4, QImage.Format_RGBA8888)
+        self.widget.update(self.targetRect)
+
     def updateVideoRect(self):
         size = self.surfaceFormat().sizeHint()
         size.scale(self.widget.size().boundedTo(size), Qt.KeepAspectRatio)
@@ -101,22 +393,33 @@ class VideoFrameGrabber(QAbstractVideoSurface):
         self.targetRect.moveCenter(self.widget.rect().center())
 
     def paint(self, painter):
-        if self.currentFrame.map(QAbstractVideoBuffer.ReadOnly):
-            oldTransform = self.painter.transform()
+        if not self.currentFrame.map(QAbstractVideoBuffer.ReadOnly):
+            return
+        oldTransform = painter.transform()
 
         if self.surfaceFormat().scanLineDirection() == QVideoSurfaceFormat.BottomToTop:
-            self.painter.scale(1, -1)
-            self.painter.translate(0, -self.widget.height())
+            painter.scale(1, -1)
+            painter.translate(0, -self.widget.height())
 
         image = QImage(self.currentFrame.bits(), self.currentFrame.width(), self.currentFrame.height(),
                        self.currentFrame.bytesPerLine(), self.imageFormat)
 
-        self.painter.drawImage(self.targetRect, image, self.sourceRect)
+        painter.drawImage(self.targetRect, image, self.sourceRect)
 
-        self.painter.setTransform(oldTransform)
+        painter.setTransform(oldTransform)
 
         self.currentFrame.unmap()
 
+        if self.preview_slot is not None:
+            # The overlay is the latest finished mask, so it can trail the frame by a few frames
+            if self.overlay is not None:
+                painter.drawImage(self.targetRect, self.overlay)
+            preview_rate = self.preview_worker.rate.rate if self.preview_worker is not None else 0.0
+            painter.setPen(QColor(255, 255, 255))
+            painter.setFont(QFont("Helvetica", 9))
+            painter.drawText(self.targetRect.adjusted(8, 8, -8, -8), Qt.AlignLeft | Qt.AlignTop,
+                             "preview {:.1f} fps / playback {:.1f} fps".format(preview_rate, self.playback_rate.rate))
+
 
 class MainWidget(QMainWindow):
     def __init__(self, parent=None):
@@ -132,7 +435,7 @@ class MainWidget(QMainWindow):
         self.gridLayout.setContentsMargins(0, 0, 0, 0)
         self.gridLayout.setSpacing(0)
 
-        self.video_item = QVideoWidget()
+        self.video_item = VideoWidget()
 
         self.gridLayout.addWidget(self.video_item)
 
@@ -160,15 +463,29 @@ class MainWidget(QMainWindow):
         self.statusBar.setFont(QFont("Helvetica", 7))
         self.statusBar.setFixedHeight(14)
 
+        self.previewButton = QPushButton("Live Preview")
+        self.previewButton.setCheckable(True)
+        self.previewButton.toggled.connect(self.togglePreview)
+        self.preview_worker = None
+
+        self.segmentation_job = None
+        self.segmentation_playlist = None
+        self.progressBar = QProgressBar()
+        self.progressBar.setRange(0, 100)
+        self.progressBar.setFixedHeight(14)
+        self.progressBar.hide()
+        self.cancelButton = QPushButton("Cancel Segmentation")
+        self.cancelButton.clicked.connect(self.cancelSegmentation)
+        self.cancelButton.hide()
+
         self.gridLayout.addWidget(self.playButton)
+        self.gridLayout.addWidget(self.previewButton)
+        self.gridLayout.addWidget(self.progressBar)
+        self.gridLayout.addWidget(self.cancelButton)
         self.gridLayout.addWidget(self.positionSlider)
         self.gridLayout.addWidget(self.statusBar)
-        # self.gridLayout.addWidget(self.grabber)
-
-        # self.mediaPlayer.setVideoOutput(self.grabber)
-        self.mediaPlayer.setVideoOutput(self.video_item)
 
-        self.grabber.frameAvailable.connect(self.process_frame)
+        self.mediaPlayer.setVideoOutput(self.grabber)
 
         self.mediaPlayer.stateChanged.connect(self.mediaStateChanged)
         self.mediaPlayer.positionChanged.connect(self.positionChanged)
@@ -218,52 +535,54 @@ class MainWidget(QMainWindow):
         from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
 
 
-    def inference_SA(self): 
-        # TODO:  model inference
-
-        # try:
-            # segment_framebyframe()
-            # pass
-        # except: # Inference Error
-            # raise RuntimeError("Model Inference Problem")
-        # raise RuntimeError("Model Inference Not Written")
-        results = SegManualMaskPredictor().video_predict(
-            source=self.filename,
-            model_type="vit_l", # vit_l, vit_h, vit_b
-            input_point=[(50, 50), (100, 100)],
-            input_label=[0, 1],
-            input_box=None,
-            multimask_output=False,
-            random_color=False,
-            output_path="Segmented.mp4",
-        )
-        print(results)
-        seg_path = pathlib.Path(os.getcwd()) / results    
-        seg_qurl = QUrl.fromLocalFile(str(seg_path))
-        seg_media = QMediaContent(seg_qurl)
-        return seg_media
-
-    def segment_paint_save(self):
-        # if "Segmented.mp4" in os.listdir(os.getcwd()):
-        #     seg_path = pathlib.Path(os.getcwd()) / "Segmented.mp4"   
-        #     seg_qurl = QUrl.fromLocalFile(str(seg_path))
-        #     seg_media = QMediaContent(seg_qurl)
-        #     return seg_media
-        segmented = self.inference_SA() 
-        # do we need to paint? can we call that as a parameter, i.e. segment with border size X
-        # seg_painted = paint(segmented) ???
-        return segmented
+    def startSegmentation(self):
+        # Plays the segmented output piece by piece while the job is still running
+        self.cancelSegmentation()
+        output_dir = str(pathlib.Path(os.getcwd()) / ("Segmented_" + pathlib.Path(self.filename).stem))
+        self.segmentation_playlist = QMediaPlaylist(self)
+        self.segmentation_job = SegmentationJob(self.filename, output_dir, parent=self)
+        self.segmentation_job.segmentReady.connect(self.segmentReady)
+        self.segmentation_job.progressChanged.connect(self.progressBar.setValue)
+        self.segmentation_job.statusChanged.connect(self.statusBar.showMessage)
+        self.segmentation_job.failed.connect(self.segmentationFailed)
+        self.segmentation_job.finished.connect(self.segmentationFinished)
+        self.mediaPlayer.pause()
+        self.progressBar.setValue(0)
+        self.progressBar.show()
+        self.cancelButton.show()
+        self.segmentation_job.start()
+
+    def segmentReady(self, path):
+        self.segmentation_playlist.addMedia(QMediaContent(QUrl.fromLocalFile(path)))
+        if self.mediaPlayer.playlist() is not self.segmentation_playlist:
+            self.mediaPlayer.setPlaylist(self.segmentation_playlist)
+            self.mediaPlayer.play()
+        elif self.mediaPlayer.state() == QMediaPlayer.StoppedState:
+            # Playback caught up with segmentation; resume on the piece that just arrived
+            self.segmentation_playlist.setCurrentIndex(self.segmentation_playlist.mediaCount() - 1)
+            self.mediaPlayer.play()
+
+    def segmentationFailed(self, message):
+        self.statusBar.showMessage("Segmentation failed: " + message)
+
+    def segmentationFinished(self):
+        self.progressBar.hide()
+        self.cancelButton.hide()
+
+    def cancelSegmentation(self):
+        if self.segmentation_job is not None and self.segmentation_job.isRunning():
+            self.segmentation_job.cancel()
+            self.segmentation_job.wait()
+            self.statusBar.showMessage("Segmentation cancelled")
 
     def pause_and_load_media(self, segmented=False):
         if not segmented:
+            self.cancelSegmentation()
             self.mediaPlayer.pause()
             self.mediaPlayer.setMedia(self.media)
             self.mediaPlayer.play()
         else:
-            self.mediaPlayer.pause()
-            seg_painted = self.segment_paint_save()
-            self.mediaPlayer.setMedia(seg_painted)
-            self.mediaPlayer.play()
+            self.startSegmentation()
 
     def onClick(self):
         if self.button.isChecked():
@@ -298,10 +617,31 @@ class MainWidget(QMainWindow):
         else:
             print("Error: not a valid file")
 
-    def process_frame(self, image):
-        # Save image here
-        print(image)
-        # image.save('c:/temp/{}.jpg'.format(str(uuid.uuid4())))
+    def togglePreview(self, enabled):
+        if enabled:
+            slot = LatestFrameSlot()
+            if self.preview_worker is None:
+                self.preview_worker = PreviewWorker(slot, parent=self)
+                self.preview_worker.maskReady.connect(self.grabber.set_overlay)
+                self.preview_worker.statusChanged.connect(self.statusBar.showMessage)
+            else:
+                self.preview_worker.slot = slot  # The loaded predictor is kept between sessions
+            self.grabber.preview_worker = self.preview_worker
+            self.grabber.preview_slot = slot
+            self.preview_worker.start()
+        else:
+            slot = self.grabber.preview_slot
+            self.grabber.preview_slot = None
+            if slot is not None:
+                slot.close()
+            if self.preview_worker is not None:
+                self.preview_worker.stop()
+            self.grabber.set_overlay(None)
+
+    def closeEvent(self, event):
+        self.previewButton.setChecked(False)
+        self.cancelSegmentation()
+        super().closeEvent(event)
 
     def mediaStateChanged(self, state):
         if self.mediaPlayer.state() == QMediaPlayer.PlayingState:
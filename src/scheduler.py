@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+    Job scheduler for cut, extract, rotate, segment and render jobs.
+
+    Every job costs a number of CPU slots and also gets that many encoder threads. A job only
+    starts when its slots are free, so queued batch work keeps the machine busy without
+    oversubscribing it. Higher priority jobs start first. Cancelling a running job kills its
+    process tree, and the outputs it created are deleted when it fails or is cancelled.
+    Jobs report progress, throughput and ETA; with a metrics directory (or $SEGMENTFX_METRICS_DIR)
+    the scheduler's metrics are exported after every job.
+"""
+
+import heapq
+import itertools
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from ClaudeSeg.SegmentFx.python import metrics
+from src.video_cutter import JobCancelled, cut_ranges, cut_video, extract_audio, rotate_video, run_process
+
+SEGMENTFX_PYTHON_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ClaudeSeg', 'SegmentFx', 'python')
+PROGRESS_POLL_SECONDS = 0.5
+
+class Job:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, job_id, kind, func, args, kwargs, priority=0, cost=1, on_progress=None, on_finished=None):
+        self.id = job_id
+        self.kind = kind
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.cost = cost
+        self.threads = cost
+        self.status = Job.QUEUED
+        self.progress = 0.0
+        self.rate = None  # frames per second, when the job reports it
+        self.eta_seconds = None
+        self.result = None
+        self.error = None
+        self.outputs = []
+        self.cancel_event = threading.Event()
+        self.started_at = None
+        self.finished_at = None
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.scheduler = None
+
+    def set_progress(self, progress):
+        self.progress = max(self.progress, min(1.0, progress))
+        if self.scheduler is not None:
+            self.scheduler._notify('on_progress', self)
+
+    def add_output(self, path):
+        # Called before the job writes path. Only paths the job creates are removed if it fails or
+        # is cancelled; a file or folder that was already there belongs to someone else.
+        if not os.path.lexists(path):
+            self.outputs.append(path)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def remove_outputs(self):
+        for path in self.outputs:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+
+class JobScheduler:
+    def __init__(self, max_workers=None, cpu_slots=None, on_progress=None, on_finished=None, metrics_dir=None):
+        self.cpu_slots = cpu_slots or multiprocessing.cpu_count()
+        # By default four jobs share the machine, each with a quarter of the cores
+        self.max_workers = max_workers or max(1, min(4, self.cpu_slots))
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.metrics_dir = metrics_dir
+        # Re-entrant so callbacks may submit or cancel jobs
+        self.lock = threading.RLock()
+        self.idle = threading.Condition(self.lock)
+        self.queue = []  # heap of (-priority, sequence, job)
+        self.sequence = itertools.count()
+        self.jobs = {}
+        self.running = set()
+        self.slots_in_use = 0
+
+    @property
+    def default_cost(self):
+        return max(1, self.cpu_slots // self.max_workers)
+
+    def submit(self, kind, func, *args, priority=0, cost=None, on_progress=None, on_finished=None, **kwargs):
+        # func is called as func(*args, job=job, **kwargs) on a worker thread. on_progress and
+        # on_finished receive the job, from worker threads, in addition to the scheduler-wide callbacks.
+        cost = min(cost or self.default_cost, self.cpu_slots)
+        with self.lock:
+            job = Job(len(self.jobs) + 1, kind, func, args, kwargs, priority, cost, on_progress, on_finished)
+            job.scheduler = self
+            self.jobs[job.id] = job
+            heapq.heappush(self.queue, (-priority, next(self.sequence), job))
+            self._dispatch()
+        return job
+
+    # Stream copies are I/O bound and take one slot; anything that encodes takes the default share
+    def submit_cut(self, video_name, start_time=0, end_time=None, mode='accurate', priority=0, **callbacks):
+        return self.submit('cut', cut_video, video_name, start_time, end_time, mode, priority=priority,
+                           cost=1 if mode == 'copy' else None, **callbacks)
+
+    def submit_cut_ranges(self, video_name, ranges, mode='smart', priority=0, **callbacks):
+        return self.submit('cut', cut_ranges, video_name, ranges, mode, priority=priority,
+                           cost=1 if mode == 'copy' else None, **callbacks)
+
+    def submit_extract(self, video_name, start_time=0, end_time=None, priority=0, **callbacks):
+        return self.submit('extract', extract_audio, video_name, start_time, end_time, priority=priority, cost=1, **callbacks)
+
+    def submit_rotate(self, video_name, start_time=0, end_time=None, degree=0, priority=0, **callbacks):
+        return self.submit('rotate', rotate_video, video_name, start_time, end_time, degree, priority=priority, **callbacks)
+
+    def submit_segment(self, args, priority=0, **callbacks):
+        # segmentation.py arguments, e.g. ['auto', video_path, '5']. It runs locally (--local) so that
+        # cancelling kills its worker processes; the model server would keep running the job.
+        return self.submit('segment', run_python_script, 'segmentation.py', list(args) + ['--local'],
+                           priority=priority, cost=self.cpu_slots, **callbacks)
+
+    def submit_render(self, args, output_path=None, priority=0, workers=None, **callbacks):
+        # custom_effects.py arguments; the render uses as many processes as it is given slots
+        cost = min(workers or self.default_cost, self.cpu_slots)
+        return self.submit('render', run_python_script, 'custom_effects.py', list(args) + ['--workers', str(cost)],
+                           output_path=output_path, priority=priority, cost=cost, **callbacks)
+
+    def _dispatch(self):
+        # Caller holds the lock. Strict priority order: if the head job does not fit yet, the jobs
+        # behind it wait too, so a large job is never starved by a stream of small ones.
+        while self.queue and len(self.running) < self.max_workers:
+            job = self.queue[0][2]
+            if job.cancel_event.is_set():
+                heapq.heappop(self.queue)
+                self._finish(job, Job.CANCELLED)
+                continue
+            if self.slots_in_use + job.cost > self.cpu_slots:
+                break
+            heapq.heappop(self.queue)
+            job.status = Job.RUNNING
+            job.started_at = time.time()
+            self.running.add(job)
+            self.slots_in_use += job.cost
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _run(self, job):
+        status = Job.DONE
+        try:
+            job.result = job.func(*job.args, job=job, **job.kwargs)
+            if job.cancel_event.is_set():
+                status = Job.CANCELLED
+        except JobCancelled:
+            status = Job.CANCELLED
+        except Exception as e:
+            status = Job.FAILED
+            job.error = str(e)
+        if status != Job.DONE:
+            job.remove_outputs()
+        metrics.counter('jobs_total', 'Finished scheduler jobs', task=job.kind, status=status).inc()
+        metrics.histogram('job_seconds', 'Wall time per scheduler job', task=job.kind).observe(time.time() - job.started_at)
+        try:
+            metrics.export(self.metrics_dir, 'scheduler', task=job.kind, status=status)
+        except OSError as e:
+            print(f'Could not export metrics: {e}')
+        with self.lock:
+            self.running.discard(job)
+            self.slots_in_use -= job.cost
+            self._finish(job, status)
+            self._dispatch()
+
+    def _finish(self, job, status):
+        # Caller holds the lock
+        job.status = status
+        job.finished_at = time.time()
+        if status == Job.DONE:
+            job.progress = 1.0
+        self.idle.notify_all()
+        self._notify('on_finished', job)
+
+    def _notify(self, event, job):
+        for callback in (getattr(job, event), getattr(self, event)):
+            if callback is not None:
+                try:
+                    callback(job)
+                except Exception as e:
+                    print(f'Job callback failed: {e}')
+
+    def cancel(self, job_id):
+        # Queued jobs are dropped immediately; a running job's process tree is killed
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status not in (Job.QUEUED, Job.RUNNING):
+                return False
+            job.cancel()
+            if job.status == Job.QUEUED:
+                self.queue = [entry for entry in self.queue if entry[2] is not job]
+                heapq.heapify(self.queue)
+                self._finish(job, Job.CANCELLED)
+                self._dispatch()
+            return True
+
+    def cancel_all(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+
+    def wait(self, timeout=None):
+        # Blocks until nothing is queued or running
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.queue and not self.running, timeout)
+
+def _watch_progress_file(path, job, stop_event):
+    # The script rewrites the file atomically, so every read is a complete snapshot
+    while not stop_event.wait(PROGRESS_POLL_SECONDS):
+        snapshot = metrics.read_progress(path)
+        if snapshot is None or not snapshot.get('total'):
+            continue
+        job.rate = snapshot.get('rate')
+        job.eta_seconds = snapshot.get('eta_seconds')
+        job.set_progress(snapshot['done'] / snapshot['total'])
+
+def run_python_script(script, args, output_path=None, job=None):
+    # Runs one of the SegmentFX backend scripts in its own process group so it can be cancelled.
+    # Progress, throughput and ETA come from the script's progress file instead of its output.
+    if output_path is not None and job is not None:
+        job.add_output(output_path)
+    command = [sys.executable, os.path.join(SEGMENTFX_PYTHON_DIR, script)] + [str(arg) for arg in args]
+    if job is None:
+        run_process(command)
+        return output_path
+    progress_path = os.path.join(tempfile.gettempdir(), f'segmentfx_job_{os.getpid()}_{job.id}.json')
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=_watch_progress_file, args=(progress_path, job, stop_event), daemon=True)
+    watcher.start()
+    try:
+        run_process(command + ['--progress-file', progress_path], job)
+    finally:
+        stop_event.set()
+        watcher.join()
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+    return output_path
@@ -3,20 +3,34 @@
 @author: GitHub@Oscarshu0719
 """
 
-from PyQt5.QtCore import QThread, pyqtSignal
-from src.video_cutter import cut_video, extract_audio, rotate_video
+from PyQt5.QtCore import QObject, pyqtSignal
+from src.scheduler import Job, JobScheduler
 
-class Thread(QThread):
+_scheduler = None
+
+def get_scheduler():
+    # One scheduler per application, so every Thread shares the same worker limit
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = JobScheduler()
+    return _scheduler
+
+class Thread(QObject):
+    """
+        Qt front end for a scheduler job. Signals are emitted from the scheduler's worker
+        threads; Qt queues them to the receiver's thread.
+    """
     MSG_CUT_VIDEO = 1
     MSG_EXTRACT_AUDIO = 2
 
     signal_return_value = pyqtSignal(int, str)
+    signal_progress = pyqtSignal(float)
+    signal_error = pyqtSignal(str)
 
-    def __init__(self, parent=None):
-        super(Thread, self).__init__()
- 
-    def __del__(self):
-        self.wait() 
+    def __init__(self, parent=None, priority=0):
+        super(Thread, self).__init__(parent)
+        self.priority = priority
+        self.job = None
 
     def set_params(self, msg, video_name, start_time, end_time, rotate_degree=0):
         self.msg = msg
@@ -25,17 +39,40 @@ class Thread(QThread):
         self.end_time = end_time
         self.rotate_degree = int(rotate_degree)
 
-    def run(self):
+    def start(self):
+        scheduler = get_scheduler()
+        callbacks = {'priority': self.priority, 'on_progress': self._on_progress, 'on_finished': self._on_finished}
         if self.msg == Thread.MSG_CUT_VIDEO:
             if self.rotate_degree == 0:
-                subclip_name = cut_video(self.video_name, self.start_time, self.end_time)
+                self.job = scheduler.submit_cut(self.video_name, self.start_time, self.end_time, **callbacks)
             else:
-                subclip_name = rotate_video(self.video_name, self.start_time, self.end_time, self.rotate_degree)
+                self.job = scheduler.submit_rotate(self.video_name, self.start_time, self.end_time, self.rotate_degree, **callbacks)
         elif self.msg == Thread.MSG_EXTRACT_AUDIO:
-            subclip_name = extract_audio(self.video_name, self.start_time, self.end_time)
+            self.job = scheduler.submit_extract(self.video_name, self.start_time, self.end_time, **callbacks)
+
+    def _on_progress(self, job):
+        self.signal_progress.emit(job.progress)
+
+    def _on_finished(self, job):
+        if job.status == Job.DONE:
+            self.signal_return_value.emit(1, job.result)
+        elif job.status == Job.FAILED:
+            self.signal_error.emit(job.error)
+
+    def isRunning(self):
+        return self.job is not None and self.job.status in (Job.QUEUED, Job.RUNNING)
 
-        self.signal_return_value.emit(1, subclip_name)
+    def wait(self, timeout=None):
+        # Like QThread.wait: timeout in milliseconds (None waits for ever); False if the job is
+        # still queued or running when it expires. There is no finalizer that waits: the job holds
+        # this object through its callbacks until it finishes, and a finished job needs no cleanup.
+        if self.job is None:
+            return True
+        scheduler = self.job.scheduler
+        with scheduler.lock:
+            return scheduler.idle.wait_for(lambda: not self.isRunning(), None if timeout is None else timeout / 1000)
 
     def stop(self):
-        self.terminate()
-        
\ No newline at end of file
+        # Cooperative: kills the job's ffmpeg process tree and removes its partial output
+        if self.job is not None:
+            get_scheduler().cancel(self.job.id)
@@ -3,64 +3,359 @@
 @author: GitHub@Oscarshu0719
 """
 
+import os
+import shutil
+import signal
 import subprocess
+import tempfile
+import threading
+import time
 
-def run(cmd):
+# The media probe cache and the metrics live with the SegmentFX Python backend and are shared with it
+from ClaudeSeg.SegmentFx.python import metrics
+from ClaudeSeg.SegmentFx.python.media_probe import probe_media, run_ffprobe
+
+# Tolerance when comparing cut points with keyframe timestamps, in seconds
+KEYFRAME_EPSILON = 0.001
+# Ranges per ffmpeg invocation in cut_ranges; keeps the command line under the Windows limit
+MAX_RANGES_PER_RUN = 16
+# Encoders for re-encoding boundary GOPs in the source's own codec, so the parts can be joined by
+# stream copy, and the container the parts are joined through. MPEG-TS carries the parameter sets
+# (SPS/PPS, VOL headers) in-band in front of every keyframe, so each part keeps its own when the
+# concat demuxer joins them; VP9 and ProRes frames describe themselves and go through Matroska
+SMART_CUT_ENCODERS = {
+    'h264': ('libx264', '.ts'),
+    'hevc': ('libx265', '.ts'),
+    'mpeg4': ('mpeg4', '.ts'),
+    'vp9': ('libvpx-vp9', '.mkv'),
+    'prores': ('prores_ks', '.mkv')
+}
+# Containers whose video track keeps the source's timescale when a smart cut is remuxed into them
+TIMESCALE_CONTAINERS = ('.mp4', '.mov', '.m4v')
+# Frames a smart cut may differ from the planned length before it is reported as broken
+SMART_CUT_FRAME_TOLERANCE = 1
+
+class JobCancelled(Exception):
+    pass
+
+def kill_process_tree(process):
+    # The command runs in its own process group / session, so this also reaches ffmpeg
+    # started through the shell and any workers it spawned
+    if process.poll() is not None:
+        return
+    if os.name == 'nt':
+        subprocess.run(f'taskkill /F /T /PID {process.pid}', shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        try:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait(timeout=5)
+        except ProcessLookupError:
+            pass
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+    process.wait()
+
+def _watch_cancel(process, job):
+    while process.poll() is None:
+        if job.cancel_event.wait(0.2):
+            kill_process_tree(process)
+            return
+
+def run_process(cmd, job=None, parse_line=None, shell=False):
+    """
+        Runs cmd and passes every output line to parse_line, which returns (consumed, progress).
+        Lines that are not consumed are printed; progress (0-1) is reported to job. When job is
+        cancelled the whole process tree is killed and JobCancelled is raised.
+    """
+    if os.name == 'nt':
+        group_kwargs = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        group_kwargs = {'start_new_session': True}
     process = subprocess.Popen(
         cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        shell=True,
+        shell=shell,
         encoding='utf-8',
-        errors='replace'
+        errors='replace',
+        **group_kwargs
     )
+    if job is not None:
+        # Reading stdout blocks, so cancellation is watched from a second thread
+        threading.Thread(target=_watch_cancel, args=(process, job), daemon=True).start()
 
-    while True:
-        realtime_output = process.stdout.readline()
+    for realtime_output in process.stdout:
+        realtime_output = realtime_output.strip()
+        consumed, progress = parse_line(realtime_output) if parse_line else (False, None)
+        if progress is not None and job is not None:
+            job.set_progress(progress)
+        if realtime_output and not consumed:
+            print(realtime_output, flush=True)
+
+    process.wait()
+    if job is not None and job.cancel_event.is_set():
+        raise JobCancelled(cmd)
+    if process.returncode != 0:
+        raise RuntimeError(f'Command failed with exit code {process.returncode}: {cmd}')
+    return process
 
-        if realtime_output == '' and process.poll() is not None:
-            break
+def run(cmd, job=None, duration=None, progress_span=(0.0, 1.0)):
+    # ffmpeg writes key=value progress blocks to stdout (-progress pipe:1); with -loglevel error
+    # everything else it prints is an error message. Each run is timed as one "encode" stage call
+    # (stream copies included) covering the frames ffmpeg reports.
+    if cmd.startswith('ffmpeg '):
+        cmd = 'ffmpeg -progress pipe:1 -nostats -loglevel error ' + cmd[len('ffmpeg '):]
+    span_start, span_end = progress_span
+    stats = {'frame': 0, 'out_time': 0.0}
 
-        if realtime_output:
-            print(realtime_output.strip(), flush=True)
+    def parse_line(line):
+        key, separator, value = line.partition('=')
+        if not separator or not key.replace('_', '').isalnum():
+            return False, None
+        if key == 'frame' and value.isdigit():
+            stats['frame'] = int(value)
+        elif key == 'fps' and job is not None:
+            try:
+                job.rate = float(value)
+            except ValueError:
+                pass
+        elif key == 'speed' and value.endswith('x') and job is not None and duration:
+            # speed is media seconds per wall second, so the rest of the range takes this long
+            try:
+                speed = float(value[:-1])
+            except ValueError:
+                speed = 0
+            if speed > 0:
+                job.eta_seconds = max(0.0, duration - stats['out_time']) / speed
+        # out_time_ms is in microseconds too (a long-standing ffmpeg quirk)
+        if key in ('out_time_us', 'out_time_ms') and value.isdigit() and duration:
+            stats['out_time'] = int(value) / 1e6
+            return True, span_start + (span_end - span_start) * min(1.0, stats['out_time'] / duration)
+        if key == 'progress' and value == 'end':
+            return True, span_end
+        return True, None
 
+    start_time = time.perf_counter()
+    process = run_process(cmd, job, parse_line, shell=True)
+    metrics.observe_stage('encode', time.perf_counter() - start_time, stats['frame'])
+    metrics.counter('ffmpeg_runs_total', 'ffmpeg commands run by video_cutter').inc()
     return process
 
+def _register_output(job, path):
+    # Outputs are removed by the scheduler if the job fails or is cancelled
+    if job is not None:
+        job.add_output(path)
+
+def _threads(job):
+    # Encoder threads granted by the scheduler; 0 lets ffmpeg use every core
+    return job.threads if job is not None else 0
+
 def get_video_stream(path):
+    # Duration in seconds, from the media probe cache (ffprobe runs once per file)
+    return probe_media(path)['duration']
+
+def _profile_args(info):
+    # ffprobe profile names mapped to the encoder's -profile:v values, e.g. 'High 4:2:2' -> 'high422'
+    codec, profile, level = info['codec'], (info.get('profile') or '').lower(), info.get('level')
+    if codec == 'h264':
+        name = profile.replace('constrained ', '').replace('4:2:2', '422').replace('4:4:4 predictive', '444').replace(' ', '')
+        args = [f'-profile:v {name}'] if name in ('baseline', 'main', 'high', 'high10', 'high422', 'high444') else []
+        if level and level > 0:
+            args.append(f'-level:v {level / 10:g}')
+        return args
+    if codec == 'hevc':
+        name = profile.replace(' ', '')
+        args = [f'-profile:v {name}'] if name in ('main', 'main10', 'mainstillpicture') else []
+        x265_params = ['log-level=error']
+        if level and level > 0:
+            x265_params.append(f'level-idc={level / 30:g}')  # general_level_idc is 30 x the level
+        return args + ['-x265-params ' + ':'.join(x265_params)]
+    if codec == 'vp9' and profile.startswith('profile '):
+        return [f'-profile:v {profile[len("profile "):]}']
+    if codec == 'prores':
+        name = profile.replace(' ', '')
+        return [f'-profile:v {name}'] if name in ('proxy', 'lt', 'standard', 'hq', '4444', '4444xq') else []
+    return []
+
+def smart_cut_encoder_args(info, job=None):
+    """
+        Encoder options for the re-encoded boundary parts of a smart cut: the source's codec,
+        profile, level, pixel format, time base and GOP length, so the encoded frames fit between
+        the stream-copied ones.
+    """
+    args = [f'-c:v {SMART_CUT_ENCODERS[info["codec"]][0]}', f'-pix_fmt {info["pix_fmt"]}'] + _profile_args(info)
+    # MPEG-4 part 2 cannot store time bases finer than 1/65535 (MPEG-TS sources use 1/90000)
+    if info.get('time_base') and not (info['codec'] == 'mpeg4' and int(info['time_base'].split('/')[1]) > 65535):
+        args.append(f'-enc_time_base:v {info["time_base"]}')
+    keyframes = info['keyframes']
+    if len(keyframes) >= 2 and info['fps']:
+        gop = max(b - a for a, b in zip(keyframes, keyframes[1:]))
+        args.append(f'-g {max(1, round(gop * info["fps"]))}')
+    args.append(f'-threads {_threads(job)}')
+    return ' '.join(args)
+
+def plan_cut(start_time, end_time, keyframes, mode='smart', duration=None):
+    """
+        Splits a cut into (start, end, copy) parts.
+            copy: one stream-copied part, with the start moved back to the previous keyframe.
+            smart: the GOPs fully inside the range are stream-copied and only the
+                partial GOPs at either end are re-encoded.
+            accurate: one re-encoded part.
+    """
+    if mode == 'copy':
+        previous = [k for k in keyframes if k <= start_time + KEYFRAME_EPSILON]
+        return [(previous[-1] if previous else 0, end_time, True)]
+    if mode == 'smart':
+        boundaries = [k for k in keyframes if start_time - KEYFRAME_EPSILON <= k <= end_time + KEYFRAME_EPSILON]
+        # The end of the stream closes the last GOP just like a keyframe does
+        if duration and end_time >= duration - KEYFRAME_EPSILON:
+            boundaries.append(end_time)
+        if len(boundaries) >= 2:
+            first_keyframe, last_keyframe = boundaries[0], boundaries[-1]
+            parts = []
+            if first_keyframe - start_time > KEYFRAME_EPSILON:
+                parts.append((start_time, first_keyframe, False))
+            parts.append((first_keyframe, last_keyframe, True))
+            if end_time - last_keyframe > KEYFRAME_EPSILON:
+                parts.append((last_keyframe, end_time, False))
+            return parts
+    return [(start_time, end_time, False)]
+
+def _cut_name(video_name, start_time, end_time, extension=None):
+    dot_index = video_name.rfind('.')
+    return video_name[: dot_index] + '_{}_{}'.format(start_time, end_time) + (extension or video_name[dot_index: ])
+
+def verify_cut(path, start_time, end_time, fps):
+    """
+        Probes a finished cut and raises RuntimeError when its video frame count is off from the
+        planned range by more than SMART_CUT_FRAME_TOLERANCE frames, or its duration by more than
+        one frame on top of that (the audio may run up to a frame past the video).
+    """
+    info = run_ffprobe(path)
+    expected_frames = round((end_time - start_time) * fps)
+    if abs(info['frame_count'] - expected_frames) > SMART_CUT_FRAME_TOLERANCE:
+        raise RuntimeError(f'Smart cut {path} has {info["frame_count"]} frames, expected {expected_frames}')
+    if abs(info['duration'] - (end_time - start_time)) > (SMART_CUT_FRAME_TOLERANCE + 1) / fps:
+        raise RuntimeError(f'Smart cut {path} lasts {info["duration"]:.3f}s, expected {end_time - start_time:.3f}s')
+    return info
+
+def cut_ranges(video_name, ranges, mode='smart', job=None):
+    """
+        Cuts every (start_time, end_time) range out of video_name. The input is opened once
+        per part with input seeking (-ss before -i), so nothing before a cut point is decoded,
+        and up to MAX_RANGES_PER_RUN ranges are written by a single ffmpeg run.
+        Returns the output file names in range order.
+    """
+    # Keyframe times count from the container start, like -ss and the cut points
+    info = probe_media(video_name)
+    duration = info['duration']
+    keyframes = info['keyframes'] if mode in ('copy', 'smart') else []
+    if mode == 'smart' and (info['codec'] not in SMART_CUT_ENCODERS or info.get('open_gop')):
+        # No matching encoder to splice with, or the first copied frames would reference the GOP
+        # before the cut (open GOPs, the x265 default)
+        mode = 'accurate'
+    if mode == 'smart':
+        encoder_args = smart_cut_encoder_args(info, job)
+        part_extension = SMART_CUT_ENCODERS[info['codec']][1]
+        # Copied mpeg4 keeps its VOL header in the extradata only, which MPEG-TS does not carry
+        copy_args = '-bsf:v dump_extra=freq=keyframe' if info['codec'] == 'mpeg4' else ''
+        remux_args = f'-video_track_timescale {info["time_base"].split("/")[1]}' \
+            if info.get('time_base') and os.path.splitext(video_name)[1].lower() in TIMESCALE_CONTAINERS else ''
+        # -t on a stream copy is checked against the decode timestamps, which trail the presentation
+        # timestamps by the reorder delay; without this the copied part would also carry the keyframe
+        # that starts the re-encoded tail (and the B-frames decoded after it)
+        copy_trim = info.get('has_b_frames', 0) / info['fps'] + KEYFRAME_EPSILON if info['fps'] else 0.0
+
+    jobs = []
+    for start_time, end_time in ranges:
+        if not end_time:
+            end_time = duration
+        cut_video_name = _cut_name(video_name, start_time, end_time)
+        _register_output(job, cut_video_name)
+        start_time, end_time = float(start_time), float(end_time)
+        jobs.append((start_time, end_time, cut_video_name, plan_cut(start_time, end_time, keyframes, mode, duration)))
+
+    temp_dir = tempfile.mkdtemp(prefix='video_cutter_')
+    batch_count = -(-len(jobs) // MAX_RANGES_PER_RUN)
     try:
-        result = subprocess.run(f'ffprobe -i "{path}" -show_entries format=duration -v quiet -of csv="p=0"', 
-            shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8", timeout=1)
-        if result.returncode == 0:
-            return result.stdout.strip()
-        else:
-            return 0
-    except Exception as err:
-        print(str(err.stderr, encoding='utf8'))
-        return 0
-
-def cut_video(video_name, start_time=0, end_time=None):
+        for batch_start in range(0, len(jobs), MAX_RANGES_PER_RUN):
+            batch = jobs[batch_start: batch_start + MAX_RANGES_PER_RUN]
+            inputs = []
+            outputs = []
+            for job_index, (start_time, end_time, cut_video_name, parts) in enumerate(batch, batch_start):
+                for part_index, (part_start, part_end, copy) in enumerate(parts):
+                    input_index = len(inputs)
+                    part_length = part_end - part_start
+                    if copy and mode == 'smart' and part_end < duration - KEYFRAME_EPSILON:
+                        part_length -= copy_trim  # Stop before the keyframe that ends the part
+                    inputs.append(f'-ss {part_start} -t {part_length} -i "{video_name}"')
+                    if len(parts) == 1:
+                        # Single part: write the final file directly, audio included
+                        if copy:
+                            audio_index = input_index
+                            if part_length < part_end - part_start:
+                                # The audio has no reorder delay and still runs to part_end
+                                audio_index = len(inputs)
+                                inputs.append(f'-ss {part_start} -t {part_end - part_start} -i "{video_name}"')
+                            outputs.append(f'-map {input_index}:v:0 -map {audio_index}:a? -c copy -avoid_negative_ts make_zero "{cut_video_name}"')
+                        else:
+                            outputs.append(f'-map {input_index}:v:0 -map {input_index}:a? -threads {_threads(job)} "{cut_video_name}"')
+                        continue
+                    part_name = os.path.join(temp_dir, f'part_{job_index:04d}_{part_index}{part_extension}')
+                    if copy:
+                        outputs.append(f'-map {input_index}:v:0 -an -c:v copy {copy_args} -avoid_negative_ts make_zero "{part_name}"')
+                    else:
+                        outputs.append(f'-map {input_index}:v:0 -an {encoder_args} "{part_name}"')
+            # Splicing is a small, copy-only step, so the encode batches carry almost all the progress
+            batch_index = batch_start // MAX_RANGES_PER_RUN
+            run('ffmpeg -y ' + ' '.join(inputs) + ' ' + ' '.join(outputs), job,
+                max(end_time - start_time for start_time, end_time, _, _ in batch),
+                (0.95 * batch_index / batch_count, 0.95 * (batch_index + 1) / batch_count))
+
+        # Join the spliced parts and copy the audio for the whole range alongside them
+        for job_index, (start_time, end_time, cut_video_name, parts) in enumerate(jobs):
+            if len(parts) == 1:
+                continue
+            list_name = os.path.join(temp_dir, f'parts_{job_index:04d}.txt')
+            with open(list_name, 'w', encoding='utf-8') as f:
+                for part_index in range(len(parts)):
+                    f.write(f"file 'part_{job_index:04d}_{part_index}{part_extension}'\n")
+            run(f'ffmpeg -y -f concat -safe 0 -i "{list_name}" -ss {start_time} -t {end_time - start_time} -i "{video_name}" '
+                f'-map 0:v -map 1:a? -c copy {remux_args} "{cut_video_name}"', job)
+            verify_cut(cut_video_name, start_time, end_time, info['fps'])
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return [cut_video_name for _, _, cut_video_name, _ in jobs]
+
+def cut_video(video_name, start_time=0, end_time=None, mode='accurate', job=None):
+    if mode != 'accurate':
+        return cut_ranges(video_name, [(start_time, end_time)], mode, job)[0]
+
     if not end_time:
         end_time = get_video_stream(video_name)
 
-    dot_index = video_name.rfind('.')
-    cut_video_name = video_name[: dot_index] + '_{}_{}'.format(start_time, end_time) + video_name[dot_index: ]
+    cut_video_name = _cut_name(video_name, start_time, end_time)
+    _register_output(job, cut_video_name)
 
-    run(f'ffmpeg -i "{video_name}" -ss {start_time} -t {end_time - start_time} "{cut_video_name}"')
+    run(f'ffmpeg -y -ss {start_time} -i "{video_name}" -t {end_time - start_time} -threads {_threads(job)} "{cut_video_name}"',
+        job, end_time - start_time)
 
     return cut_video_name
 
-def extract_audio(video_name, start_time=0, end_time=None):
+def extract_audio(video_name, start_time=0, end_time=None, job=None):
     if not end_time:
         end_time = get_video_stream(video_name)
 
-    dot_index = video_name.rfind('.')
-    cut_audio_name = video_name[: dot_index] + '_{}_{}'.format(start_time, end_time) + '.mp3'
+    cut_audio_name = _cut_name(video_name, start_time, end_time, '.mp3')
+    _register_output(job, cut_audio_name)
 
-    run(f'ffmpeg -i "{video_name}" -ss {start_time} -t {end_time - start_time} -q:a 0 -map a "{cut_audio_name}"')
+    run(f'ffmpeg -y -ss {start_time} -i "{video_name}" -t {end_time - start_time} -q:a 0 -map a "{cut_audio_name}"',
+        job, end_time - start_time)
 
     return cut_audio_name
 
-def rotate_video(video_name, start_time=0, end_time=None, degree=0):
+def rotate_video(video_name, start_time=0, end_time=None, degree=0, job=None):
     if not end_time:
         end_time = get_video_stream(video_name)
 
@@ -75,10 +370,11 @@ def rotate_video(video_name, start_time=0, end_time=None, degree=0):
         '180': 'transpose=2,transpose=2', 
         '270': 'transpose=2'
     }
-    dot_index = video_name.rfind('.')
-    cut_video_name = video_name[: dot_index] + '_{}_{}'.format(start_time, end_time) + video_name[dot_index: ]
+    cut_video_name = _cut_name(video_name, start_time, end_time)
+    _register_output(job, cut_video_name)
 
     traspose_method = transpose_dict[str(degree)]
-    run(f'ffmpeg -i "{video_name}" -ss {start_time} -t {end_time - start_time} -vf "{traspose_method}" "{cut_video_name}"')
+    run(f'ffmpeg -y -ss {start_time} -i "{video_name}" -t {end_time - start_time} -vf "{traspose_method}" -threads {_threads(job)} "{cut_video_name}"',
+        job, end_time - start_time)
 
     return cut_video_name
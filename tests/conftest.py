@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The SegmentFX backend modules import each other by their top-level names, as they do when run
+# from ClaudeSeg/SegmentFx/python; the repository root makes src importable.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEGMENTFX_PYTHON_DIR = os.path.join(ROOT, "ClaudeSeg", "SegmentFx", "python")
+for path in (ROOT, SEGMENTFX_PYTHON_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,137 @@
+import json
+import os
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from mask_store import MaskStoreReader
+from segmentation import MASK_STORE_FILENAME, AutoMaskWriter
+
+WIDTH, HEIGHT = 32, 24
+
+
+def frame_result(frame_num, count=2):
+    # A label map with count horizontal bands and the metadata of each band's object
+    labels = np.zeros((HEIGHT, WIDTH), dtype=np.uint8)
+    masks = []
+    for i in range(count):
+        labels[i * 4:i * 4 + 3, frame_num:frame_num + 10] = i + 1
+        masks.append({'object_id': i * 3, 'bbox': [frame_num, i * 4, 10, 3], 'area': 30.0, 'stability_score': 0.9})
+    return labels, masks
+
+
+def make_writer(tmp_path, mask_format="container", frame_count=6, window=None):
+    return AutoMaskWriter(str(tmp_path), (WIDTH, HEIGHT), 25.0, frame_count, mask_format=mask_format, window=window)
+
+
+def video_frame_count(tmp_path):
+    video = cv2.VideoCapture(str(tmp_path / 'combined_masks.mp4'))
+    count = 0
+    while video.read()[0]:
+        count += 1
+    video.release()
+    return count
+
+
+def test_out_of_order_results_are_written_in_order(tmp_path):
+    writer = make_writer(tmp_path)
+    for frame_num in (2, 0, 3, 1, 5, 4):
+        writer.add(frame_num, frame_result(frame_num))
+    # Frames 2 and 3 waited for 1, and 5 for 4
+    assert writer.max_pending == 3
+    assert writer.next_frame == 6 and not writer.pending
+    writer.close()
+
+    with MaskStoreReader(str(tmp_path / MASK_STORE_FILENAME)) as reader:
+        assert reader.frames() == list(range(6))
+        assert reader.read_frame(4)[0]['bbox'] == [4, 0, 10, 3]
+    assert video_frame_count(tmp_path) == 6
+
+
+def test_close_fills_missing_frames(tmp_path):
+    writer = make_writer(tmp_path)
+    writer.add(0, frame_result(0))
+    writer.add(2, frame_result(2))
+    writer.add(3, None)  # Failed to segment
+    assert writer.next_frame == 1 and sorted(writer.pending) == [2, 3]
+    writer.close()
+
+    with MaskStoreReader(str(tmp_path / MASK_STORE_FILENAME)) as reader:
+        assert reader.frames() == [0, 2]
+    # The lost frame and the failed one still get a (blank) combined-mask frame
+    assert video_frame_count(tmp_path) == 4
+    with open(tmp_path / 'mask_objects.json') as f:
+        assert json.load(f) == {'mask_store': MASK_STORE_FILENAME, 'object_ids': [0, 3], 'complete': True}
+
+
+def test_window_holds_the_decoder_until_frames_are_written(tmp_path):
+    writer = make_writer(tmp_path, window=2)
+    stop_event = threading.Event()
+    writer.wait_for_window(1, stop_event)  # Inside the window, returns at once
+
+    released = threading.Event()
+
+    def decoder():
+        writer.wait_for_window(2, stop_event)
+        released.set()
+
+    thread = threading.Thread(target=decoder)
+    thread.start()
+    assert not released.wait(0.2)
+    writer.add(0, frame_result(0))
+    assert released.wait(5)
+    thread.join()
+    writer.close()
+
+
+def test_window_wait_ends_on_stop(tmp_path):
+    writer = make_writer(tmp_path, window=1)
+    stop_event = threading.Event()
+    stop_event.set()
+    writer.wait_for_window(5, stop_event)
+    writer.close()
+
+
+def test_container_is_readable_while_running(tmp_path):
+    writer = make_writer(tmp_path)
+    try:
+        writer.add(0, frame_result(0, count=1))
+        writer.add(1, frame_result(1))
+        with MaskStoreReader(str(tmp_path / MASK_STORE_FILENAME)) as reader:
+            assert reader.frames() == [0, 1]
+            np.testing.assert_array_equal(reader.read_frame(1)[1]['segmentation'], frame_result(1)[0] == 2)
+        with open(tmp_path / 'mask_objects.json') as f:
+            assert json.load(f) == {'mask_store': MASK_STORE_FILENAME, 'object_ids': [0, 3], 'complete': False}
+    finally:
+        writer.close()
+
+
+def test_png_metadata_is_streamed(tmp_path):
+    writer = make_writer(tmp_path, mask_format="png")
+    writer.add(1, frame_result(1))
+    writer.add(0, frame_result(0))
+    # Until close() the array is left open; every record written so far is complete
+    with open(tmp_path / 'mask_metadata.json') as f:
+        partial = json.loads(f.read() + "]")
+    assert [(entry['frame'], entry['object_id']) for entry in partial] == [(0, 0), (0, 3), (1, 0), (1, 3)]
+    writer.add(2, None)
+    writer.close()
+
+    with open(tmp_path / 'mask_metadata.json') as f:
+        metadata = json.load(f)
+    assert metadata == partial
+    assert metadata[3] == {'frame': 1, 'object_id': 3, 'filename': 'mask_frame0001_object03.png',
+                           'bbox': [1, 4, 10, 3], 'area': 30.0, 'stability_score': pytest.approx(0.9)}
+    png = cv2.imread(str(tmp_path / metadata[3]['filename']), cv2.IMREAD_GRAYSCALE)
+    np.testing.assert_array_equal(png > 127, frame_result(1)[0] == 2)
+    assert not os.path.exists(tmp_path / MASK_STORE_FILENAME)
+    assert not os.path.exists(tmp_path / 'mask_objects.json')
+
+
+def test_png_metadata_without_masks_is_an_empty_array(tmp_path):
+    writer = make_writer(tmp_path, mask_format="png")
+    writer.close()
+    with open(tmp_path / 'mask_metadata.json') as f:
+        assert json.load(f) == []
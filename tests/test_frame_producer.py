@@ -0,0 +1,57 @@
+import queue
+import types
+
+import cv2
+import numpy as np
+import pytest
+
+from segmentation import FrameProducer
+
+
+@pytest.fixture
+def clip(tmp_path):
+    path = str(tmp_path / 'clip.mp4')
+    video = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), 25.0, (32, 24))
+    for i in range(10):
+        video.write(np.full((24, 32, 3), i * 20, dtype=np.uint8))
+    video.release()
+    return path
+
+
+def test_stop_releases_a_producer_waiting_for_a_slot(clip):
+    # Every ring slot is taken and no worker is left to free one
+    ring = types.SimpleNamespace(frames={})
+    free_slots = queue.Queue()
+    free_slots.put(0)
+    task_queue = queue.Queue(maxsize=4)
+    producer = FrameProducer(clip, task_queue, 2, ring=ring, free_slots=free_slots)
+    producer.start()
+    assert task_queue.get(timeout=5) == (0, 0, (32, 24))
+    assert not producer.done.wait(0.3)
+    producer.stop()
+    producer.join(5)
+    assert not producer.is_alive() and producer.done.is_set()
+    assert producer.frames_produced == 1
+    # The end signals still reach the workers
+    assert [task_queue.get_nowait() for _ in range(2)] == [None, None]
+
+
+def test_stop_releases_a_producer_blocked_on_a_full_queue(clip):
+    task_queue = queue.Queue(maxsize=2)
+    producer = FrameProducer(clip, task_queue, 1)
+    producer.start()
+    assert not producer.done.wait(0.3)
+    producer.stop()
+    producer.join(5)
+    assert not producer.is_alive() and producer.done.is_set()
+    assert producer.frames_produced == 2
+
+
+def test_producer_queues_every_frame_then_end_signals(clip):
+    task_queue = queue.Queue()
+    producer = FrameProducer(clip, task_queue, 2)
+    producer.start()
+    producer.join(5)
+    tasks = [task_queue.get_nowait() for _ in range(12)]
+    assert [task[0] for task in tasks[:10]] == list(range(10))
+    assert tasks[10:] == [None, None]
@@ -0,0 +1,37 @@
+import pytest
+
+import custom_effects
+from custom_effects import keyframe_ranges
+
+
+def probe_with(keyframes, start_offset=0.0):
+    return lambda path: {"keyframes": keyframes, "start_offset": start_offset}
+
+
+def test_ranges_start_on_keyframes(monkeypatch):
+    monkeypatch.setattr(custom_effects, "probe_media", probe_with([0.0, 2.0, 4.0, 6.0, 8.0]))
+    assert keyframe_ranges("clip.mp4", 250, 25.0, chunk_size=100) == [(0, 100), (100, 200), (200, None)]
+
+
+def test_short_gops_are_merged_up_to_chunk_size(monkeypatch):
+    monkeypatch.setattr(custom_effects, "probe_media", probe_with([0.0, 1.0, 2.0, 3.0, 4.0, 5.0]))
+    assert keyframe_ranges("clip.mp4", 150, 25.0, chunk_size=60) == [(0, 75), (75, None)]
+
+
+def test_keyframes_are_counted_from_the_first_video_frame(monkeypatch):
+    # The probe reports times from the container start; the first frame sits 0.022s after it
+    monkeypatch.setattr(custom_effects, "probe_media", probe_with([0.022, 4.022, 8.022], start_offset=0.022))
+    assert keyframe_ranges("clip.mp4", 250, 25.0, chunk_size=100) == [(0, 100), (100, 200), (200, None)]
+
+
+def test_keyframes_past_the_frame_count_are_ignored(monkeypatch):
+    monkeypatch.setattr(custom_effects, "probe_media", probe_with([0.0, 4.0, 20.0]))
+    assert keyframe_ranges("clip.mp4", 150, 25.0, chunk_size=60) == [(0, 100), (100, None)]
+
+
+@pytest.mark.parametrize("error", [OSError, RuntimeError, ValueError])
+def test_fixed_ranges_without_a_probe(monkeypatch, error):
+    def fail(path):
+        raise error("ffprobe unavailable")
+    monkeypatch.setattr(custom_effects, "probe_media", fail)
+    assert keyframe_ranges("clip.mp4", 250, 25.0, chunk_size=100) == [(0, 100), (100, 200), (200, None)]
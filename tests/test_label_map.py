@@ -0,0 +1,102 @@
+import numpy as np
+import pytest
+
+from label_map import (OVERLAP_POLICIES, combined_mask, label_dtype, object_mask, paint_labels, select_objects,
+                       upscale_labels)
+from mask_store import encode_label_rle, encode_rle
+
+
+def box_mask(x1, y1, x2, y2, shape=(10, 10)):
+    mask = np.zeros(shape, dtype=bool)
+    mask[y1:y2, x1:x2] = True
+    return mask
+
+
+def overlapping_masks():
+    # A large object with a small one on top of it; the small one is less stable
+    large = box_mask(0, 0, 8, 8)
+    small = box_mask(2, 2, 5, 5)
+    return [
+        {'segmentation': large, 'area': float(large.sum()), 'stability_score': 0.95},
+        {'segmentation': small, 'area': float(small.sum()), 'stability_score': 0.80},
+    ]
+
+
+@pytest.mark.parametrize("overlap, winner", [
+    ("smaller-on-top", 2),
+    ("larger-on-top", 1),
+    ("score", 1),
+])
+def test_overlap_policy_decides_shared_pixels(overlap, winner):
+    labels = paint_labels(overlapping_masks(), (10, 10), overlap=overlap)
+    assert labels[3, 3] == winner
+    # Pixels only one object covers are that object's whatever the policy
+    assert labels[0, 0] == 1 and labels[9, 9] == 0
+
+
+def test_score_policy_follows_stability():
+    masks = overlapping_masks()
+    masks[1]['stability_score'] = 0.99
+    assert paint_labels(masks, (10, 10), overlap="score")[3, 3] == 2
+
+
+def test_unknown_overlap_policy():
+    assert "bottom" not in OVERLAP_POLICIES
+    with pytest.raises(ValueError):
+        paint_labels(overlapping_masks(), (10, 10), overlap="bottom")
+
+
+def test_paint_into_existing_buffer():
+    out = np.full((10, 10), 7, dtype=np.uint8)
+    labels = paint_labels(overlapping_masks(), (10, 10), out=out)
+    assert labels is out
+    assert set(np.unique(out)) == {0, 1, 2}
+
+
+def test_label_dtype_widens_past_255_objects():
+    assert label_dtype(255) == np.uint8
+    assert label_dtype(256) == np.uint16
+    masks = [{'segmentation': box_mask(i % 10, i // 10, i % 10 + 1, i // 10 + 1, (30, 10)), 'area': 1.0}
+             for i in range(300)]
+    labels = paint_labels(masks, (30, 10))
+    assert labels.dtype == np.uint16 and labels.max() == 300
+
+
+def test_upscale_keeps_labels():
+    labels = paint_labels(overlapping_masks(), (10, 10))
+    upscaled = upscale_labels(labels, (40, 30))
+    assert upscaled.shape == (30, 40)
+    assert set(np.unique(upscaled)) == set(np.unique(labels))
+
+
+def test_object_masks_and_selection():
+    labels = paint_labels(overlapping_masks(), (10, 10))
+    object_ids = [4, 9]  # Label 1 is object 4, label 2 object 9
+    np.testing.assert_array_equal(combined_mask(labels) > 0, overlapping_masks()[0]['segmentation'])
+    np.testing.assert_array_equal(object_mask(labels, 2) > 0, labels == 2)
+    np.testing.assert_array_equal(select_objects(labels, object_ids, {9}), object_mask(labels, 2))
+    np.testing.assert_array_equal(select_objects(labels, object_ids), combined_mask(labels))
+    np.testing.assert_array_equal(select_objects(labels, object_ids, {4, 9}), combined_mask(labels))
+    assert select_objects(labels, object_ids, {5}) is None
+    assert select_objects(np.zeros((10, 10), dtype=np.uint8), []) is None
+
+
+@pytest.mark.parametrize("labels", [
+    np.zeros((4, 5), dtype=np.uint8),
+    np.full((4, 5), 2, dtype=np.uint8),
+    np.array([[1, 1, 2, 0, 3, 3, 1]], dtype=np.uint8),
+    np.array([[0, 2, 2, 1]], dtype=np.uint8),
+])
+def test_label_rle_matches_per_object_rle(labels):
+    rle = encode_label_rle(labels, 3)
+    for label, counts in enumerate(rle, start=1):
+        assert counts.dtype == np.uint32
+        np.testing.assert_array_equal(counts, encode_rle(labels == label))
+
+
+def test_label_rle_random():
+    random = np.random.RandomState(0)
+    for _ in range(30):
+        labels = random.randint(0, 5, size=tuple(random.randint(1, 20, 2))).astype(np.uint8)
+        for label, counts in enumerate(encode_label_rle(labels, 6), start=1):
+            np.testing.assert_array_equal(counts, encode_rle(labels == label))
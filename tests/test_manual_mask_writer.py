@@ -0,0 +1,35 @@
+import json
+
+import numpy as np
+
+from mask_store import MaskStoreReader
+from segmentation import MASK_STORE_FILENAME, ManualMaskWriter
+
+
+def square_mask(x):
+    mask = np.zeros((24, 32), dtype=np.uint8)
+    mask[4:12, x:x + 8] = 255
+    return mask
+
+
+def test_close_marks_the_objects_file(tmp_path):
+    writer = ManualMaskWriter(str(tmp_path), 25.0)
+    writer.add(square_mask(2))
+    writer.add_skipped(np.zeros((12, 16, 2), dtype=np.float32))  # No motion: the previous mask again
+    writer.add(np.zeros((24, 32), dtype=np.uint8))
+    writer.close()
+
+    with open(tmp_path / 'mask_objects.json') as f:
+        assert json.load(f) == {'mask_store': MASK_STORE_FILENAME, 'object_ids': [0], 'complete': True}
+    with MaskStoreReader(str(tmp_path / MASK_STORE_FILENAME)) as reader:
+        assert reader.frames() == [0, 1, 2]
+        np.testing.assert_array_equal(reader.read_frame(1)[0]['segmentation'], square_mask(2) > 127)
+        assert reader.read_frame(2) == []
+
+
+def test_interrupted_run_is_marked_incomplete(tmp_path):
+    writer = ManualMaskWriter(str(tmp_path), 25.0)
+    writer.add(square_mask(2))
+    writer.close(complete=False)
+    with open(tmp_path / 'mask_objects.json') as f:
+        assert json.load(f)['complete'] is False
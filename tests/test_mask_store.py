@@ -0,0 +1,146 @@
+import json
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+from mask_store import (FOOTER, MaskStoreReader, MaskStoreWriter, decode_rle, encode_rle, export_png_layout)
+
+WIDTH, HEIGHT = 40, 24
+
+
+def random_mask(random, shape=(HEIGHT, WIDTH)):
+    return random.rand(*shape) > 0.6
+
+
+def make_masks(random, frame_num, count=3):
+    masks = []
+    for object_id in range(count):
+        masks.append({
+            'segmentation': random_mask(random),
+            'bbox': [object_id, frame_num, 10 + object_id, 12],
+            'area': float(100 + object_id),
+            'stability_score': 0.9,
+            'object_id': object_id * 2,
+        })
+    return masks
+
+
+@pytest.mark.parametrize("mask", [
+    np.zeros((4, 5), dtype=bool),
+    np.ones((4, 5), dtype=bool),
+    np.eye(5, dtype=bool),
+    np.array([[True, False, False, True]]),
+    np.zeros((0, 3), dtype=bool),
+])
+def test_rle_round_trip_edge_cases(mask):
+    counts = encode_rle(mask)
+    assert counts.dtype == np.uint32
+    assert counts.sum() == mask.size
+    np.testing.assert_array_equal(decode_rle(counts, mask.shape), mask)
+
+
+def test_rle_starts_with_background():
+    assert encode_rle(np.array([True, True, False])).tolist() == [0, 2, 1]
+    assert encode_rle(np.array([False, True, True])).tolist() == [1, 2]
+
+
+def test_rle_round_trip_random():
+    random = np.random.RandomState(0)
+    for _ in range(50):
+        mask = random_mask(random, tuple(random.randint(1, 30, 2)))
+        np.testing.assert_array_equal(decode_rle(encode_rle(mask), mask.shape), mask)
+
+
+def write_store(path, frames, close=True):
+    writer = MaskStoreWriter(path, (WIDTH, HEIGHT), 25.0)
+    for frame_num, masks in frames.items():
+        writer.write_frame(frame_num, masks)
+    if close:
+        writer.close()
+    else:
+        writer.flush()
+    return writer
+
+
+def assert_frame_equal(read, written):
+    assert len(read) == len(written)
+    for read_mask, mask_data in zip(read, written):
+        np.testing.assert_array_equal(read_mask['segmentation'], mask_data['segmentation'])
+        assert read_mask['object_id'] == mask_data['object_id']
+        assert read_mask['bbox'] == mask_data['bbox']
+        assert read_mask['area'] == mask_data['area']
+        assert read_mask['stability_score'] == pytest.approx(mask_data['stability_score'])
+
+
+def test_container_round_trip(tmp_path):
+    random = np.random.RandomState(1)
+    frames = {frame_num: make_masks(random, frame_num) for frame_num in range(6)}
+    frames[6] = []  # A frame without objects is still indexed
+    path = str(tmp_path / "masks.sfxm")
+    write_store(path, frames)
+
+    with MaskStoreReader(path) as reader:
+        assert reader.frame_size == (WIDTH, HEIGHT)
+        assert reader.fps == 25.0
+        assert reader.frames() == list(range(7))
+        # Read out of order through the index
+        for frame_num in reversed(reader.frames()):
+            assert_frame_equal(reader.read_frame(frame_num), frames[frame_num])
+        metadata = reader.read_metadata(3)
+        assert [entry['object_id'] for entry in metadata] == [0, 2, 4]
+        assert 'segmentation' not in metadata[0] and 'runs' not in metadata[0]
+
+
+def test_reader_scans_chunks_without_footer(tmp_path):
+    # A writer that is still running (or was killed) has no index yet
+    random = np.random.RandomState(2)
+    frames = {frame_num: make_masks(random, frame_num) for frame_num in range(4)}
+    path = str(tmp_path / "masks.sfxm")
+    writer = write_store(path, frames, close=False)
+    try:
+        with MaskStoreReader(path) as reader:
+            assert reader.frames() == [0, 1, 2, 3]
+            assert_frame_equal(reader.read_frame(2), frames[2])
+    finally:
+        writer.close()
+
+
+def test_reader_ignores_truncated_last_chunk(tmp_path):
+    random = np.random.RandomState(3)
+    frames = {frame_num: make_masks(random, frame_num) for frame_num in range(3)}
+    path = str(tmp_path / "masks.sfxm")
+    write_store(path, frames)
+    with MaskStoreReader(path) as reader:
+        last_offset = reader.offsets[2]
+    # Drop the index and footer, then cut the last chunk short
+    with open(path, "r+b") as f:
+        f.truncate(last_offset + 10)
+    with MaskStoreReader(path) as reader:
+        assert reader.frames() == [0, 1]
+        assert_frame_equal(reader.read_frame(1), frames[1])
+
+
+def test_footer_points_at_index(tmp_path):
+    path = str(tmp_path / "masks.sfxm")
+    write_store(path, {0: [], 5: []})
+    with open(path, "rb") as f:
+        f.seek(-FOOTER.size, os.SEEK_END)
+        _, frame_count, magic = FOOTER.unpack(f.read())
+    assert (frame_count, magic) == (2, b"SFXINDEX")
+
+
+def test_export_png_layout(tmp_path):
+    random = np.random.RandomState(4)
+    frames = {frame_num: make_masks(random, frame_num, count=2) for frame_num in range(2)}
+    path = str(tmp_path / "masks.sfxm")
+    write_store(path, frames)
+    output_dir = str(tmp_path / "png")
+    export_png_layout(path, output_dir)
+
+    with open(os.path.join(output_dir, "mask_metadata.json")) as f:
+        metadata = json.load(f)
+    assert [(entry['frame'], entry['object_id']) for entry in metadata] == [(0, 0), (0, 2), (1, 0), (1, 2)]
+    png = cv2.imread(os.path.join(output_dir, metadata[3]['filename']), cv2.IMREAD_GRAYSCALE)
+    np.testing.assert_array_equal(png > 127, frames[1][1]['segmentation'])
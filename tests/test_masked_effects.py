@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from custom_effects import apply_effect, apply_effect_masked, apply_prepared_masked, create_effect
+
+EFFECTS = [
+    ("glitch", {"intensity": 0.5}),
+    ("glitch", {"intensity": 1.7}),  # Shift wider than the frame
+    ("pixelate", {"block_size": 16}),
+    ("pixelate", {"block_size": 10}),
+    ("pixelate", {"block_size": 7}),
+]
+# (width, height): multiples of every block size above, and sizes that are not
+FRAME_SIZES = [(160, 80), (160, 100), (97, 61)]
+
+
+def mask_boxes(width, height, size=30):
+    # A box touching each edge and each corner, one in the middle and one covering the frame
+    right, bottom = width - size, height - size
+    middle_x, middle_y = (width - size) // 2, (height - size) // 2
+    boxes = [(0, middle_y), (right, middle_y), (middle_x, 0), (middle_x, bottom),
+             (0, 0), (right, bottom), (middle_x, middle_y)]
+    return [(x, y, size, size) for x, y in boxes] + [(0, 0, width, height)]
+
+
+def make_mask(width, height, box):
+    # An ellipse inside the box, so the bounding box is the box but the mask is not
+    x, y, w, h = box
+    rows, cols = np.ogrid[:height, :width]
+    inside = ((cols + 0.5 - x - w / 2) / (w / 2)) ** 2 + ((rows + 0.5 - y - h / 2) / (h / 2)) ** 2 <= 1
+    return np.where(inside, 255, 0).astype(np.uint8)
+
+
+@pytest.mark.parametrize("effect_name, parameters", EFFECTS)
+@pytest.mark.parametrize("width, height", FRAME_SIZES)
+def test_masked_render_matches_full_frame(effect_name, parameters, width, height):
+    frame = np.random.RandomState(width * height).randint(0, 256, (height, width, 3)).astype(np.uint8)
+    full = apply_effect(frame, effect_name, parameters)
+    effect = create_effect(effect_name, width, height, parameters)
+    for box in mask_boxes(width, height):
+        mask = make_mask(width, height, box)
+        expected = np.where(mask[:, :, None] > 0, full, frame)
+        np.testing.assert_array_equal(apply_effect_masked(frame.copy(), mask, effect_name, parameters), expected,
+                                      err_msg=str(box))
+        np.testing.assert_array_equal(apply_prepared_masked(frame.copy(), mask, effect), expected, err_msg=str(box))
+
+
+def test_empty_mask_leaves_frame():
+    frame = np.random.RandomState(0).randint(0, 256, (40, 50, 3)).astype(np.uint8)
+    mask = np.zeros((40, 50), dtype=np.uint8)
+    np.testing.assert_array_equal(apply_effect_masked(frame.copy(), mask, "pixelate", {"block_size": 8}), frame)
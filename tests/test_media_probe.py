@@ -0,0 +1,113 @@
+import json
+import os
+import subprocess
+import threading
+
+import pytest
+
+import media_probe
+from media_probe import MediaProbeCache, PROBE_VERSION
+
+
+def ffprobe_output(packets, format_start="1.400000", stream_start="1.422000"):
+    return json.dumps({
+        "format": {"duration": "4.000000", "start_time": format_start},
+        "streams": [{"codec_name": "h264", "profile": "High", "level": 40, "pix_fmt": "yuv420p",
+                     "time_base": "1/90000", "width": 64, "height": 48, "avg_frame_rate": "25/1",
+                     "r_frame_rate": "25/1", "has_b_frames": 2, "start_time": stream_start}],
+        "packets": [{"pts_time": pts, "flags": flags} for pts, flags in packets],
+    })
+
+
+@pytest.fixture
+def fake_ffprobe(monkeypatch):
+    calls = []
+
+    def install(stdout):
+        def run(command, **kwargs):
+            calls.append(command)
+            return subprocess.CompletedProcess(command, 0, stdout, "")
+        monkeypatch.setattr(media_probe.subprocess, "run", run)
+        return calls
+    return install
+
+
+def test_keyframes_count_from_the_container_start(fake_ffprobe):
+    # Decode order of closed GOPs with B-frames: every frame after a keyframe is shown after it
+    fake_ffprobe(ffprobe_output([("1.422000", "K__"), ("1.542000", "___"), ("1.462000", "___"),
+                                 ("2.422000", "K__"), ("2.502000", "___"), ("N/A", "___")]))
+    info = media_probe.run_ffprobe("clip.mp4")
+    assert info["keyframes"] == [0.022, 1.022]
+    assert info["start_offset"] == 0.022
+    assert info["open_gop"] is False
+    assert (info["profile"], info["level"], info["time_base"], info["has_b_frames"]) == ("High", 40, "1/90000", 2)
+
+
+def test_leading_frames_mark_an_open_gop(fake_ffprobe):
+    fake_ffprobe(ffprobe_output([("0.000000", "K__"), ("0.080000", "___"), ("1.000000", "K__"),
+                                 ("0.920000", "___")], format_start="0.000000", stream_start="0.000000"))
+    info = media_probe.run_ffprobe("clip.mp4")
+    assert info["open_gop"] is True
+    assert info["keyframes"] == [0.0, 1.0]
+
+
+def test_missing_start_times_default_to_zero(fake_ffprobe):
+    fake_ffprobe(ffprobe_output([("0.500000", "K__")], format_start="N/A", stream_start="N/A"))
+    info = media_probe.run_ffprobe("clip.mkv")
+    assert info["keyframes"] == [0.5]
+    assert info["start_offset"] == 0.0
+
+
+def test_cache_reprobes_entries_from_an_older_version(tmp_path, fake_ffprobe):
+    video = tmp_path / "clip.mp4"
+    video.write_bytes(b"not really a video")
+    calls = fake_ffprobe(ffprobe_output([("1.422000", "K__")]))
+    cache = MediaProbeCache(str(tmp_path / "cache.json"))
+    cache.entries[cache.make_key(str(video))] = {"keyframes": [1.422], "version": PROBE_VERSION - 1}
+
+    assert cache.probe(str(video))["keyframes"] == [0.022]
+    assert cache.probe(str(video))["version"] == PROBE_VERSION
+    assert len(calls) == 1
+    assert json.loads((tmp_path / "cache.json").read_text())[cache.make_key(str(video))]["keyframes"] == [0.022]
+
+
+def test_ffprobe_timeout_is_a_runtime_error(monkeypatch):
+    def run(command, **kwargs):
+        assert kwargs["timeout"] == media_probe.FFPROBE_TIMEOUT
+        raise subprocess.TimeoutExpired(command, kwargs["timeout"])
+    monkeypatch.setattr(media_probe.subprocess, "run", run)
+    with pytest.raises(RuntimeError, match="did not finish"):
+        media_probe.run_ffprobe("clip.mp4")
+
+
+def test_caches_sharing_a_file_keep_each_others_entries(tmp_path, monkeypatch):
+    monkeypatch.setattr(media_probe, "run_ffprobe", lambda path: {"path": path, "version": PROBE_VERSION})
+    videos = []
+    for i in range(8):
+        video = tmp_path / f"clip{i}.mp4"
+        video.write_bytes(b"x" * i)
+        videos.append(str(video))
+    # Separate instances stand in for separate processes: each only knows the file as it was when it started
+    caches = [MediaProbeCache(str(tmp_path / "cache.json")) for _ in videos]
+    threads = [threading.Thread(target=cache.probe, args=(video,)) for cache, video in zip(caches, videos)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    entries = MediaProbeCache(str(tmp_path / "cache.json")).entries
+    assert sorted(entry["path"] for entry in entries.values()) == videos
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_saving_replaces_older_versions_of_the_same_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(media_probe, "run_ffprobe", lambda path: {"size": os.path.getsize(path), "version": PROBE_VERSION})
+    video = tmp_path / "clip.mp4"
+    video.write_bytes(b"first")
+    cache = MediaProbeCache(str(tmp_path / "cache.json"))
+    cache.probe(str(video))
+    video.write_bytes(b"second version")
+    other = MediaProbeCache(str(tmp_path / "cache.json"))
+    other.probe(str(video))
+
+    assert [entry["size"] for entry in MediaProbeCache(str(tmp_path / "cache.json")).entries.values()] == [14]
@@ -0,0 +1,102 @@
+import json
+import os
+
+import pytest
+
+import metrics
+from metrics import Histogram, MetricsRegistry, ProgressTracker, read_progress
+
+
+def test_histogram_buckets_and_quantile():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2]
+    assert (histogram.count, histogram.min, histogram.max) == (4, 0.05, 5.0)
+    assert histogram.quantile(0.25) == 0.1
+    assert histogram.quantile(0.75) == 1.0
+    # Past the last bucket the largest observation is reported
+    assert histogram.quantile(1.0) == 5.0
+
+
+def test_stage_summary_in_pipeline_order():
+    registry = MetricsRegistry()
+    registry.observe_stage("write", 0.5, items=10)
+    registry.observe_stage("decode", 0.2)
+    registry.observe_stage("decode", 0.3)
+    summary = registry.stage_summary()
+    assert list(summary) == ["decode", "write"]
+    assert summary["decode"]["calls"] == 2 and summary["decode"]["items"] == 2
+    assert summary["write"]["fps"] == pytest.approx(20.0)
+    assert summary["decode"]["mean_ms"] == pytest.approx(250.0)
+
+
+def test_merge_accumulates_worker_state():
+    parent, worker = MetricsRegistry(), MetricsRegistry()
+    parent.counter("frames_total", task="auto").inc(3)
+    parent.gauge("queue_depth").set(4)
+    worker.counter("frames_total", task="auto").inc(2)
+    worker.gauge("queue_depth").set(1)
+    worker.observe_stage("inference", 0.4)
+    parent.merge(json.loads(json.dumps(worker.state())))  # State crosses processes as JSON-like data
+    assert parent.counter("frames_total", task="auto").value == 5
+    assert parent.gauge("queue_depth").value == 1
+    assert parent.stage_summary()["inference"]["calls"] == 1
+
+
+def test_prometheus_text():
+    registry = MetricsRegistry()
+    registry.counter("frames_total", "Frames written", task='a "quoted" task').inc(2)
+    registry.histogram("stage_seconds", buckets=(0.1, 1.0), stage="decode").observe(0.5)
+    lines = registry.prometheus_text(source="test").splitlines()
+    assert "# HELP segmentfx_frames_total Frames written" in lines
+    assert "# TYPE segmentfx_frames_total counter" in lines
+    assert 'segmentfx_frames_total{source="test",task="a \\"quoted\\" task"} 2' in lines
+    assert "# TYPE segmentfx_stage_seconds histogram" in lines
+    # Buckets are cumulative and end with +Inf
+    assert 'segmentfx_stage_seconds_bucket{source="test",stage="decode",le="0.1"} 0' in lines
+    assert 'segmentfx_stage_seconds_bucket{source="test",stage="decode",le="1"} 1' in lines
+    assert 'segmentfx_stage_seconds_bucket{source="test",stage="decode",le="+Inf"} 1' in lines
+    assert 'segmentfx_stage_seconds_sum{source="test",stage="decode"} 0.5' in lines
+    assert 'segmentfx_stage_seconds_count{source="test",stage="decode"} 1' in lines
+
+
+def test_export_writes_json_lines_and_prometheus(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", MetricsRegistry())
+    monkeypatch.delenv(metrics.METRICS_DIR_ENV, raising=False)
+    assert metrics.export(None, "test") is None
+
+    metrics.observe_stage("encode", 0.1)
+    directory = str(tmp_path / "metrics")
+    assert metrics.export(directory, "test", video="clip.mp4") == directory
+    metrics.export(directory, "test", video="clip.mp4")
+
+    with open(os.path.join(directory, metrics.JSON_LINES_FILENAME)) as f:
+        records = [json.loads(line) for line in f]
+    # JSON lines are appended, one snapshot per export
+    assert len(records) == 2
+    assert records[0]["source"] == "test" and records[0]["video"] == "clip.mp4"
+    assert records[0]["stages"]["encode"]["calls"] == 1
+    with open(os.path.join(directory, metrics.PROMETHEUS_FILENAME.format("test"))) as f:
+        assert 'segmentfx_stage_seconds_count{source="test",stage="encode"} 1' in f.read()
+
+
+def test_export_directory_from_environment(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, "REGISTRY", MetricsRegistry())
+    monkeypatch.setenv(metrics.METRICS_DIR_ENV, str(tmp_path))
+    assert metrics.export(None, "test") == str(tmp_path)
+    assert os.path.exists(tmp_path / metrics.JSON_LINES_FILENAME)
+
+
+def test_progress_file(tmp_path):
+    path = str(tmp_path / "progress" / "job.json")
+    tracker = ProgressTracker("auto", total=10, path=path, write_interval=0)
+    assert read_progress(path)["status"] == "running"
+    tracker(4)
+    snapshot = read_progress(path)
+    assert (snapshot["done"], snapshot["total"], snapshot["progress"]) == (4, 10, 40.0)
+    tracker.finish(output="out.mp4")
+    snapshot = read_progress(path)
+    assert snapshot["status"] == "complete" and snapshot["done"] == 10
+    assert snapshot["eta_seconds"] == 0.0 and snapshot["output"] == "out.mp4"
+    assert read_progress(str(tmp_path / "missing.json")) is None
@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+
+from src.scheduler import Job, JobScheduler
+from src.video_cutter import JobCancelled
+
+
+def write_outputs(paths, job=None, fail=None, release=None):
+    for path in paths:
+        job.add_output(str(path))
+        path.write_text("partial")
+    if release is not None:
+        release.wait(5)
+    if job.cancel_event.is_set():
+        raise JobCancelled()
+    if fail:
+        raise RuntimeError(fail)
+    return [str(path) for path in paths]
+
+
+def test_failed_job_removes_only_outputs_it_created(tmp_path):
+    existing = tmp_path / "clip_0_10.mp4"
+    existing.write_text("an earlier cut")
+    created = tmp_path / "clip_0_10.mp3"
+    scheduler = JobScheduler(max_workers=1, cpu_slots=1)
+    job = scheduler.submit('cut', write_outputs, [existing, created], fail="ffmpeg failed")
+    assert scheduler.wait(5)
+
+    assert job.status == Job.FAILED
+    assert job.error == "ffmpeg failed"
+    assert existing.exists()
+    assert not created.exists()
+
+
+def test_cancelled_job_removes_created_folder(tmp_path):
+    created = tmp_path / "render"
+    started, release = threading.Event(), threading.Event()
+
+    def render(job=None):
+        job.add_output(str(created))
+        created.mkdir()
+        (created / "part_0000.mp4").write_text("partial")
+        started.set()
+        return write_outputs([], job=job, release=release)
+
+    scheduler = JobScheduler(max_workers=1, cpu_slots=1)
+    job = scheduler.submit('render', render)
+    assert started.wait(5)
+    assert scheduler.cancel(job.id)
+    release.set()
+    assert scheduler.wait(5)
+
+    assert job.status == Job.CANCELLED
+    assert not created.exists()
+
+
+def test_finished_job_keeps_its_outputs(tmp_path):
+    created = tmp_path / "clip_0_10.mp4"
+    scheduler = JobScheduler(max_workers=1, cpu_slots=1)
+    job = scheduler.submit('cut', write_outputs, [created])
+    assert scheduler.wait(5)
+
+    assert job.status == Job.DONE
+    assert job.result == [str(created)]
+    assert created.exists()
+
+
+def test_thread_wait_honours_its_timeout():
+    pytest.importorskip("PyQt5")
+    from src import thread
+
+    release = threading.Event()
+    scheduler = JobScheduler(max_workers=1, cpu_slots=1)
+    qt_thread = thread.Thread()
+    qt_thread.job = scheduler.submit('cut', lambda job=None: release.wait(5))
+    assert qt_thread.wait(50) is False
+    release.set()
+    assert qt_thread.wait() is True
+    assert thread.Thread().wait(0) is True
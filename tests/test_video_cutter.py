@@ -0,0 +1,110 @@
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from ClaudeSeg.SegmentFx.python.media_probe import MediaProbeCache
+from src import video_cutter
+from src.video_cutter import KEYFRAME_EPSILON, plan_cut
+
+KEYFRAMES = [0.0, 1.0, 2.0, 3.0, 4.0]
+DURATION = 4.5
+
+
+def test_copy_moves_start_back_to_previous_keyframe():
+    assert plan_cut(1.5, 3.2, KEYFRAMES, 'copy') == [(1.0, 3.2, True)]
+    assert plan_cut(2.0, 3.2, KEYFRAMES, 'copy') == [(2.0, 3.2, True)]
+    assert plan_cut(0.5, 1.0, [], 'copy') == [(0, 1.0, True)]
+
+
+def test_accurate_is_one_encoded_part():
+    assert plan_cut(1.5, 3.2, KEYFRAMES, 'accurate') == [(1.5, 3.2, False)]
+
+
+def test_smart_encodes_only_partial_gops():
+    assert plan_cut(0.5, 3.3, KEYFRAMES, 'smart', DURATION) == [(0.5, 1.0, False), (1.0, 3.0, True), (3.0, 3.3, False)]
+
+
+def test_smart_on_keyframes_is_one_copy():
+    assert plan_cut(1.0, 3.0, KEYFRAMES, 'smart', DURATION) == [(1.0, 3.0, True)]
+
+
+def test_smart_keyframes_match_within_epsilon():
+    start = 1.0 + KEYFRAME_EPSILON / 2
+    assert plan_cut(start, 3.0 - KEYFRAME_EPSILON / 2, KEYFRAMES, 'smart', DURATION) == [(1.0, 3.0, True)]
+
+
+def test_smart_without_a_whole_gop_is_encoded():
+    assert plan_cut(1.2, 1.8, KEYFRAMES, 'smart', DURATION) == [(1.2, 1.8, False)]
+    assert plan_cut(1.2, 2.5, KEYFRAMES, 'smart', DURATION) == [(1.2, 2.5, False)]
+
+
+def test_smart_end_of_stream_closes_the_last_gop():
+    assert plan_cut(3.5, DURATION, KEYFRAMES, 'smart', DURATION) == [(3.5, 4.0, False), (4.0, DURATION, True)]
+    # Without the duration the tail after the last keyframe is re-encoded
+    assert plan_cut(3.5, DURATION, KEYFRAMES, 'smart') == [(3.5, DURATION, False)]
+
+
+def test_smart_with_container_start_offset():
+    # Keyframes as media_probe reports them for a file whose first frame sits 0.022s after the
+    # container start: the planned boundaries are the -ss positions of those keyframes
+    keyframes = [round(k + 0.022, 6) for k in KEYFRAMES]
+    assert plan_cut(0.5, 3.3, keyframes, 'smart', DURATION) == [(0.5, 1.022, False), (1.022, 3.022, True),
+                                                               (3.022, 3.3, False)]
+
+
+def test_encoder_args_follow_the_source():
+    info = {'codec': 'h264', 'profile': 'Constrained Baseline', 'level': 31, 'pix_fmt': 'yuv420p',
+            'time_base': '1/30000', 'keyframes': [0.0, 1.001, 2.002], 'fps': 30000 / 1001}
+    args = f' {video_cutter.smart_cut_encoder_args(info)} '
+    for option in ('-c:v libx264', '-pix_fmt yuv420p', '-profile:v baseline', '-level:v 3.1',
+                   '-enc_time_base:v 1/30000', '-g 30'):
+        assert f' {option} ' in args, option
+
+
+def test_mpeg4_encoder_args_skip_unsupported_time_base():
+    info = {'codec': 'mpeg4', 'profile': 'Simple Profile', 'level': 1, 'pix_fmt': 'yuv420p',
+            'time_base': '1/90000', 'keyframes': [0.0], 'fps': 25.0}
+    assert '-enc_time_base' not in video_cutter.smart_cut_encoder_args(info)
+
+
+def has_ffmpeg():
+    if not (shutil.which('ffmpeg') and shutil.which('ffprobe')):
+        return False
+    encoders = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True).stdout
+    return 'libx264' in encoders
+
+
+def decode_gray(path, size):
+    result = subprocess.run(['ffmpeg', '-v', 'error', '-xerror', '-i', path, '-map', '0:v:0', '-fps_mode', 'passthrough',
+                             '-pix_fmt', 'gray', '-f', 'rawvideo', '-'], capture_output=True, check=True)
+    return np.frombuffer(result.stdout, np.uint8).reshape(-1, size[1], size[0]).astype(np.float32)
+
+
+@pytest.mark.skipif(not has_ffmpeg(), reason="needs ffmpeg and ffprobe with libx264")
+def test_smart_cut_joins_without_broken_or_repeated_frames(tmp_path, monkeypatch):
+    # Keep the test's probe results out of the user's cache
+    cache = MediaProbeCache(str(tmp_path / 'media_probe.json'))
+    monkeypatch.setattr(video_cutter, 'probe_media', cache.probe)
+    size, fps = (160, 120), 25
+    source = str(tmp_path / 'source.mp4')
+    # Closed 1s GOPs with B-frames, so the decode timestamps trail the presentation timestamps
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', '-f', 'lavfi', '-i', f'testsrc2=size={size[0]}x{size[1]}:rate={fps}',
+                    '-f', 'lavfi', '-i', 'sine=sample_rate=48000', '-t', '6', '-c:v', 'libx264', '-profile:v', 'high',
+                    '-g', str(fps), '-bf', '2', '-c:a', 'aac', '-shortest', source], check=True)
+
+    start_time, end_time = 0.6, 3.4
+    output = video_cutter.cut_ranges(source, [(start_time, end_time)], 'smart')[0]
+    assert os.path.exists(output)
+
+    cut = decode_gray(output, size)
+    frames = decode_gray(source, size)
+    assert abs(len(cut) - round((end_time - start_time) * fps)) <= 1
+    # The cut is one contiguous run of source frames: re-encoded ends are close, the copied GOPs exact
+    first = int(np.argmin([np.abs(frames[i] - cut[0]).mean() for i in range(len(frames))]))
+    errors = np.abs(frames[first: first + len(cut)] - cut).mean(axis=(1, 2))
+    assert errors.max() < 8
+    assert (errors == 0).sum() >= 2 * fps
+